@@ -1,13 +1,12 @@
 
 import streamlit as st
 import time
-import pandas as pd
 from dotenv import load_dotenv
 import os
-import psycopg2
-import bcrypt
-from google import genai
 import re
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuration and Initialization --- #
 
@@ -16,6 +15,14 @@ st.set_page_config(
     layout="wide"
 )
 
+def secret_flag(name, default):
+    # On/off setting from st.secrets: a TOML boolean as is, a string (as environment overrides
+    # give) is on only when it reads 1, true, yes or on
+    value = st.secrets.get(name, default)
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
 
 # Initialize session state for history and current input
 if 'history' not in st.session_state:
@@ -31,6 +38,16 @@ if 'query_results_df' not in st.session_state:
     st.session_state.query_results_df = None
 if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
+if 'query_job' not in st.session_state:
+    st.session_state.query_job = None
+if 'query_results_page' not in st.session_state:
+    st.session_state.query_results_page = None
+if 'query_confirmation' not in st.session_state:
+    st.session_state.query_confirmation = None
+if 'query_guard_note' not in st.session_state:
+    st.session_state.query_guard_note = None
+if 'session_key' not in st.session_state:
+    st.session_state.session_key = uuid.uuid4().hex
 
 
 # -- Login Screen -- #
@@ -52,6 +69,7 @@ def login_screen():
     if login_btn:
         if password:
             try:
+                import bcrypt
                 if bcrypt.checkpw(password.encode('utf-8'), HASHED_PASSWORD.encode('utf-8')):
                     st.session_state.logged_in = True
                     st.success("✅ Authentication successful! Redirecting...")
@@ -72,70 +90,15 @@ def login_screen():
 def require_login():
     if not st.session_state.logged_in:
         login_screen()
+        # The first visitor's login screen starts the warm-up once it is rendered, so the two
+        # do not compete for the interpreter while it paints
+        start_warmup()
         st.stop()
 
-# -- Database Schema for LLM refrence -- #
-DATABASE_SCHEMA = """
-    Database Schema:
-
-    Lookup tables - 
-    Region(
-        RegionID SERIAL not null primary key,
-        Region TEXT not null
-    )
-    Country(
-        CountryID SERIAL not null Primary key,
-        Country Text not null,
-        RegionID integer not null,
-        FOREIGN KEY(RegionID) REFERENCES Region(RegionID)
-    )
-    ProductCategory(
-        ProductCategoryID SERIAL not null Primary Key,
-        ProductCategory Text not null,
-        ProductCategoryDescription Text not null,
-        UNIQUE(ProductCategory)
-    )
-    Product(
-        ProductID SERIAL not null Primary key,
-        ProductName Text not null,
-        ProductUnitPrice Real not null,
-        ProductCategoryID integer not null,
-        UNIQUE (ProductName),
-        FOREIGN KEY(ProductCategoryID) REFERENCES ProductCategory(ProductCategoryID)
-    )
-
-    Core tables -
-
-    Customer(
-        CustomerID SERIAL not null Primary Key,
-        FirstName Text not null,
-        LastName Text not null,
-        Address Text not null,
-        City Text not null,
-        CountryID integer not null,
-        UNIQUE (FirstName, LastName, Address),
-        FOREIGN KEY(CountryID) REFERENCES Country(CountryID)
-    )
-    OrderDetail(
-        OrderID SERIAL not null Primary Key,
-        CustomerID integer not null,
-        ProductID integer not null,
-        OrderDate TIMESTAMP not null,
-        QuantityOrdered integer not null,
-        UNIQUE (CustomerID, ProductID),
-        FOREIGN KEY(CustomerID) REFERENCES Customer(CustomerID),
-        FOREIGN KEY(ProductID) REFERENCES Product(ProductID)
-    )
-
-    Important Notes - 
-    Use Joins to get descriptive values from lookup tables
-    OrderDate is a TIMESTAMP type
-    Always use proper joins for foreign key relationships
-"""
-
 # --- Database connection --- #
 load_dotenv()
 
+@st.cache_resource
 def generate_url():
     DATABASE_USERNAME = st.secrets["DATABASE_USERNAME"]
     DATABASE_PASSWORD = st.secrets["DATABASE_PASSWORD"] 
@@ -146,30 +109,341 @@ def generate_url():
 
 DATABASE_URL = generate_url()
 
-def db_connection(DB_URL):
+@st.cache_resource(show_spinner=False)
+def get_connection_pool():
+    """One connection pool per server process, shared by every session."""
+    import db_pool
+    return db_pool.ConnectionPool(
+        DATABASE_URL,
+        minconn=int(st.secrets.get("DB_POOL_MIN", 1)),
+        maxconn=int(st.secrets.get("DB_POOL_SIZE", 5)),
+        checkout_timeout=float(st.secrets.get("DB_POOL_TIMEOUT", 30)),
+    )
+
+
+@st.cache_resource
+def get_query_cache():
+    """Result cache shared by every session, invalidated by each load of the database."""
+    import query_cache
+    return query_cache.QueryCache(
+        ttl_seconds=float(st.secrets.get("QUERY_CACHE_TTL", 600)),
+        max_bytes=int(float(st.secrets.get("QUERY_CACHE_MB", 64)) * 1024 * 1024),
+    )
+
+
+# "postgres" runs queries on the database above, "duckdb" on a local DuckDB copy of its tables
+# built by duckdb_backend.py, in-process and without a network round trip per query.
+QUERY_BACKEND = st.secrets.get("QUERY_BACKEND", "postgres")
+
+@st.cache_resource(show_spinner=False)
+def get_duckdb_backend():
+    """The DuckDB file queries run on when QUERY_BACKEND is "duckdb"."""
+    import duckdb_backend
+    return duckdb_backend.DuckDBBackend(st.secrets.get("DUCKDB_PATH", "sales.duckdb"))
+
+@st.cache_resource
+def get_query_executor():
+    """Worker threads running queries in the background, one per pooled connection."""
+    return ThreadPoolExecutor(max_workers=int(st.secrets.get("DB_POOL_SIZE", 5)), thread_name_prefix="query")
+
+@st.cache_resource
+def get_query_log():
+    """Log of executed queries and their durations, the input of index_advisor.py."""
+    import query_log
+    return query_log.QueryLog(st.secrets.get("QUERY_LOG_PATH", "query_log.jsonl"))
+
+# Sessions keep the last HISTORY_MAX_ITEMS questions and RESULT_PREVIEW_ROWS rows of the result
+# page in memory. The full page goes to a Parquet file, dropped SESSION_MAX_AGE_SECONDS after its
+# session last used it.
+HISTORY_MAX_ITEMS = int(st.secrets.get("HISTORY_MAX_ITEMS", 50))
+RESULT_PREVIEW_ROWS = int(st.secrets.get("RESULT_PREVIEW_ROWS", 100))
+SESSION_MAX_AGE_SECONDS = float(st.secrets.get("SESSION_MAX_AGE_SECONDS", 3600))
+
+@st.cache_resource
+def get_session_memory():
+    """Session state size of every session on this server, for the memory report."""
+    import session_memory
+    return session_memory.SessionMemory(SESSION_MAX_AGE_SECONDS)
+
+@st.cache_resource
+def get_result_spill():
+    """On-disk store of full result pages, evicting stale sessions' data every 10 minutes."""
+    import session_memory
+    spill = session_memory.ResultSpill(
+        st.secrets.get("RESULT_SPILL_DIR", os.path.join(tempfile.gettempdir(), "sales_assistant_results")),
+        SESSION_MAX_AGE_SECONDS,
+    )
+    session_memory.start_eviction(600, spill, get_session_memory())
+    return spill
+
+QUERY_TIMEOUT_SECONDS = float(st.secrets.get("QUERY_TIMEOUT_SECONDS", 60))
+# Results are fetched a page at a time. Paging stops at QUERY_MAX_ROWS and a page is cut short
+# once its rows take more than QUERY_MAX_PAGE_MB, so a session never holds more than one page.
+QUERY_PAGE_SIZE = int(st.secrets.get("QUERY_PAGE_SIZE", 500))
+QUERY_MAX_ROWS = int(st.secrets.get("QUERY_MAX_ROWS", 100000))
+QUERY_MAX_PAGE_BYTES = int(float(st.secrets.get("QUERY_MAX_PAGE_MB", 16)) * 1024 * 1024)
+# Aggregates a rollup view can answer are run against it; ROLLUP_VERIFY also runs them on the base
+# tables and falls back to that answer if the two differ.
+USE_ROLLUPS = secret_flag("USE_ROLLUPS", True)
+ROLLUP_VERIFY = secret_flag("ROLLUP_VERIFY", False)
+
+
+def fetch_rollup_page(conn, sql, route, offset, fetch_rows):
+    """Page of sql answered from the rollup route points at, None if the rollup can't be used.
+
+    Runs inside a savepoint so a missing view (a load in progress) leaves the transaction usable
+    for the base query. The page records the rollup and its speedup in df.attrs.
+    """
+    import psycopg2
+    import result_pages
+    import rollups
+    view_name, rollup_query = route
+    with conn.cursor() as cur:
+        cur.execute("SAVEPOINT rollup")
     try:
-        conn = psycopg2.connect(DB_URL)
-        return conn
-    except Error as e:
-        print(e)
+        rollup_start = time.perf_counter()
+        df = result_pages.fetch_page(conn, rollup_query, offset, fetch_rows, QUERY_MAX_PAGE_BYTES)
+        rollup_seconds = time.perf_counter() - rollup_start
+        if ROLLUP_VERIFY:
+            base_start = time.perf_counter()
+            base_df = result_pages.fetch_page(conn, sql, offset, fetch_rows, QUERY_MAX_PAGE_BYTES)
+            speedup, measured = (time.perf_counter() - base_start) / rollup_seconds, True
+            if not rollups.frames_match(base_df, df):
+                print(f"{view_name} answer differs from the base tables, using the base tables for: {sql}")
+                return base_df
+        else:
+            speedup, measured = rollups.estimated_speedup(conn, sql, rollup_query), False
+    except psycopg2.errors.QueryCanceled:
+        raise
+    except psycopg2.Error as e:
+        print(f"{view_name} not usable, running on the base tables: {e}")
+        with conn.cursor() as cur:
+            cur.execute("ROLLBACK TO SAVEPOINT rollup")
         return None
-    
+    with conn.cursor() as cur:
+        cur.execute("RELEASE SAVEPOINT rollup")
+    df.attrs.update({"rollup": view_name, "rollup_query": rollup_query, "speedup": speedup, "speedup_measured": measured})
+    return df
+
+
+def run_sql(pool, cache, sql, job, offset=0, page_size=QUERY_PAGE_SIZE):
+    """Fetches one page of sql for job on a pooled connection under the job's statement_timeout.
+
+    Takes the pool and cache as arguments and makes no st calls, so it can run on a worker thread.
+    Returns the page, its offset, the total row count (None if counting hit the timeout), the
+    age in seconds of the page if it came from the cache, None if it was just fetched, and the
+    seconds spent if anything ran on the database.
+    """
+    import psycopg2
+    import query_cache
+    import result_pages
+    import rollups
+    run_start = time.perf_counter()
+    executed = False
+    fetch_rows = max(min(page_size, QUERY_MAX_ROWS - offset), 0)
+    page_key = result_pages.page_key(sql, offset, fetch_rows, QUERY_MAX_PAGE_BYTES)
+    count_sql = result_pages.count_sql(sql)
+    route = rollups.route_query(sql) if USE_ROLLUPS else None
+    with pool.connection() as conn:
+        job.attach(conn)
+        try:
+            generation = query_cache.load_generation(conn)
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (int(job.timeout_seconds * 1000),))
+
+            cached = cache.get(page_key, generation)
+            if cached is not None:
+                df, cache_age = cached
+            else:
+                job.check_cancelled()
+                executed = True
+                df = fetch_rollup_page(conn, sql, route, offset, fetch_rows) if route is not None else None
+                if df is None:
+                    df = result_pages.fetch_page(conn, sql, offset, fetch_rows, QUERY_MAX_PAGE_BYTES)
+                cache_age = None
+                cache.put(page_key, generation, df)
+
+            counted = cache.get(count_sql, generation)
+            if counted is not None:
+                total = int(counted[0].iloc[0, 0])
+            else:
+                job.check_cancelled()
+                executed = True
+                try:
+                    with conn.cursor() as cur:
+                        # Counting the rollup rewrite gives the same total without the base table scan
+                        cur.execute(result_pages.count_sql(df.attrs["rollup_query"]) if "rollup" in df.attrs else count_sql)
+                        total = cur.fetchone()[0]
+                    cache.put(count_sql, generation, result_pages.total_frame(total))
+                except psycopg2.errors.QueryCanceled:
+                    if job.cancel_requested:
+                        raise
+                    total = None
+        finally:
+            job.detach()
+    return {"df": df, "offset": offset, "page_size": page_size, "total": total, "cache_age": cache_age,
+            "query_seconds": time.perf_counter() - run_start if executed else None}
+
+# Planner cost thresholds for the pre-flight EXPLAIN: above QUERY_WARN_COST a query needs a confirmation,
+# above QUERY_BLOCK_COST it does not run. Queries estimated past QUERY_MAX_ROWS rows get a LIMIT.
+QUERY_WARN_COST = float(st.secrets.get("QUERY_WARN_COST", 1e6))
+QUERY_BLOCK_COST = float(st.secrets.get("QUERY_BLOCK_COST", 1e9))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def plan_preflight(sql):
+    """EXPLAIN summary of what running sql would execute, its rollup rewrite if it has one.
+
+    Returns {"error": message} when the SQL holds several statements or the planner rejects it.
+    Any other failure raises, st.cache_data does not keep exceptions.
+    """
+    import cost_guard
+    import psycopg2
+    import rollups
+    parts = cost_guard.statements(sql)
+    if len(parts) != 1:
+        return {"error": "only a single SQL statement can be run", "block": len(parts) > 1}
+    if QUERY_BACKEND == "duckdb":
+        return {"error": "plan estimates come from Postgres, queries run on the embedded DuckDB file"}
+    route = rollups.route_query(sql) if USE_ROLLUPS else None
+    try:
+        with get_connection_pool().connection() as conn:
+            if route is not None:
+                try:
+                    return {**cost_guard.plan_summary(cost_guard.explain(conn, route[1])), "rollup": route[0]}
+                except psycopg2.Error:
+                    conn.rollback()
+            return cost_guard.plan_summary(cost_guard.explain(conn, parts[0]))
+    except (psycopg2.ProgrammingError, psycopg2.DataError) as e:
+        # Syntax errors, unknown tables or columns, bad literals: running the query fails the same way
+        return {"error": str(e).strip().splitlines()[0]}
+
+def preflight(sql):
+    """plan_preflight(sql), or {"error": message, "unavailable": True} when no plan could be made:
+    no free connection, a dropped connection or an EXPLAIN timeout. Those are not cached."""
+    try:
+        return plan_preflight(sql)
+    except Exception as e:
+        return {"error": f"the pre-flight check failed, no plan estimate ({str(e).strip().splitlines()[0]})",
+                "unavailable": True}
+
+def guard_query(sql, confirmed=False):
+    """Pre-flight decision on sql, shared by Run Query and the warm-up: (decision, reason, sql to run).
+
+    "block" never runs and "warn" runs only when confirmed is set. The SQL to run carries a LIMIT when the
+    planner expects more than QUERY_MAX_ROWS rows, a confirmed query included. A query the pre-flight
+    could not estimate is a "warn" and runs with the LIMIT once confirmed.
+    """
+    import cost_guard
+    summary = preflight(sql)
+    if summary.get("unavailable"):
+        if not confirmed:
+            return "warn", summary["error"], sql
+        return "warn", f"{summary['error']}, LIMIT {QUERY_MAX_ROWS:,} added", cost_guard.add_limit(sql, QUERY_MAX_ROWS)
+    if "error" in summary:
+        return ("block", summary["error"], sql) if summary.get("block") else ("ok", None, sql)
+    decision, reason = cost_guard.check(summary, QUERY_WARN_COST, QUERY_BLOCK_COST, QUERY_MAX_ROWS)
+    if decision == "block" or (decision == "warn" and not confirmed):
+        return decision, reason, sql
+    if cost_guard.needs_limit(summary, QUERY_MAX_ROWS):
+        sql = cost_guard.add_limit(sql, QUERY_MAX_ROWS)
+        if decision != "limit":
+            reason += f", LIMIT {QUERY_MAX_ROWS:,} added"
+    return decision, reason, sql
+
+def run_sql_embedded(backend, cache, sql, job, offset=0, page_size=QUERY_PAGE_SIZE):
+    """run_sql on the embedded DuckDB backend, same arguments and result.
+
+    There are no rollup views in the DuckDB file, and the job's timeout is enforced by
+    interrupting the query, which raises QueryTimeout.
+    """
+    import result_pages
+    run_start = time.perf_counter()
+    executed = False
+    fetch_rows = max(min(page_size, QUERY_MAX_ROWS - offset), 0)
+    page_key = result_pages.page_key(sql, offset, fetch_rows, QUERY_MAX_PAGE_BYTES)
+    count_sql = result_pages.count_sql(sql)
+    with backend.cursor(job) as (cur, generation):
+        cached = cache.get(page_key, generation)
+        if cached is not None:
+            df, cache_age = cached
+        else:
+            job.check_cancelled()
+            executed = True
+            df = backend.fetch_page(cur, sql, offset, fetch_rows, QUERY_MAX_PAGE_BYTES)
+            cache_age = None
+            cache.put(page_key, generation, df)
+
+        counted = cache.get(count_sql, generation)
+        if counted is not None:
+            total = int(counted[0].iloc[0, 0])
+        else:
+            job.check_cancelled()
+            executed = True
+            total = cur.execute(count_sql).fetchone()[0]
+            cache.put(count_sql, generation, result_pages.total_frame(total))
+    return {"df": df, "offset": offset, "page_size": page_size, "total": total, "cache_age": cache_age,
+            "query_seconds": time.perf_counter() - run_start if executed else None}
+
+def submit_query(job, offset=0, page_size=QUERY_PAGE_SIZE):
+    # Runs job on a worker thread against the configured backend
+    if QUERY_BACKEND == "duckdb":
+        job.submit(get_query_executor(), run_sql_embedded, get_duckdb_backend(), get_query_cache(), job.sql, job, offset, page_size)
+    else:
+        job.submit(get_query_executor(), run_sql, get_connection_pool(), get_query_cache(), job.sql, job, offset, page_size)
 
-def execute_sql(sql):
-    conn = db_connection(DATABASE_URL)
-    with conn:
-        df = pd.read_sql_query(sql,conn)
-        return df
+def execute_sql(sql, timeout_seconds=QUERY_TIMEOUT_SECONDS):
+    import query_jobs
+    job = query_jobs.QueryJob(sql, timeout_seconds)
+    submit_query(job)
+    return job.future.result()
 
 
 # --- LLM connection --- # 
 
+LLM_MODEL = "gemini-2.0-flash-lite"
+
+# Prompts carry only the tables a question needs and the join paths between them
+PRUNE_SCHEMA = secret_flag("PRUNE_SCHEMA", True)
+
+@st.cache_resource
+def get_prompt_cache():
+    """Question to SQL cache on disk, shared by every session and kept across restarts."""
+    import prompt_cache
+    import schema_context
+    return prompt_cache.PromptCache(
+        st.secrets.get("PROMPT_CACHE_PATH", "prompt_cache.sqlite3"),
+        schema_context.DATABASE_SCHEMA,
+        LLM_MODEL,
+        max_entries=int(st.secrets.get("PROMPT_CACHE_SIZE", 1000)),
+        prompt=f"{schema_context.PROMPT_TEMPLATE}\0prune_schema={PRUNE_SCHEMA}",
+    )
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def get_schema_values():
+    """Region, country and category names, so a question naming one gets that table in its prompt."""
+    import schema_context
+    try:
+        if QUERY_BACKEND == "duckdb":
+            return get_duckdb_backend().value_terms(schema_context.VALUE_QUERIES)
+        with get_connection_pool().connection() as conn:
+            return schema_context.load_value_terms(conn)
+    except Exception as e:
+        print(f"schema values not loaded: {e}")
+        return {}
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key):
+    """One Gemini client per process. google.genai is imported here, on the first generation,
+    as it is the slowest import of the app and the login screen does not need it."""
+    from google import genai
+    return genai.Client(api_key=api_key)
+
 def generate_sql_query_llm(prompt):
 
     MY_API_KEY = st.secrets["GEMINI_KEY"]
-    client = genai.Client(api_key=MY_API_KEY)
+    client = get_genai_client(MY_API_KEY)
     response = client.models.generate_content(
-        model="gemini-2.0-flash-lite",
+        model=LLM_MODEL,
         # model="gemini-2.5-flash",
         contents=f"{prompt}",
     )
@@ -187,6 +461,64 @@ def sql_extraction(text_block):
     else:
         print("SQL block not found in the text.")
 
+def question_sql(question):
+    """SQL for question from the prompt cache, generated and cached on a miss, and whether it
+    came from the cache. Makes no st calls other than cached resources, the warm-up runs it too."""
+    import schema_context
+    cache = get_prompt_cache()
+    sql = cache.get(question)
+    if sql is not None:
+        return sql, True
+
+    prompt_formatted = schema_context.build_prompt(question, PRUNE_SCHEMA, get_schema_values() if PRUNE_SCHEMA else None)
+    sql = sql_extraction(generate_sql_query_llm(prompt_formatted))
+    if sql:
+        cache.put(question, sql)
+    return sql, False
+
+
+# --- Warm-up --- #
+
+EXAMPLE_QUESTIONS = {
+    "ex_region": "Find the total value by region. Total is defined as multiplication of product price and ordered quantity.",
+    "ex_country": "List of all the countries with total order value greater than 100000 dollars.",
+    "ex_average_order": "What is the average order value?",
+    "ex_common_product": "List the top 5 most ordered productnames.",
+}
+
+# Questions answered at server start, before anyone clicks them: their SQL is generated into the
+# prompt cache and their first result page fetched into the query cache, WARMUP_WORKERS at a time.
+WARMUP_QUESTIONS = list(st.secrets.get("WARMUP_QUESTIONS", EXAMPLE_QUESTIONS.values()))
+WARMUP_WORKERS = int(st.secrets.get("WARMUP_WORKERS", 4))
+
+def warm_up_query(sql):
+    import query_jobs
+    import warmup
+    # The first page a click on Run Query fetches, run on the warm-up thread instead of the query
+    # executor. Nobody has reviewed the generated SQL, so anything the pre-flight would block or ask
+    # to confirm is skipped, and the rest gets the same LIMIT a click adds, caching the same page.
+    decision, reason, sql = guard_query(sql)
+    if decision in ("block", "warn"):
+        raise warmup.WarmupSkipped(reason)
+    job = query_jobs.QueryJob(sql, QUERY_TIMEOUT_SECONDS)
+    if QUERY_BACKEND == "duckdb":
+        return run_sql_embedded(get_duckdb_backend(), get_query_cache(), sql, job)
+    return run_sql(get_connection_pool(), get_query_cache(), sql, job)
+
+@st.cache_resource(show_spinner=False)
+def start_warmup():
+    """Warm-up of WARMUP_QUESTIONS, started once per server process by its first login screen.
+
+    Runs on background threads, the page that starts it renders without waiting.
+    """
+    import warmup
+    # Both open local files only, the database connections are left to the warm-up threads
+    get_prompt_cache()
+    get_query_cache()
+    question_warmup = warmup.Warmup(WARMUP_QUESTIONS, question_sql, warm_up_query, WARMUP_WORKERS)
+    question_warmup.start()
+    return question_warmup
+
 
 # --- Button Handlers ---
 
@@ -195,53 +527,48 @@ def handle_generate_sql():
     prompt = st.session_state.user_input_key
     
     # Reset execution messages and results when a new generation starts
+    cancel_query_job()
     st.session_state.execution_message = None
     st.session_state.execution_error = None
     st.session_state.query_results_df = None
-
-    prompt_formatted = f"""You are a PostgreSQL expert. Given the following database schema and a user's question, generate a valid PostgreSQL query.
-
-    {DATABASE_SCHEMA}
-
-    User Question: {prompt}
-
-    Requirements:
-    1. Generate ONLY the SQL query, wrapped in ```sql``` code blocks
-    2. Use proper JOINs to get descriptive names from lookup tables
-    3. Use appropriate aggregations (COUNT, AVG, SUM, etc.) when needed
-    4. Add LIMIT clauses for queries that might return many rows (default LIMIT 100)
-    5. Use proper date/time functions for TIMESTAMP columns
-    6. Make sure the query is syntactically correct for PostgreSQL
-    7. Add helpful column aliases using AS
-
-    Generate the SQL query: """
+    st.session_state.query_results_page = None
+    st.session_state.query_confirmation = None
+    st.session_state.query_guard_note = None
 
     if prompt:
         with st.spinner('Generating SQL query...'):
-            result = generate_sql_query_llm(prompt_formatted)
-        
-        result_formatted = sql_extraction(result)
+            result_formatted, _ = question_sql(prompt)
         
         st.session_state.history.append({
             "prompt" : st.session_state.user_input_key,
             "sql" : result_formatted
         })
+        del st.session_state.history[:-HISTORY_MAX_ITEMS]
+        # Only the latest question has an editor, the edited SQL of older ones is not shown again.
+        # Trimming moves the latest index onto an older question's key, so they all go.
+        for key in [key for key in st.session_state.keys() if key.startswith("editable_sql_")]:
+            del st.session_state[key]
         
         st.session_state.user_input_key = ""
 
 def handle_clear_history():
+    cancel_query_job()
+    get_result_spill().drop(st.session_state.session_key)
     st.session_state.history = []
     st.session_state.user_input_key = ""
     st.session_state.execution_message = None
     st.session_state.execution_error = None
     st.session_state.query_results_df = None
+    st.session_state.query_results_page = None
+    st.session_state.query_confirmation = None
+    st.session_state.query_guard_note = None
 
 def load_example(example_text):
     """Loads an example question into the input area."""
     st.session_state.user_input_key = example_text
 
 
-def handle_run_query(latest_index):
+def handle_run_query(latest_index, confirmed=False):
     """Run the query against the database and displays results."""
     
     sql_to_execute = st.session_state.get(f'editable_sql_{latest_index}')
@@ -250,25 +577,207 @@ def handle_run_query(latest_index):
     st.session_state.execution_message = None
     st.session_state.execution_error = None
     st.session_state.query_results_df = None
+    st.session_state.query_results_page = None
+    st.session_state.query_confirmation = None
+    st.session_state.query_guard_note = None
     
     if not sql_to_execute:
         st.session_state.execution_error = "Cannot run an empty query."
         return
 
-    with st.spinner('Executing query against database...'):
-        time.sleep(2) # Simulate execution time
+    decision, reason, sql_to_execute = guard_query(sql_to_execute, confirmed)
+    if decision == "block":
+        st.session_state.execution_error = f"🛑 Query blocked: {reason}."
+        return
+    if decision == "warn" and not confirmed:
+        st.session_state.query_confirmation = {"index": latest_index, "reason": reason}
+        return
+    st.session_state.query_guard_note = reason
+
+    start_query_job(sql_to_execute, 0)
+
+def handle_change_page(offset):
+    """Fetches another page of the query whose results are on screen."""
+    page = st.session_state.query_results_page
+    start_query_job(page["sql"], offset)
+
+def start_query_job(sql, offset):
+    import query_jobs
+    cancel_query_job()
+    page_size = int(st.session_state.get('query_page_size', QUERY_PAGE_SIZE))
+    job = query_jobs.QueryJob(sql, st.session_state.get('query_timeout_seconds', QUERY_TIMEOUT_SECONDS))
+    submit_query(job, offset, page_size)
+    st.session_state.query_job = job
+
+def cancel_query_job():
+    """Sends a backend cancel for the query this session is running, if any."""
+    job = st.session_state.query_job
+    if job is not None and not job.done():
+        job.cancel()
+        get_query_log().record(job.sql, job.elapsed(), status="cancelled")
+        st.session_state.execution_message = None
+        st.session_state.execution_error = f"⏹️ Query cancelled after {job.elapsed():.1f}s."
+        st.session_state.query_job = None
+
+def collect_query_job():
+    """Moves the result of a finished background query into the session state."""
+    import psycopg2
+    import query_jobs
+    job = st.session_state.query_job
+    if job is None or not job.done():
+        return
+    st.session_state.query_job = None
+
+    try:
+        page = job.future.result()
+        results_df = page.pop("df")
         
-        try:
-            results_df = execute_sql(sql_to_execute)
-            
+        # Pages past RESULT_PREVIEW_ROWS are kept on disk, the session holds their first rows
+        if len(results_df) > RESULT_PREVIEW_ROWS:
+            get_result_spill().save(st.session_state.session_key, results_df)
+            preview_df = results_df.head(RESULT_PREVIEW_ROWS).copy()
+            preview_df.attrs["spilled_rows"] = len(results_df)
+            st.session_state.query_results_df = preview_df
+        else:
+            get_result_spill().drop(st.session_state.session_key)
             st.session_state.query_results_df = results_df
-            
-            st.session_state.execution_message = (
-                f"✅ Query returned {len(results_df)} rows successfully at {time.strftime('%H:%M:%S')}!"
+        st.session_state.query_results_page = {"sql": job.sql, "rows": len(results_df), **page}
+        if page["query_seconds"] is not None:
+            get_query_log().record(job.sql, page["query_seconds"], len(results_df), rollup=results_df.attrs.get("rollup"))
+        
+        total = f"{page['total']:,}" if page["total"] is not None else "an uncounted number of"
+        st.session_state.execution_message = (
+            f"✅ Query returned {total} rows successfully in {job.elapsed():.2f}s at {time.strftime('%H:%M:%S')}!"
+        )
+        if page["cache_age"] is not None:
+            st.session_state.execution_message += f" (cached result, {page['cache_age']:.0f}s old)"
+        if st.session_state.query_guard_note:
+            st.session_state.execution_message += f" Pre-flight: {st.session_state.query_guard_note}."
+        if results_df.attrs.get("rollup"):
+            speedup = results_df.attrs["speedup"]
+            st.session_state.execution_message += (
+                f" Answered from the {results_df.attrs['rollup']} rollup"
+                + (f", {speedup:.1f}x speedup over the base tables (measured)" if results_df.attrs["speedup_measured"] else
+                   f", {speedup:.1f}x speedup over the base tables (planner estimate)" if speedup else "")
+                + "."
             )
-            
-        except Exception as e:
-            st.session_state.execution_error = f"❌ Database Error: Could not execute query. {e}"
+        if results_df.attrs.get("truncated"):
+            st.session_state.execution_message += (
+                f" This page was cut at {len(results_df)} rows, its rows exceed the {QUERY_MAX_PAGE_BYTES // (1024 * 1024)} MB page limit."
+            )
+
+    except query_jobs.QueryCancelled:
+        st.session_state.execution_error = f"⏹️ Query cancelled after {job.elapsed():.1f}s."
+        get_query_log().record(job.sql, job.elapsed(), status="cancelled")
+    except query_jobs.QueryTimeout as e:
+        st.session_state.execution_error = (
+            f"⏱️ Query stopped after exceeding the {job.timeout_seconds:g}s statement timeout. {e}"
+        )
+        get_query_log().record(job.sql, job.elapsed(), status="timeout")
+    except psycopg2.errors.QueryCanceled as e:
+        if job.cancel_requested:
+            st.session_state.execution_error = f"⏹️ Query cancelled after {job.elapsed():.1f}s."
+            get_query_log().record(job.sql, job.elapsed(), status="cancelled")
+        else:
+            st.session_state.execution_error = (
+                f"⏱️ Query stopped after exceeding the {job.timeout_seconds:g}s statement timeout. {e}"
+            )
+            get_query_log().record(job.sql, job.elapsed(), status="timeout")
+    except Exception as e:
+        st.session_state.execution_error = f"❌ Database Error: Could not execute query. {e}"
+        get_query_log().record(job.sql, job.elapsed(), status="error")
+
+@st.fragment(run_every=0.5)
+def render_running_query():
+    """Elapsed time and Cancel button while a query runs, reruns the page once it finishes."""
+    job = st.session_state.query_job
+    if job is None:
+        return
+    if job.done():
+        st.rerun()
+
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        st.info(f"⏳ Executing query against database... {job.elapsed():.1f}s")
+    with col2:
+        st.button("Cancel", on_click=cancel_query_job, key="cancel_query")
+
+
+def render_plan_summary(sql):
+    """Planner estimate for the SQL in the editor and what the pre-flight check will do with it."""
+    import cost_guard
+    st.caption("**Query plan estimate**")
+    if not sql:
+        return
+    summary = preflight(sql)
+    if "error" in summary:
+        st.caption(f"Plan unavailable: {summary['error']}")
+        return
+    st.caption(cost_guard.describe(summary) + (f" · answered from {summary['rollup']}" if "rollup" in summary else ""))
+    decision, reason = cost_guard.check(summary, QUERY_WARN_COST, QUERY_BLOCK_COST, QUERY_MAX_ROWS)
+    if decision == "block":
+        st.caption(f"🛑 Will be blocked: {reason}")
+    elif decision == "warn":
+        st.caption(f"⚠️ Needs confirmation: {reason}")
+    elif decision == "limit":
+        st.caption(f"✂️ {reason[0].upper()}{reason[1:]}")
+
+def load_result_page():
+    """The result page on screen: the preview kept in session state, or the full page read back
+    from disk when the analyst asks for every row."""
+    results_df = st.session_state.query_results_df
+    spilled_rows = results_df.attrs.get("spilled_rows")
+    if not spilled_rows:
+        return results_df
+    if not st.toggle(f"Show all {spilled_rows:,} rows of this page (first {len(results_df):,} shown)", key="show_full_page"):
+        return results_df
+    full_df = get_result_spill().load(st.session_state.session_key)
+    if full_df is None:
+        st.caption("The full page was evicted from the disk cache, run the query again to see every row.")
+        return results_df
+    return full_df
+
+def render_page_controls():
+    """Previous/Next buttons and page size for the result on screen."""
+    page = st.session_state.query_results_page
+    if page is None:
+        return
+    first_row = page["offset"] + 1 if page["rows"] else 0
+    last_row = page["offset"] + page["rows"]
+    next_offset = page["offset"] + page["rows"]
+    has_next = page["rows"] > 0 and (page["total"] is None or next_offset < page["total"])
+
+    col1, col2, col3, col4 = st.columns([1, 1, 1, 4])
+    with col1:
+        st.button(
+            "◀ Previous",
+            on_click=handle_change_page,
+            args=[max(page["offset"] - page["page_size"], 0)],
+            disabled=page["offset"] == 0 or st.session_state.query_job is not None,
+            key="page_previous"
+        )
+    with col2:
+        st.button(
+            "Next ▶",
+            on_click=handle_change_page,
+            args=[next_offset],
+            disabled=not has_next or next_offset >= QUERY_MAX_ROWS or st.session_state.query_job is not None,
+            key="page_next"
+        )
+    with col3:
+        st.selectbox(
+            "Rows per page",
+            [100, 500, 1000, 5000],
+            index=[100, 500, 1000, 5000].index(page["page_size"]) if page["page_size"] in [100, 500, 1000, 5000] else 1,
+            key="query_page_size",
+            on_change=handle_change_page,
+            args=[page["offset"]],
+            label_visibility="collapsed"
+        )
+    with col4:
+        st.caption(f"Rows {first_row:,}–{last_row:,}" + (f" of {page['total']:,}" if page["total"] is not None else ""))
+        if has_next and next_offset >= QUERY_MAX_ROWS:
+            st.caption(f"Paging stops at {QUERY_MAX_ROWS:,} rows, add a WHERE or LIMIT to see the rest.")
 
 
 # --- Sidebar Content ---
@@ -291,29 +800,29 @@ def render_sidebar():
     
     st.sidebar.markdown("**Demographics:**")
     st.sidebar.button(
-        "Find the total value by region. Total is defined as multiplication of product price and ordered quantity.", 
-        on_click=load_example, 
-        args=["Find the total value by region. Total is defined as multiplication of product price and ordered quantity."], 
+        EXAMPLE_QUESTIONS["ex_region"],
+        on_click=load_example,
+        args=[EXAMPLE_QUESTIONS["ex_region"]],
         key="ex_region"
     )
     st.sidebar.button(
-        "List of all the countries with total order value greater than 100000 dollars.", 
-        on_click=load_example, 
-        args=["List of all the countries with total order value greater than 100000 dollars."], 
+        EXAMPLE_QUESTIONS["ex_country"],
+        on_click=load_example,
+        args=[EXAMPLE_QUESTIONS["ex_country"]],
         key="ex_country"
     )
 
     st.sidebar.markdown("**Statistics**")
     st.sidebar.button(
-        "What is the average order value?", 
-        on_click=load_example, 
-        args=["What is the average order value?"], 
+        EXAMPLE_QUESTIONS["ex_average_order"],
+        on_click=load_example,
+        args=[EXAMPLE_QUESTIONS["ex_average_order"]],
         key="ex_average_order"
     )
     st.sidebar.button(
-        "List the top 5 most ordered productnames.", 
-        on_click=load_example, 
-        args=["List the top 5 most ordered productnames."], 
+        EXAMPLE_QUESTIONS["ex_common_product"],
+        on_click=load_example,
+        args=[EXAMPLE_QUESTIONS["ex_common_product"]],
         key="ex_common_product"
     )
 
@@ -335,10 +844,88 @@ def render_sidebar():
 
     st.sidebar.markdown("---")
 
+    if QUERY_BACKEND == "duckdb":
+        with st.sidebar.expander("DuckDB backend"):
+            backend_metrics = get_duckdb_backend().metrics()
+            st.caption(f"{backend_metrics['path']} · {backend_metrics['bytes'] / 1e6:.1f} MB · "
+                       f"built {backend_metrics['built']}")
+    else:
+        with st.sidebar.expander("Connection pool"):
+            pool_metrics = get_connection_pool().metrics()
+            st.caption(
+                f"{pool_metrics['in_use']}/{pool_metrics['size']} in use · "
+                f"{pool_metrics['checkouts']} checkouts · "
+                f"wait avg {pool_metrics['wait_seconds_avg'] * 1000:.1f} ms, "
+                f"max {pool_metrics['wait_seconds_max'] * 1000:.1f} ms · "
+                f"{pool_metrics['reconnects']} reconnects · {pool_metrics['timeouts']} timeouts"
+            )
+
+    with st.sidebar.expander("Query cache"):
+        cache_metrics = get_query_cache().metrics()
+        st.caption(
+            f"{cache_metrics['entries']} results, "
+            f"{cache_metrics['bytes'] / 1e6:.1f}/{cache_metrics['max_bytes'] / 1e6:.0f} MB · "
+            f"{cache_metrics['hits']} hits, {cache_metrics['misses']} misses · "
+            f"{cache_metrics['evictions']} evictions · load generation {cache_metrics['generation']}"
+        )
+        st.button("Clear cache", on_click=get_query_cache().clear, key="clear_query_cache")
+
+    with st.sidebar.expander("SQL generation cache"):
+        prompt_metrics = get_prompt_cache().metrics()
+        st.caption(
+            f"{prompt_metrics['entries']} questions · {prompt_metrics['hits']} hits, "
+            f"{prompt_metrics['misses']} misses ({prompt_metrics['hit_rate']:.0%} hit rate) · "
+            f"{prompt_metrics['evictions']} evictions"
+        )
+        warmup_metrics = start_warmup().metrics()
+        if warmup_metrics["questions"]:
+            st.caption(
+                f"Warm-up: {warmup_metrics['ready']}/{warmup_metrics['questions']} questions ready"
+                + (f", {len(warmup_metrics['skipped'])} skipped by the pre-flight" if warmup_metrics["skipped"] else "")
+                + (f", {len(warmup_metrics['failed'])} failed" if warmup_metrics["failed"] else "")
+                + (" · running" if warmup_metrics["running"] else f" in {warmup_metrics['seconds']:.1f}s")
+            )
+        st.button("Clear cache", on_click=get_prompt_cache().clear, key="clear_prompt_cache")
+
+    # Filled in by render_memory_report once the rest of the page has updated the session state
+    memory_report = st.sidebar.container()
+
     if st.sidebar.button('Logout'):
         st.session_state.logged_in = False
         st.rerun()
 
+    return memory_report
+
+def render_memory_report(container):
+    """Memory held by this session's state, by all sessions, and by this server process in total."""
+    import result_pages
+    import session_memory
+    sizes = session_memory.state_sizes(st.session_state)
+    session_bytes = sum(sizes.values())
+    get_session_memory().update(st.session_state.session_key, session_bytes)
+    all_sessions = get_session_memory().metrics()
+
+    with container.expander("Session memory"):
+        st.caption(f"This session: {session_bytes / 1e3:,.0f} KB · "
+                   + ", ".join(f"{key} {size / 1e3:,.0f} KB" for key, size in list(sizes.items())[:3]))
+        results_df = st.session_state.query_results_df
+        if results_df is not None and results_df.attrs.get("spilled_rows"):
+            st.caption(f"Result preview: {result_pages.frame_bytes(results_df) / 1e3:,.0f} KB for "
+                       f"{len(results_df):,} rows, the full {results_df.attrs['spilled_rows']:,} row page is on disk")
+        elif results_df is not None and "raw_bytes" in results_df.attrs:
+            st.caption(f"Result page: {result_pages.frame_bytes(results_df) / 1e3:,.0f} KB, "
+                       f"{results_df.attrs['raw_bytes'] / 1e3:,.0f} KB before compaction")
+        st.caption(f"All sessions: {all_sessions['sessions']} active · {all_sessions['bytes'] / 1e3:,.0f} KB · "
+                   f"largest {all_sessions['max_bytes'] / 1e3:,.0f} KB")
+
+        # Everything this server process holds for its sessions: their state, the shared result
+        # cache, and the pages spilled to disk
+        cache_bytes = get_query_cache().metrics()["bytes"]
+        spill_metrics = get_result_spill().metrics()
+        st.caption(f"Server process: {(all_sessions['bytes'] + cache_bytes) / 1e6:.1f} MB in memory "
+                   f"({all_sessions['bytes'] / 1e6:.1f} MB sessions, {cache_bytes / 1e6:.1f} MB query cache) · "
+                   f"{spill_metrics['bytes'] / 1e6:.1f} MB on disk in {spill_metrics['files']} spilled pages")
+
 
 # --- Main Application Logic ---
 
@@ -347,7 +934,7 @@ def main():
     require_login()
     
     # 1. Render the sidebar
-    render_sidebar()
+    memory_report = render_sidebar()
     
     # 2. Main Title
     st.markdown(
@@ -421,22 +1008,48 @@ def main():
         if sql_key not in st.session_state or st.session_state[sql_key] == "": 
             st.session_state[sql_key] = latest_item["sql"]
             
-        st.text_area(
-            label="SQL Query", 
-            value=st.session_state[sql_key], 
-            height=150, 
-            key=sql_key,
-            label_visibility="collapsed"
-        )
+        editor_col, plan_col = st.columns([3, 1])
+        with editor_col:
+            st.text_area(
+                label="SQL Query", 
+                value=st.session_state[sql_key], 
+                height=150, 
+                key=sql_key,
+                label_visibility="collapsed"
+            )
+        with plan_col:
+            render_plan_summary(st.session_state[sql_key])
+
+        # Confirmation for a query the pre-flight check flagged
+        confirmation = st.session_state.query_confirmation
+        if confirmation is not None and confirmation["index"] == latest_index:
+            st.warning(f"⚠️ {confirmation['reason'][0].upper()}{confirmation['reason'][1:]}. Run it anyway?")
+            st.button("Run anyway", on_click=handle_run_query, args=[latest_index, True], key=f"confirm_btn_{latest_index}")
         
-        # Run Query Button
-        st.button(
-            "Run Query", 
-            on_click=handle_run_query, 
-            args=[latest_index], 
-            key=f"run_btn_{latest_index}", 
-            type="primary"
-        )
+        # Run Query Button and the server side timeout it runs under
+        collect_query_job()
+        col1, col2, _ = st.columns([1, 1, 5])
+        with col1:
+            st.button(
+                "Run Query", 
+                on_click=handle_run_query, 
+                args=[latest_index], 
+                key=f"run_btn_{latest_index}", 
+                type="primary",
+                disabled=st.session_state.query_job is not None
+            )
+        with col2:
+            st.number_input(
+                "Timeout (s)",
+                min_value=1.0,
+                value=QUERY_TIMEOUT_SECONDS,
+                step=5.0,
+                key="query_timeout_seconds",
+                label_visibility="collapsed",
+                help="statement_timeout for this query, in seconds"
+            )
+
+        render_running_query()
         
         # 6. Query Results Section
         if st.session_state.get('execution_message') or st.session_state.get('execution_error'):
@@ -452,9 +1065,10 @@ def main():
                     # Display success message
                     st.success(st.session_state.execution_message)
                     
-                    # Display the simulated DataFrame result
+                    # Display the current page of the result
                     if st.session_state.query_results_df is not None:
-                        st.dataframe(st.session_state.query_results_df, use_container_width=True)
+                        st.dataframe(load_result_page(), use_container_width=True)
+                        render_page_controls()
                 
             if st.session_state.get('execution_error'):
                 with results_container:
@@ -477,6 +1091,8 @@ def main():
     else:
         st.info("Ask your first natural language question above to generate an SQL query!")
 
+    render_memory_report(memory_report)
+
 # Run the app
 if __name__ == "__main__":
     main()
\ No newline at end of file
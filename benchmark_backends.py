@@ -0,0 +1,91 @@
+import argparse
+import datetime
+import json
+import os
+import statistics
+import time
+
+import duckdb_backend
+import rollups
+
+# The sidebar example questions, answered by the first verification queries of rollups.py
+SIDEBAR_QUESTIONS = [
+    "Find the total value by region. Total is defined as multiplication of product price and ordered quantity.",
+    "List of all the countries with total order value greater than 100000 dollars.",
+    "What is the average order value?",
+    "List the top 5 most ordered productnames.",
+]
+
+
+## -- Measurements -- ##
+
+def timed_rows(cur, sql, repeats):
+    # Rows of sql, the column names, and the median wall time of executing and fetching it
+    timings = []
+    for _ in range(repeats):
+        query_start = time.perf_counter()
+        cur.execute(sql)
+        rows = cur.fetchall()
+        timings.append(time.perf_counter() - query_start)
+    return rows, [column[0] for column in cur.description], statistics.median(timings)
+
+def same_answer(postgres_result, duckdb_result):
+    # Postgres multiplies the REAL prices in single precision, the DuckDB file holds them as DOUBLE
+    import pandas as pd
+    frames = [pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+              for rows, columns, _ in (postgres_result, duckdb_result)]
+    return rollups.frames_match(*frames, rel_tol=1e-5)
+
+def measure_question(question, sql, pg_cur, backend, repeats):
+    postgres_result = timed_rows(pg_cur, sql, repeats)
+    pg_cur.connection.rollback()
+    with backend.cursor() as (cur, _):
+        duckdb_result = timed_rows(cur, sql, repeats)
+    return {
+        "question": question,
+        "rows": len(postgres_result[0]),
+        "postgres_seconds": round(postgres_result[2], 5),
+        "duckdb_seconds": round(duckdb_result[2], 5),
+        "same_answer": same_answer(postgres_result, duckdb_result),
+    }
+
+def print_results(results):
+    print(f"{'question':<50} {'rows':>5} {'postgres ms':>12} {'duckdb ms':>10} {'speedup':>8} {'same':>5}")
+    for result in results:
+        print(f"{result['question'][:50]:<50} {result['rows']:>5} {result['postgres_seconds'] * 1000:>12.2f} "
+              f"{result['duckdb_seconds'] * 1000:>10.2f} {result['postgres_seconds'] / result['duckdb_seconds']:>7.1f}x "
+              f"{'yes' if result['same_answer'] else 'NO':>5}")
+
+
+if __name__ == "__main__":
+    import psycopg2
+    import populate_database
+
+    parser = argparse.ArgumentParser(description="Time the sidebar example questions on Postgres and on the DuckDB backend")
+    parser.add_argument("--duckdb-path", default="sales.duckdb")
+    parser.add_argument("--build", action="store_true", help="rebuild the DuckDB file from Postgres first")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per query, the median is reported")
+    parser.add_argument("--output", default="benchmark_backends.json")
+    args = parser.parse_args()
+
+    if args.build or not os.path.exists(args.duckdb_path):
+        duckdb_backend.build(args.duckdb_path, database_url=populate_database.DATABASE_URL)
+    backend = duckdb_backend.DuckDBBackend(args.duckdb_path)
+
+    pg_conn = psycopg2.connect(populate_database.DATABASE_URL)
+    with pg_conn.cursor() as pg_cur:
+        results = [measure_question(question, sql, pg_cur, backend, args.repeats)
+                   for question, sql in zip(SIDEBAR_QUESTIONS, rollups.verification_queries)]
+    pg_conn.close()
+    print_results(results)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "postgres": populate_database.DATABASE_URL.rsplit("@", 1)[-1],
+            "duckdb_path": args.duckdb_path,
+            "results": results,
+        }, f, indent=2)
+    print(f"results written to {args.output}")
+    if not all(result["same_answer"] for result in results):
+        raise SystemExit(1)
@@ -0,0 +1,273 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import populate_database as loader
+
+
+## -- Synthetic data -- ##
+
+def parse_size(size):
+    # "10k" -> 10000, "1M" -> 1000000
+    multipliers = {"k": 1000, "m": 1000000}
+    suffix = size[-1].lower()
+    if suffix in multipliers:
+        return int(float(size[:-1]) * multipliers[suffix])
+    return int(size)
+
+def generate_data_file(data_filename, lines, customers=10000, products=500, categories=20, countries=50,
+                       regions=6, max_items=4, seed=0):
+    # Inputs: Output path, number of data rows and the cardinality of every dimension
+    # Output: None. Writes a tab separated file with ';' separated order columns, the format
+    #         read_data_rows and the step functions parse.
+
+    rng = random.Random(seed)
+    region_names = [f"Region {i}" for i in range(regions)]
+    country_rows = [(f"Country {i}", region_names[i % regions]) for i in range(countries)]
+    category_rows = [(f"Category {i}", f"Description of category {i}") for i in range(categories)]
+    product_rows = [(f"Product {i}", f"{rng.uniform(1, 500):.2f}", category_rows[i % categories]) for i in range(products)]
+    customer_rows = []
+    for i in range(customers):
+        country, region = country_rows[rng.randrange(countries)]
+        customer_rows.append((f"First{i} Last{i}", f"{i} Market Street", f"City {i % 997}", country, region))
+
+    start_date = datetime.date(2015, 1, 1)
+    with open(data_filename, 'w') as f:
+        f.write("Name\tAddress\tCity\tCountry\tRegion\tProductName\tProductCategory\t"
+                "ProductCategoryDescription\tProductUnitPrice\tQuantityOrdered\tOrderDate\n")
+        for _ in range(lines):
+            customer = customer_rows[rng.randrange(customers)]
+            items = [product_rows[rng.randrange(products)] for _ in range(rng.randint(1, max_items))]
+            f.write("\t".join([
+                *customer,
+                ";".join(item[0] for item in items),
+                ";".join(item[2][0] for item in items),
+                ";".join(item[2][1] for item in items),
+                ";".join(item[1] for item in items),
+                ";".join(str(rng.randint(1, 20)) for _ in items),
+                ";".join((start_date + datetime.timedelta(days=rng.randrange(3650))).strftime('%Y%m%d') for _ in items),
+            ]) + "\n")
+
+
+## -- Measurements -- ##
+
+def reset_peak_rss():
+    # Linux resets the process's peak RSS (VmHWM) when 5 is written to clear_refs. Returns whether it did.
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_kb():
+    # Peak RSS since the last reset_peak_rss(), the process lifetime peak where it cannot be reset
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def table_row_count(conn_norm, table_name):
+    cur = conn_norm.cursor()
+    cur.execute(f"SELECT count(*) FROM {table_name}")
+    row_count = cur.fetchone()[0]
+    cur.close()
+    return row_count
+
+def measure_step(results, step_name, run_step, count_rows, trace_memory=False):
+    # Runs one step and appends its wall time, rows/sec and peak memory to results. peak_rss_kb is
+    # the step's own peak, None where the peak cannot be reset; peak_rss_growth_kb is how far the
+    # step raised the peak it started with.
+
+    peak_resettable = reset_peak_rss()
+    start_peak = peak_rss_kb()
+    if trace_memory:
+        tracemalloc.start()
+    step_start = time.perf_counter()
+    run_step()
+    seconds = time.perf_counter() - step_start
+    step_peak = peak_rss_kb()
+    traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    rows = count_rows()
+    results.append({
+        "step": step_name,
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds, 1) if seconds else None,
+        "peak_rss_kb": step_peak if peak_resettable else None,
+        "peak_rss_growth_kb": max(step_peak - start_peak, 0),
+        "peak_traced_kb": traced_peak // 1024 if traced_peak is not None else None,
+    })
+    print(f"  {step_name}: {seconds:.3f}s, {rows} rows")
+
+def benchmark_mode(data_filename, line_count, mode, workers, trace_memory=False):
+    # Inputs: Data file, its number of rows, loader mode and worker count for the parallel mode
+    # Output: List of per-step measurements
+
+    normalized_database = loader.normalized_database
+    conn_norm = loader.create_connection(normalized_database)
+    results = []
+
+    if mode == "elt":
+        measure_step(results, "elt_load", lambda: loader.elt_load(data_filename, normalized_database, conn_norm),
+                     lambda: table_row_count(conn_norm, "OrderDetail"), trace_memory)
+        conn_norm.close()
+        return results
+
+    bulk = mode == "bulk"
+    engine = "columnar" if mode == "columnar" else "rows"
+    step_workers = workers if mode == "parallel" else 1
+    dimension_data = {}
+
+    measure_step(results, "extract_dimension_data",
+                 lambda: dimension_data.update(loader.extract_dimension_data(data_filename)),
+                 lambda: line_count, trace_memory)
+
+    steps = [
+        ("step1_create_region_table", loader.step1_create_region_table, "Region"),
+        ("step3_create_country_table", loader.step3_create_country_table, "Country"),
+        ("step5_create_customer_table", loader.step5_create_customer_table, "Customer"),
+        ("step7_create_productcategory_table", loader.step7_create_productcategory_table, "ProductCategory"),
+        ("step9_create_product_table", loader.step9_create_product_table, "Product"),
+    ]
+    for step_name, step_function, table_name in steps:
+        def run_step(step_function=step_function):
+            with loader.loader_step(conn_norm, step_name, []):
+                step_function(data_filename, normalized_database, dimension_data, bulk=bulk, conn_norm=conn_norm)
+        measure_step(results, step_name, run_step, lambda table_name=table_name: table_row_count(conn_norm, table_name),
+                     trace_memory)
+
+    def run_orderdetail():
+        with loader.loader_step(conn_norm, "step11_create_orderdetail_table", []):
+            loader.step11_create_orderdetail_table(data_filename, normalized_database, bulk=bulk, workers=step_workers,
+                                                   conn_norm=conn_norm, engine=engine)
+    measure_step(results, "step11_create_orderdetail_table", run_orderdetail,
+                 lambda: table_row_count(conn_norm, "OrderDetail"), trace_memory)
+
+    conn_norm.close()
+    return results
+
+
+def benchmark_mode_subprocess(data_filename, line_count, mode, workers, trace_memory, database_url):
+    # benchmark_mode in a fresh interpreter, so no mode inherits the memory an earlier one left behind
+    with tempfile.TemporaryDirectory() as directory:
+        steps_path = os.path.join(directory, "steps.json")
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--run-mode", mode, "--data-file", data_filename,
+                        "--lines", str(line_count), "--workers", str(workers), "--database-url", database_url,
+                        "--output", steps_path] + (["--trace-memory"] if trace_memory else []), check=True)
+        with open(steps_path) as f:
+            return json.load(f)
+
+
+## -- Regression check -- ##
+
+def compare_results(baseline_runs, runs, threshold):
+    # Prints every step that got more than threshold (a fraction) slower than in the baseline file.
+    # Output: Number of regressions found
+
+    baseline = {(run["lines"], run["mode"], step["step"]): step["seconds"]
+                for run in baseline_runs for step in run["steps"]}
+    regressions = 0
+    for run in runs:
+        for step in run["steps"]:
+            previous = baseline.get((run["lines"], run["mode"], step["step"]))
+            if previous and step["seconds"] > previous * (1 + threshold):
+                regressions += 1
+                print(f"REGRESSION {run['mode']} {run['lines']} lines {step['step']}: "
+                      f"{previous:.3f}s -> {step['seconds']:.3f}s")
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark populate_database.py on synthetic data files")
+    parser.add_argument("--sizes", default="10k", help="comma separated row counts, e.g. 10k,1M,10M")
+    parser.add_argument("--modes", default="rows,bulk,columnar,parallel,elt",
+                        help="comma separated loader modes: rows, bulk, columnar, parallel, elt")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes for the parallel mode")
+    parser.add_argument("--customers", type=int, default=10000)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--countries", type=int, default=50)
+    parser.add_argument("--regions", type=int, default=6)
+    parser.add_argument("--max-items", type=int, default=4, help="most order lines per data row")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default="benchmark_data", help="where generated data files are kept and reused")
+    parser.add_argument("--database-url", required=True,
+                        help="Postgres to load into; every mode drops and recreates the normalized tables there")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also record the peak Python allocation of each step with tracemalloc (slower)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="earlier results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown fraction reported as a regression")
+    # Used by benchmark_mode_subprocess to run a single mode
+    parser.add_argument("--run-mode", help=argparse.SUPPRESS)
+    parser.add_argument("--data-file", help=argparse.SUPPRESS)
+    parser.add_argument("--lines", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    loader.DATABASE_URL = args.database_url
+    if args.run_mode:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_mode(args.data_file, args.lines, args.run_mode, args.workers, args.trace_memory), f)
+        raise SystemExit(0)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    runs = []
+    for size in args.sizes.split(","):
+        lines = parse_size(size)
+        data_filename = os.path.join(args.data_dir, f"data_{lines}_{args.customers}_{args.products}_{args.categories}_"
+                                                    f"{args.countries}_{args.regions}_{args.max_items}_{args.seed}.csv")
+        if not os.path.exists(data_filename):
+            print(f"generating {data_filename}")
+            generate_data_file(data_filename, lines, args.customers, args.products, args.categories, args.countries,
+                               args.regions, args.max_items, args.seed)
+
+        for mode in args.modes.split(","):
+            print(f"{mode}, {lines} lines")
+            runs.append({
+                "lines": lines,
+                "mode": mode,
+                "workers": args.workers if mode == "parallel" else 1,
+                "file_bytes": os.path.getsize(data_filename),
+                "steps": benchmark_mode_subprocess(data_filename, lines, mode, args.workers, args.trace_memory,
+                                                   args.database_url),
+            })
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "revision": git_revision(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "cardinalities": {"customers": args.customers, "products": args.products, "categories": args.categories,
+                              "countries": args.countries, "regions": args.regions, "max_items": args.max_items},
+            "runs": runs,
+        }, f, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f)["runs"], runs, args.threshold)
+        if regressions:
+            raise SystemExit(1)
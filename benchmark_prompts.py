@@ -0,0 +1,98 @@
+import argparse
+import datetime
+import json
+import os
+import statistics
+import time
+
+import schema_context
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Fixed question set: the sidebar examples plus questions touching every table
+QUESTIONS = [
+    "Find the total value by region. Total is defined as multiplication of product price and ordered quantity.",
+    "List of all the countries with total order value greater than 100000 dollars.",
+    "What is the average order value?",
+    "List the top 5 most ordered productnames.",
+    "How many customers live in each city?",
+    "Which product categories sell best in Europe?",
+    "Show the monthly order quantity for 2019.",
+    "Which customers spent the most, with their country?",
+]
+
+
+## -- Measurements -- ##
+
+def prompt_tokens(client, model, prompt):
+    # Token count from the Gemini API when a client is given, otherwise the usual 4 characters per token estimate
+    if client is None:
+        return round(len(prompt) / 4)
+    return client.models.count_tokens(model=model, contents=prompt).total_tokens
+
+def generation_seconds(client, model, prompt, repeats):
+    # Median wall time of generate_content over repeats calls
+    timings = []
+    for _ in range(repeats):
+        call_start = time.perf_counter()
+        client.models.generate_content(model=model, contents=prompt)
+        timings.append(time.perf_counter() - call_start)
+    return statistics.median(timings)
+
+def measure_question(question, client, model, repeats, value_terms):
+    result = {"question": question,
+              "tables": schema_context.relevant_tables(question, schema_context.SCHEMA_TABLES, value_terms)}
+    for variant, prune_schema in (("full", False), ("pruned", True)):
+        prompt = schema_context.build_prompt(question, prune_schema, value_terms)
+        result[variant] = {"chars": len(prompt), "tokens": prompt_tokens(client, model, prompt)}
+        if client is not None and repeats:
+            result[variant]["seconds"] = round(generation_seconds(client, model, prompt, repeats), 3)
+    return result
+
+def print_results(results):
+    print(f"{'question':<50} {'tables':>6} {'full tok':>9} {'pruned tok':>11} {'saved':>6} {'full s':>7} {'pruned s':>9}")
+    for result in results:
+        full, pruned = result["full"], result["pruned"]
+        print(f"{result['question'][:50]:<50} {len(result['tables']):>6} {full['tokens']:>9} {pruned['tokens']:>11} "
+              f"{1 - pruned['tokens'] / full['tokens']:>6.0%} {full.get('seconds', float('nan')):>7.2f} "
+              f"{pruned.get('seconds', float('nan')):>9.2f}")
+    full_tokens = sum(result["full"]["tokens"] for result in results)
+    pruned_tokens = sum(result["pruned"]["tokens"] for result in results)
+    print(f"total prompt tokens: {full_tokens} full, {pruned_tokens} pruned ({1 - pruned_tokens / full_tokens:.0%} fewer)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure prompt size and generation latency with and without schema pruning")
+    parser.add_argument("--model", default="gemini-2.0-flash-lite")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="generation calls per prompt for the latency median, 0 to only count tokens")
+    parser.add_argument("--offline", action="store_true",
+                        help="estimate tokens from the prompt length and skip the API, also used when GEMINI_KEY is unset")
+    parser.add_argument("--database-url", help="Postgres to read region, country and category names from")
+    parser.add_argument("--output", default="benchmark_prompts.json")
+    args = parser.parse_args()
+
+    client = None
+    if not args.offline and os.environ.get("GEMINI_KEY"):
+        from google import genai
+        client = genai.Client(api_key=os.environ["GEMINI_KEY"])
+
+    value_terms = None
+    if args.database_url:
+        import psycopg2
+        conn = psycopg2.connect(args.database_url)
+        value_terms = schema_context.load_value_terms(conn)
+        conn.close()
+
+    results = [measure_question(question, client, args.model, args.repeats, value_terms) for question in QUESTIONS]
+    print_results(results)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "model": args.model,
+            "tokens_counted_by": "api" if client is not None else "estimate",
+            "results": results,
+        }, f, indent=2)
+    print(f"results written to {args.output}")
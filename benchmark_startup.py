@@ -0,0 +1,139 @@
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Cold start of app1.py: every run is a fresh interpreter rendering the first page through
+# Streamlit's AppTest, the way a new container serves its first visitor. Fails when the median
+# first paint is over budget or the login screen pulls in a module only later pages need.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app1.py")
+
+# Loaded on first use: the login screen must render without them. The app's own query_cache,
+# prompt_cache, schema_context and warmup are not listed, the login screen starts the warm-up.
+LAZY_MODULES = ["google.genai", "pandas", "pyarrow", "psycopg2", "db_pool", "query_jobs", "result_pages",
+                "rollups", "cost_guard", "query_log", "session_memory", "duckdb_backend"]
+
+# Enough for the login screen, which reads these secrets but does not connect anywhere
+PLACEHOLDER_SECRETS = {
+    "HASHED_PASSWORD": "$2b$12$placeholderplaceholderplaceholderplaceholderplaceholde",
+    "DATABASE_USERNAME": "user",
+    "DATABASE_PASSWORD": "password",
+    "DATABASE_SERVER": "localhost",
+    "DATABASE_NAME": "sales",
+    "GEMINI_KEY": "key",
+}
+
+# The result goes to a file: the warm-up threads the first page starts print to stdout meanwhile.
+# Lazy modules are recorded with the thread that imported them, the warm-up's own imports do not
+# count against the page.
+COLD_START = """
+import json, sys, threading, time
+lazy_modules = json.loads(sys.argv[4])
+imported_by = {}
+class ImportRecorder:
+    def find_spec(self, name, path=None, target=None):
+        if name in lazy_modules:
+            imported_by.setdefault(name, threading.current_thread().name)
+        return None
+sys.meta_path.insert(0, ImportRecorder())
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.secrets.update(json.loads(sys.argv[2]))
+if sys.argv[3] == "1":
+    at.session_state.logged_in = True
+at.run()
+painted = time.perf_counter()
+with open(sys.argv[5], "w") as f:
+    json.dump({
+        "import_seconds": imported - started,
+        "first_paint_seconds": painted - imported,
+        "exceptions": [exception.value for exception in at.exception],
+        "modules": [name for name, thread in imported_by.items() if not thread.startswith("warmup")],
+        "warmup_modules": [name for name, thread in imported_by.items() if thread.startswith("warmup")],
+    }, f)
+"""
+
+
+## -- Measurements -- ##
+
+def load_secrets(path):
+    # Real secrets for --logged-in runs, placeholders otherwise
+    if path is None:
+        return PLACEHOLDER_SECRETS
+    import tomllib
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+def cold_start(secrets, logged_in):
+    """One fresh interpreter rendering the first page: its import and first paint times, the
+    process wall time, and which of LAZY_MODULES it loaded."""
+    with tempfile.TemporaryDirectory() as directory:
+        result_path = os.path.join(directory, "cold_start.json")
+        process_start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-c", COLD_START, APP_PATH, json.dumps(secrets), "1" if logged_in else "0",
+             json.dumps(LAZY_MODULES), result_path],
+            capture_output=True, text=True, cwd=os.path.dirname(APP_PATH),
+        )
+        wall_seconds = time.perf_counter() - process_start
+        if completed.returncode != 0:
+            raise RuntimeError(f"cold start failed:\n{completed.stderr}")
+        with open(result_path) as f:
+            return {**json.load(f), "wall_seconds": wall_seconds}
+
+def summarize(runs):
+    return {
+        key: round(statistics.median(run[key] for run in runs), 3)
+        for key in ("import_seconds", "first_paint_seconds", "wall_seconds")
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cold start of the Streamlit app against a budget")
+    parser.add_argument("--repeats", type=int, default=5, help="cold starts measured, the median is reported")
+    parser.add_argument("--budget-seconds", type=float, default=1.0,
+                        help="largest allowed median first paint, the app's own start up after Streamlit is loaded")
+    parser.add_argument("--logged-in", action="store_true",
+                        help="measure the main page instead of the login screen, needs --secrets with a reachable database")
+    parser.add_argument("--secrets", help="secrets.toml to run with, placeholders are used for the login screen")
+    parser.add_argument("--output", default="benchmark_startup.json")
+    args = parser.parse_args()
+
+    secrets = load_secrets(args.secrets)
+    runs = [cold_start(secrets, args.logged_in) for _ in range(args.repeats)]
+    summary = summarize(runs)
+    page = "main page" if args.logged_in else "login screen"
+    print(f"{page}: streamlit import {summary['import_seconds']:.3f}s, first paint {summary['first_paint_seconds']:.3f}s, "
+          f"process {summary['wall_seconds']:.3f}s (median of {len(runs)})")
+
+    failures = []
+    if runs[0]["exceptions"]:
+        failures.append(f"the {page} raised: {runs[0]['exceptions']}")
+    if summary["first_paint_seconds"] > args.budget_seconds:
+        failures.append(f"first paint {summary['first_paint_seconds']:.3f}s is over the {args.budget_seconds:.3f}s budget")
+    if not args.logged_in and runs[0]["modules"]:
+        failures.append(f"the login screen imported {', '.join(runs[0]['modules'])}")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "page": page,
+            "budget_seconds": args.budget_seconds,
+            "summary": summary,
+            "runs": runs,
+            "failures": failures,
+        }, f, indent=2)
+    print(f"results written to {args.output}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        raise SystemExit(1)
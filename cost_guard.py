@@ -0,0 +1,141 @@
+import re
+
+# Pre-flight check of generated SQL: the planner's estimates from EXPLAIN (never ANALYZE, nothing runs)
+# decide whether a query runs as is, runs after a confirmation, runs with a LIMIT added, or is blocked.
+
+SCAN_NODES = {"Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Heap Scan"}
+
+DOLLAR_QUOTE = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$")
+
+def literal_end(sql, i):
+    # Index just past the quoted string or identifier starting at sql[i], None when none starts there.
+    # Knows '...' and "..." (a doubled quote reads as two adjacent literals), E'...' with backslash
+    # escapes and $tag$...$tag$. One left open runs to the end of sql.
+    char = sql[i]
+    if char in "'\"":
+        end = sql.find(char, i + 1)
+        return len(sql) if end == -1 else end + 1
+    # E and $ only open a literal where they do not continue a name (rate$, some_e) or a $1 parameter
+    if i and (sql[i - 1].isalnum() or sql[i - 1] in "_$"):
+        return None
+    if char in "eE" and sql.startswith("'", i + 1):
+        j = i + 2
+        while j < len(sql):
+            if sql[j] == "\\":
+                j += 2
+            elif sql.startswith("''", j):
+                j += 2
+            elif sql[j] == "'":
+                return j + 1
+            else:
+                j += 1
+        return len(sql)
+    match = DOLLAR_QUOTE.match(sql, i) if char == "$" else None
+    if match:
+        end = sql.find(match.group(), match.end())
+        return len(sql) if end == -1 else end + len(match.group())
+    return None
+
+def statements(sql):
+    # Statements in sql, split on semicolons outside literals and comments. Comments become a space,
+    # literals are copied whole so '--', '/*' or ';' inside one is not taken for syntax.
+    parts, current = [], []
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        end = literal_end(sql, i)
+        if end is not None:
+            current.append(sql[i:end])
+            i = end
+            continue
+        if sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end
+            current.append(" ")
+            continue
+        if sql.startswith("/*", i):
+            # Postgres block comments nest
+            depth, i = 1, i + 2
+            while i < len(sql) and depth:
+                if sql.startswith("/*", i):
+                    depth, i = depth + 1, i + 2
+                elif sql.startswith("*/", i):
+                    depth, i = depth - 1, i + 2
+                else:
+                    i += 1
+            current.append(" ")
+            continue
+        if char == ";":
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    parts.append("".join(current))
+    return [part.strip() for part in parts if part.strip()]
+
+def explain(conn, sql, timeout_ms=5000):
+    """The planner's JSON plan for sql. Runs EXPLAIN only, under a short statement_timeout."""
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+        cur.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+        plan = cur.fetchone()[0][0]["Plan"]
+    conn.rollback()
+    return plan
+
+def walk(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk(child)
+
+def is_cartesian(node):
+    # A nested loop joining without any join condition: every outer row meets every inner row.
+    # Crossing with a single row (a grand total subquery, say) is left alone.
+    if node["Node Type"] != "Nested Loop" or "Join Filter" in node or len(node.get("Plans", [])) != 2:
+        return False
+    outer, inner = node["Plans"]
+    if outer["Plan Rows"] <= 1 or inner["Plan Rows"] <= 1:
+        return False
+    return not any("Index Cond" in child or "Recheck Cond" in child for child in walk(inner))
+
+def plan_summary(plan):
+    """Estimated cost, rows and the notable nodes of a plan, as shown next to the SQL editor."""
+    nodes = list(walk(plan))
+    return {
+        "total_cost": plan["Total Cost"],
+        "plan_rows": plan["Plan Rows"],
+        "width": plan["Plan Width"],
+        "top_node": plan["Node Type"],
+        "has_limit": plan["Node Type"] == "Limit",
+        "seq_scans": sorted({node["Relation Name"] for node in nodes
+                             if node["Node Type"] == "Seq Scan" and "Relation Name" in node}),
+        "cartesian_joins": sum(is_cartesian(node) for node in nodes),
+    }
+
+def needs_limit(summary, limit_rows):
+    return summary["plan_rows"] > limit_rows and not summary["has_limit"]
+
+def check(summary, warn_cost, block_cost, limit_rows):
+    """Decision for a plan summary: ("ok" | "warn" | "limit" | "block", reason)."""
+    if summary["total_cost"] >= block_cost:
+        return "block", (f"estimated cost {summary['total_cost']:,.0f} is above the {block_cost:,.0f} limit"
+                         + (", the plan joins tables without a join condition" if summary["cartesian_joins"] else ""))
+    if summary["cartesian_joins"]:
+        return "warn", "the plan joins tables without a join condition (cartesian product)"
+    if summary["total_cost"] >= warn_cost:
+        return "warn", f"estimated cost {summary['total_cost']:,.0f} is above the {warn_cost:,.0f} warning threshold"
+    if needs_limit(summary, limit_rows):
+        return "limit", f"about {summary['plan_rows']:,.0f} rows estimated, LIMIT {limit_rows:,} added"
+    return "ok", None
+
+def add_limit(sql, limit_rows):
+    return f"SELECT * FROM ({statements(sql)[0]}) AS limited LIMIT {int(limit_rows)}"
+
+def describe(summary):
+    # One line plan summary: "cost 1,234 · ~5 rows · Hash Join · seq scans: orderdetail"
+    text = f"cost {summary['total_cost']:,.0f} · ~{summary['plan_rows']:,.0f} rows · {summary['top_node']}"
+    if summary["seq_scans"]:
+        text += f" · seq scans: {', '.join(summary['seq_scans'])}"
+    if summary["cartesian_joins"]:
+        text += f" · {summary['cartesian_joins']} join(s) without a condition"
+    return text
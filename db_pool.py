@@ -0,0 +1,134 @@
+import contextlib
+import threading
+import time
+
+import psycopg2
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Process-wide pool of Postgres connections shared by every Streamlit session.
+
+    Up to maxconn connections are opened on demand and kept open between queries.
+    Checkouts wait for a free connection instead of failing when the pool is exhausted.
+    Connections that sat idle are pinged before being handed out and broken ones are
+    replaced, so a restarted database or a dropped socket costs one reconnect, not an error.
+    """
+
+    def __init__(self, database_url, minconn=1, maxconn=5, checkout_timeout=30, health_check_after=60):
+        self.database_url = database_url
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.last_used = {}
+        self.stats = {
+            "connections": 0,
+            "checkouts": 0,
+            "in_use": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "timeouts": 0,
+            "reconnects": 0,
+        }
+        for _ in range(min(minconn, maxconn)):
+            self.idle.append(self.connect())
+
+    def connect(self):
+        conn = psycopg2.connect(self.database_url)
+        with self.lock:
+            self.stats["connections"] += 1
+        return conn
+
+    def is_healthy(self, conn):
+        """Cheap liveness check, only pings connections idle for longer than health_check_after."""
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def checkout(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is not None and not self.is_healthy(conn):
+            self.discard(conn)
+            conn = None
+            with self.lock:
+                self.stats["reconnects"] += 1
+        if conn is None:
+            conn = self.connect()
+        return conn
+
+    def discard(self, conn):
+        self.last_used.pop(id(conn), None)
+        if not conn.closed:
+            conn.close()
+
+    def release(self, conn):
+        """Returns a connection to the idle list, dropping it if the server side went away."""
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed:
+            self.discard(conn)
+            return
+        self.last_used[id(conn)] = time.monotonic()
+        with self.lock:
+            self.idle.append(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Checks out a healthy connection for the duration of the block."""
+        wait_start = time.perf_counter()
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            with self.lock:
+                self.stats["timeouts"] += 1
+            raise PoolTimeout(f"no database connection free after {self.checkout_timeout}s")
+        waited = time.perf_counter() - wait_start
+
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+
+        conn = None
+        try:
+            conn = self.checkout()
+            yield conn
+        finally:
+            if conn is not None:
+                self.release(conn)
+            with self.lock:
+                self.stats["in_use"] -= 1
+            self.slots.release()
+
+    def metrics(self):
+        """Snapshot of the pool counters, including the average checkout wait."""
+        with self.lock:
+            metrics = dict(self.stats)
+            metrics["idle"] = len(self.idle)
+        metrics["size"] = self.maxconn
+        metrics["wait_seconds_avg"] = metrics["wait_seconds_total"] / metrics["checkouts"] if metrics["checkouts"] else 0.0
+        return metrics
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
@@ -0,0 +1,244 @@
+import argparse
+import contextlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+import query_jobs
+import result_pages
+
+# DuckDB in place of Postgres for the app's read-only queries: the normalized tables are copied
+# into a DuckDB file, from Postgres, a Parquet snapshot or straight from data.csv, and queried
+# in-process.
+#
+# Generated SQL is PostgreSQL dialect. DuckDB parses most of it, but some of its semantics differ:
+# / between integers divides with a fractional result unless integer_division is set, which
+# the query connection does. The gaps that remain show up as different answers, not errors:
+# - avg() and other numeric results come back as DOUBLE where Postgres returns exact NUMERIC;
+# - prices are DOUBLE holding the value as written, Postgres keeps the single precision REAL and
+#   widens it to double precision for arithmetic, so 13.44 * 3 is 40.32 here, 40.3199987... there;
+# - text sorts by code point where Postgres uses the database collation;
+# - Postgres-only functions (to_char, age, ...) fail with an error instead.
+# Where exact answers matter, run on Postgres.
+
+TABLE_ORDER = ["Region", "Country", "Customer", "ProductCategory", "Product", "OrderDetail"]
+
+# Order lines staged from the raw rows, the ELT load's RawOrderLines. DuckDB unnests several
+# lists in a select list side by side, like the multi-argument unnest in FROM on Postgres.
+stage_order_lines = """ CREATE TABLE RawOrderLines AS
+    SELECT LineNo, unnest(range(1, len(ProductNames) + 1)) AS ItemNo, Name,
+           unnest(ProductNames) AS ProductName, unnest(ProductCategories) AS ProductCategory,
+           unnest(ProductCategoryDescriptions) AS ProductCategoryDescription,
+           unnest(ProductUnitPrices) AS ProductUnitPrice, unnest(Quantities) AS QuantityOrdered,
+           unnest(OrderDates) AS OrderDate
+    FROM (SELECT LineNo, trim(Name) AS Name,
+                 string_split(trim(ProductName), ';') AS ProductNames,
+                 string_split(trim(ProductCategory), ';') AS ProductCategories,
+                 string_split(trim(ProductCategoryDescription), ';') AS ProductCategoryDescriptions,
+                 string_split(trim(ProductUnitPrice), ';') AS ProductUnitPrices,
+                 string_split(trim(QuantityOrdered), ';') AS Quantities,
+                 string_split(trim(OrderDate), ';') AS OrderDates
+          FROM RawOrders) r"""
+
+
+## -- Building the DuckDB file -- ##
+
+def duckdb_sql(sql):
+    # The ELT load's Postgres statements in DuckDB's dialect. Prices are stored as DOUBLE: DuckDB
+    # hands REAL values back widened (13.4399995...), Postgres prints them as written (13.44).
+    sql = re.sub(r"\bSERIAL\b", "INTEGER", sql)
+    sql = re.sub(r"\breal\b", "DOUBLE", sql, flags=re.IGNORECASE)
+    return sql.replace("to_date(l.OrderDate, 'YYYYMMDD')::timestamp", "strptime(l.OrderDate, '%Y%m%d')")
+
+def stage_raw_rows(conn, data_filename):
+    # RawOrders from data.csv, numbered in file order. Read with pyarrow rather than DuckDB's
+    # read_csv, whose parallel reader gives no line numbers.
+    import pyarrow as pa
+    import pyarrow.csv
+    import populate_database
+
+    raw_rows = pyarrow.csv.read_csv(
+        data_filename,
+        parse_options=pyarrow.csv.ParseOptions(delimiter='\t', quote_char=False),
+        # Named by position like the Postgres loader does, whatever the header line says
+        read_options=pyarrow.csv.ReadOptions(column_names=populate_database.raw_columns, skip_rows=1),
+        convert_options=pyarrow.csv.ConvertOptions(column_types={column: pa.string() for column in populate_database.raw_columns}),
+    )
+    raw_rows = raw_rows.add_column(0, "LineNo", pa.array(range(1, raw_rows.num_rows + 1), pa.int64()))
+    conn.register("raw_rows", raw_rows)
+    conn.execute("CREATE TABLE RawOrders AS SELECT * FROM raw_rows")
+    conn.unregister("raw_rows")
+    conn.execute(stage_order_lines)
+
+def load_from_csv(conn, data_filename):
+    """Normalized tables built from data.csv with the ELT load's statements, same rows and ids."""
+    import populate_database
+
+    stage_raw_rows(conn, data_filename)
+    for _, create_table_sql in populate_database.elt_create_tables:
+        conn.execute(duckdb_sql(create_table_sql))
+    for _, insert_sql in populate_database.elt_insert_tables:
+        conn.execute(duckdb_sql(insert_sql))
+    conn.execute("DROP TABLE RawOrderLines")
+    conn.execute("DROP TABLE RawOrders")
+
+def load_from_postgres(conn, database_url):
+    """Normalized tables copied from Postgres, through COPY to a temporary CSV file per table."""
+    import psycopg2
+    import populate_database
+
+    create_tables = dict(populate_database.elt_create_tables)
+    pg_conn = psycopg2.connect(database_url)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for table_name in TABLE_ORDER:
+                conn.execute(duckdb_sql(create_tables[table_name]))
+                csv_path = os.path.join(directory, f"{table_name}.csv")
+                with open(csv_path, 'w') as f, pg_conn.cursor() as cur:
+                    cur.copy_expert(f"COPY {table_name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+                conn.execute(f"COPY {table_name} FROM '{csv_path}' (FORMAT csv, HEADER)")
+    finally:
+        pg_conn.close()
+
+def load_from_snapshot(conn, snapshot_directory):
+    """Normalized tables read straight from a Parquet snapshot written by populate_database.py --snapshot."""
+    import populate_database
+    import snapshots
+
+    create_tables = dict(populate_database.elt_create_tables)
+    manifest = snapshots.read_manifest(snapshot_directory)
+    for table_name in TABLE_ORDER:
+        entry = manifest["tables"][table_name]
+        columns = ", ".join(entry["columns"])
+        conn.execute(duckdb_sql(create_tables[table_name]))
+        conn.execute(f"""INSERT INTO {table_name} ({columns}) SELECT {columns}
+            FROM read_parquet(?, hive_partitioning = false) ORDER BY 1""",
+                     [snapshots.table_files(snapshot_directory, entry)])
+        row_count = conn.execute(f"SELECT count(*) FROM {table_name}").fetchone()[0]
+        if row_count != entry["rows"]:
+            raise ValueError(f"snapshot of {table_name} has {row_count} rows, the manifest lists {entry['rows']}")
+
+def build(path, data_filename=None, database_url=None, snapshot_directory=None):
+    """Writes a new DuckDB file at path, from a snapshot or data.csv if given, from Postgres otherwise.
+
+    Built next to the old file and renamed over it, so the app keeps answering from the old
+    data until the new file is complete, then switches on its next query.
+    """
+    import duckdb
+
+    build_path = path + ".build"
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(build_path)
+    conn = duckdb.connect(build_path)
+    try:
+        if snapshot_directory is not None:
+            load_from_snapshot(conn, snapshot_directory)
+        elif data_filename is not None:
+            load_from_csv(conn, data_filename)
+        else:
+            load_from_postgres(conn, database_url)
+        conn.execute("CHECKPOINT")
+    finally:
+        conn.close()
+    os.replace(build_path, path)
+
+
+## -- Querying -- ##
+
+class Interrupter:
+    # Stands in for a Postgres connection on a QueryJob, whose cancel() stops the running query
+    def __init__(self, cur):
+        self.cur = cur
+
+    def cancel(self):
+        self.cur.interrupt()
+
+
+class DuckDBBackend:
+    """Read-only DuckDB file queried in-process, shared by every session.
+
+    Each query runs on its own cursor. A rebuilt file is picked up by the next query, and its
+    modification time serves as the load generation the query cache is keyed on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.generation = None
+
+    def connection(self):
+        import duckdb
+
+        with self.lock:
+            generation = os.stat(self.path).st_mtime_ns
+            if generation != self.generation:
+                # The old connection is left to queries still running on it
+                self.conn = duckdb.connect(self.path, read_only=True, config={"integer_division": True})
+                self.generation = generation
+            return self.conn, self.generation
+
+    @contextlib.contextmanager
+    def cursor(self, job=None):
+        """A cursor and the load generation it reads. With a job, the query can be cancelled
+        through it and is interrupted after the job's timeout, raising QueryTimeout."""
+        import duckdb
+
+        conn, generation = self.connection()
+        cur = conn.cursor()
+        timer = None
+        timed_out = threading.Event()
+        if job is not None:
+            def time_out():
+                timed_out.set()
+                cur.interrupt()
+            timer = threading.Timer(job.timeout_seconds, time_out)
+            timer.start()
+            job.attach(Interrupter(cur))
+        try:
+            yield cur, generation
+        except duckdb.InterruptException:
+            if job is not None and job.cancel_requested:
+                raise query_jobs.QueryCancelled()
+            if timed_out.is_set():
+                raise query_jobs.QueryTimeout(f"canceling statement due to statement timeout ({job.timeout_seconds:g}s)")
+            raise
+        finally:
+            if job is not None:
+                job.detach()
+                timer.cancel()
+            cur.close()
+
+    def fetch_page(self, cur, sql, offset, page_size, max_bytes):
+        # DuckDB skips the offset rows itself, nothing before the page is materialized in Python
+        cur.execute(f"SELECT * FROM ({result_pages.strip_statement(sql)}) AS page LIMIT {int(page_size)} OFFSET {int(offset)}")
+        return result_pages.read_page(cur, page_size, max_bytes)
+
+    def value_terms(self, value_queries):
+        with self.cursor() as (cur, _):
+            return {table_name: {row[0] for row in cur.execute(value_sql).fetchall() if row[0]}
+                    for table_name, value_sql in value_queries.items()}
+
+    def metrics(self):
+        stat = os.stat(self.path)
+        return {"path": self.path, "bytes": stat.st_size,
+                "built": time.strftime('%Y-%m-%d %H:%M', time.localtime(stat.st_mtime))}
+
+
+if __name__ == "__main__":
+    import populate_database
+
+    parser = argparse.ArgumentParser(description="Build the DuckDB file the app can query instead of Postgres")
+    parser.add_argument("--output", default="sales.duckdb")
+    parser.add_argument("--from-csv", nargs="?", const=populate_database.data_file,
+                        help="build from data.csv (the loader's data file if no path is given) instead of Postgres")
+    parser.add_argument("--from-snapshot", metavar="DIRECTORY",
+                        help="build from a Parquet snapshot written by populate_database.py --snapshot")
+    args = parser.parse_args()
+
+    build_start = time.perf_counter()
+    build(args.output, data_filename=args.from_csv, database_url=populate_database.DATABASE_URL,
+          snapshot_directory=args.from_snapshot)
+    print(f"{args.output} built from {args.from_snapshot or args.from_csv or 'Postgres'} in {time.perf_counter() - build_start:.2f}s")
@@ -0,0 +1,227 @@
+import argparse
+import re
+
+import psycopg2
+
+import cost_guard
+import query_cache
+import query_log
+
+# Proposes indexes for the queries that took the most time: the app's query log and, when the
+# extension is installed, pg_stat_statements give the workload. Every plan is searched for
+# sequential scans filtered or joined on a column no index starts with, and each such column is
+# tried as a hypothetical index and the workload re-planned. With the hypopg extension installed the
+# index only exists in the planner. Without it the index is really built inside a transaction and
+# rolled back, which holds a SHARE lock blocking writes to the table while it builds, so that build
+# is cut off after --trial-timeout. Only indexes that lower the estimated cost are proposed; --apply
+# creates them.
+
+JOIN_CONDITIONS = ("Hash Cond", "Merge Cond", "Join Filter")
+
+
+## -- Workload -- ##
+
+def statement_stats(conn, limit):
+    # The slowest read statements from pg_stat_statements, [] when the extension is not installed.
+    # Statements with $n parameters cannot be planned and are skipped later on.
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""SELECT query, calls, total_exec_time / 1000, max_exec_time / 1000
+                FROM pg_stat_statements
+                WHERE query ~* '^\\s*(select|with)\\M' AND query !~* 'pg_stat_statements'
+                ORDER BY total_exec_time DESC LIMIT %s""", (limit,))
+            rows = cur.fetchall()
+    except psycopg2.Error:
+        conn.rollback()
+        return []
+    return [{"sql": sql, "calls": calls, "total_seconds": float(total), "max_seconds": float(maximum), "errors": 0}
+            for sql, calls, total, maximum in rows]
+
+def merge_workloads(*workloads):
+    # One entry per normalized statement, keeping the larger timings when both sources saw it
+    merged = {}
+    for workload in workloads:
+        for query in workload:
+            key = query_cache.normalize_sql(query["sql"])
+            if key not in merged or query["total_seconds"] > merged[key]["total_seconds"]:
+                merged[key] = query
+    return sorted(merged.values(), key=lambda query: query["total_seconds"], reverse=True)
+
+
+## -- Plans -- ##
+
+def explain_plan(cur, sql):
+    # The plan of sql, made in cur's transaction so a hypothetical index created in it is considered
+    cur.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+    return cur.fetchone()[0][0]["Plan"]
+
+def table_columns(conn):
+    with conn.cursor() as cur:
+        cur.execute("""SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = 'public'""")
+        columns = {}
+        for table_name, column_name in cur.fetchall():
+            columns.setdefault(table_name, set()).add(column_name)
+    return columns
+
+def indexed_columns(conn):
+    # (table, column) pairs some index on a public table starts with
+    with conn.cursor() as cur:
+        cur.execute("""SELECT t.relname, a.attname
+            FROM pg_index x
+            JOIN pg_class t ON t.oid = x.indrelid
+            JOIN pg_namespace n ON n.oid = t.relnamespace
+            JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = x.indkey[0]
+            WHERE n.nspname = 'public'""")
+        return set(cur.fetchall())
+
+def column_references(condition, alias, relation_aliases, columns):
+    # (table, column) pairs a plan condition reads. Unqualified names belong to the scanned relation.
+    condition = re.sub(r"'(?:[^']|'')*'", "''", condition)
+    references = set()
+    for qualifier, name in re.findall(r"\b(?:(\w+)\.)?(\w+)\b", condition):
+        table_name = relation_aliases.get(qualifier) if qualifier else relation_aliases.get(alias)
+        if table_name is not None and name in columns.get(table_name, ()):
+            references.add((table_name, name))
+    return references
+
+def candidate_columns(plan, columns):
+    """Columns worth a hypothetical index: filtered or joined on in a table the plan scans sequentially."""
+    nodes = list(cost_guard.walk(plan))
+    relation_aliases = {node["Alias"]: node["Relation Name"] for node in nodes if "Relation Name" in node}
+    seq_scanned = {node["Relation Name"] for node in nodes if node["Node Type"] == "Seq Scan"}
+    candidates = set()
+    for node in nodes:
+        if node["Node Type"] == "Seq Scan" and "Filter" in node:
+            candidates |= column_references(node["Filter"], node["Alias"], relation_aliases, columns)
+        for condition in JOIN_CONDITIONS:
+            if condition in node:
+                candidates |= column_references(node[condition], None, relation_aliases, columns)
+    return {(table_name, column_name) for table_name, column_name in candidates if table_name in seq_scanned}
+
+
+## -- Advice -- ##
+
+def hypopg_installed(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'hypopg')")
+        return cur.fetchone()[0]
+
+def trial_index(cur, table_name, column_name, hypothetical, timeout_ms):
+    # Makes an index on column_name visible to the planner for the rest of cur's transaction.
+    # A real trial index is built under a SHARE lock, so both the lock wait and the build are bounded.
+    if hypothetical:
+        cur.execute("SELECT hypopg_create_index(%s)", (f"CREATE INDEX ON {table_name}({column_name})",))
+    else:
+        cur.execute("SELECT set_config('statement_timeout', %s, true), set_config('lock_timeout', %s, true)",
+                    (str(timeout_ms), str(timeout_ms)))
+        cur.execute(f"CREATE INDEX advisor_trial ON {table_name}({column_name})")
+
+def advise(conn, workload, min_gain, trial_timeout_ms=5000):
+    """Hypothetical index trials for every candidate column of the workload.
+
+    Returns the planned queries, the ones that could not be planned, the proposals sorted by the
+    share of the workload's time they are estimated to save, and the candidates whose trial failed,
+    with the reason (trial_timeout_ms hit, no btree support, no permission, ...). A query's saving is
+    its logged time times its relative cost reduction.
+    """
+    hypothetical = hypopg_installed(conn)
+    columns = table_columns(conn)
+    indexed = indexed_columns(conn)
+    planned, unplanned = [], []
+    with conn.cursor() as cur:
+        for query in workload:
+            try:
+                plan = explain_plan(cur, query["sql"])
+            except psycopg2.Error as e:
+                conn.rollback()
+                unplanned.append({**query, "error": str(e).strip().splitlines()[0]})
+                continue
+            planned.append({**query, "cost": plan["Total Cost"], "candidates": candidate_columns(plan, columns) - indexed})
+        conn.rollback()
+
+        workload_seconds = sum(query["total_seconds"] for query in planned) or 1.0
+        proposals, failed = [], []
+        for table_name, column_name in sorted(set().union(*(query["candidates"] for query in planned))):
+            affected = [query for query in planned if (table_name, column_name) in query["candidates"]]
+            try:
+                trial_index(cur, table_name, column_name, hypothetical, trial_timeout_ms)
+                costs = [explain_plan(cur, query["sql"])["Total Cost"] for query in affected]
+            except (psycopg2.errors.QueryCanceled, psycopg2.errors.LockNotAvailable):
+                failed.append({"table": table_name, "column": column_name, "error": "the trial index hit --trial-timeout"})
+                continue
+            except psycopg2.Error as e:
+                failed.append({"table": table_name, "column": column_name, "error": str(e).strip().splitlines()[0]})
+                continue
+            finally:
+                conn.rollback()
+                if hypothetical:
+                    cur.execute("SELECT hypopg_reset()")
+                    conn.rollback()
+            saved_seconds = sum(query["total_seconds"] * max(query["cost"] - cost, 0) / query["cost"]
+                                for query, cost in zip(affected, costs) if query["cost"])
+            if saved_seconds / workload_seconds < min_gain:
+                continue
+            proposals.append({
+                "table": table_name,
+                "column": column_name,
+                "statement": f"CREATE INDEX IF NOT EXISTS ix_{table_name}_{column_name} ON {table_name}({column_name})",
+                "queries": len(affected),
+                "cost_before": sum(query["cost"] for query in affected),
+                "cost_after": sum(costs),
+                "saved_seconds": saved_seconds,
+                "gain": saved_seconds / workload_seconds,
+            })
+    return planned, unplanned, sorted(proposals, key=lambda proposal: proposal["gain"], reverse=True), failed
+
+def print_advice(planned, unplanned, proposals, failed):
+    print(f"{len(planned)} queries planned, {len(unplanned)} could not be planned")
+    for query in unplanned:
+        print(f"  skipped: {' '.join(query['sql'].split())[:80]} ({query['error']})")
+    for trial in failed:
+        print(f"  not tried: {trial['table']}({trial['column']}) ({trial['error']})")
+    if not proposals:
+        print("no index lowers the estimated cost of the logged workload")
+        return
+    print(f"{'index':<45} {'queries':>7} {'cost before':>12} {'cost after':>11} {'saved s':>8} {'gain':>6}")
+    for proposal in proposals:
+        print(f"{proposal['table'] + '(' + proposal['column'] + ')':<45} {proposal['queries']:>7} "
+              f"{proposal['cost_before']:>12,.0f} {proposal['cost_after']:>11,.0f} "
+              f"{proposal['saved_seconds']:>8.2f} {proposal['gain']:>6.0%}")
+    for proposal in proposals:
+        print(proposal["statement"] + ";")
+
+
+if __name__ == "__main__":
+    import populate_database
+
+    parser = argparse.ArgumentParser(
+        description="Propose indexes for the slowest logged queries. Without the hypopg extension every "
+                    "trial index is really built and rolled back, blocking writes to its table meanwhile.")
+    parser.add_argument("--log", default="query_log.jsonl", help="query log written by the app (QUERY_LOG_PATH)")
+    parser.add_argument("--top", type=int, default=50, help="slowest statements considered from each source")
+    parser.add_argument("--min-seconds", type=float, default=0.0,
+                        help="leave out statements whose slowest run was faster than this")
+    parser.add_argument("--min-gain", type=float, default=0.01,
+                        help="smallest share of the workload time an index must save to be proposed")
+    parser.add_argument("--trial-timeout", type=int, default=5000,
+                        help="milliseconds a trial index may wait for and hold its SHARE lock when hypopg is not installed")
+    parser.add_argument("--apply", action="store_true", help="create the proposed indexes")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(populate_database.DATABASE_URL)
+    workload = merge_workloads(query_log.workload(query_log.read_entries(args.log))[:args.top],
+                               statement_stats(conn, args.top))
+    workload = [query for query in workload if query["max_seconds"] >= args.min_seconds]
+    planned, unplanned, proposals, failed = advise(conn, workload, args.min_gain, args.trial_timeout)
+    print_advice(planned, unplanned, proposals, failed)
+
+    if args.apply and proposals:
+        with conn:
+            with conn.cursor() as cur:
+                for proposal in proposals:
+                    cur.execute(proposal["statement"])
+                for table_name in dict.fromkeys(proposal["table"] for proposal in proposals):
+                    cur.execute(f"ANALYZE {table_name}")
+        print(f"created {len(proposals)} indexes")
+    conn.close()
@@ -0,0 +1,140 @@
+import contextlib
+import cProfile
+import functools
+import json
+import pstats
+import resource
+import sys
+import time
+
+# Instrumentation for populate_database.py. Steps wrapped with instrumented_step emit a JSON line per
+# start/finish, batch inserts emit one per batch, and every finished step is kept for print_summary.
+
+events_file = None
+counters = {"bytes_read": 0}
+step_stack = []
+step_summaries = []
+
+
+def configure_events(events_path):
+    # Sends events to events_path as JSON lines, "-" for stderr, None to only keep the summary
+    global events_file
+    if events_path == "-":
+        events_file = sys.stderr
+    elif events_path:
+        events_file = open(events_path, 'a')
+
+def peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def emit(event, **fields):
+    if events_file is None:
+        return
+    record = {"ts": round(time.time(), 3), "event": event, **fields}
+    events_file.write(json.dumps(record) + "\n")
+    events_file.flush()
+
+def add_bytes_read(byte_count):
+    counters["bytes_read"] += byte_count
+
+def add_rows(row_count):
+    # Adds to the rows processed by the innermost running step
+    if step_stack:
+        step_stack[-1]["rows"] += row_count
+
+
+def instrumented_step(function):
+    # Decorator timing a loader step and counting the rows and bytes it processed
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        step = {"step": function.__name__, "depth": len(step_stack), "rows": 0,
+                "start": time.perf_counter(), "bytes_start": counters["bytes_read"]}
+        step_stack.append(step)
+        emit("step_start", step=step["step"], depth=step["depth"])
+        status = "failed"
+        try:
+            result = function(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            step_stack.pop()
+            seconds = time.perf_counter() - step["start"]
+            summary = {
+                "step": step["step"],
+                "depth": step["depth"],
+                "status": status,
+                "seconds": round(seconds, 4),
+                "rows": step["rows"],
+                "rows_per_sec": round(step["rows"] / seconds, 1) if seconds else None,
+                "bytes_read": counters["bytes_read"] - step["bytes_start"],
+                "peak_memory_kb": peak_memory_kb(),
+            }
+            emit("step_end", **summary)
+            step_summaries.append((step["start"], summary))
+
+    return wrapper
+
+def record_batch(row_count, seconds, data_size=None, bytes_start=0):
+    # One batch insert finished. data_size is the number of bytes the step will read in total,
+    # used with the bytes read so far to estimate progress and time left.
+    add_rows(row_count)
+    fields = {
+        "step": step_stack[-1]["step"] if step_stack else None,
+        "rows": row_count,
+        "batch_seconds": round(seconds, 4),
+        "rows_per_sec": round(row_count / seconds, 1) if seconds else None,
+        "bytes_read": counters["bytes_read"],
+        "peak_memory_kb": peak_memory_kb(),
+    }
+    if data_size and step_stack:
+        progress = min((counters["bytes_read"] - bytes_start) / data_size, 1.0)
+        elapsed = time.perf_counter() - step_stack[-1]["start"]
+        fields["progress"] = round(progress, 4)
+        fields["eta_seconds"] = round(elapsed * (1 - progress) / progress, 1) if progress else None
+    emit("batch", **fields)
+
+def track_batches(rows, batch_size, data_size=None):
+    # Passes rows through, recording a batch event every batch_size rows. For loads that stream
+    # every row through one statement (COPY), where there are no insert batches to time.
+    bytes_start = counters["bytes_read"]
+    batch_rows = 0
+    batch_start = time.perf_counter()
+    for row in rows:
+        yield row
+        batch_rows += 1
+        if batch_rows >= batch_size:
+            record_batch(batch_rows, time.perf_counter() - batch_start, data_size, bytes_start)
+            batch_rows = 0
+            batch_start = time.perf_counter()
+    if batch_rows:
+        record_batch(batch_rows, time.perf_counter() - batch_start, data_size, bytes_start)
+
+
+def print_summary():
+    # End of run table of every instrumented step, nested steps indented under their caller
+    if not step_summaries:
+        return
+    print(f"{'step':<64} {'seconds':>9} {'rows':>11} {'rows/s':>11} {'MB read':>9} {'peak MB':>8}")
+    for _, summary in sorted(step_summaries, key=lambda started_summary: started_summary[0]):
+        name = "  " * summary["depth"] + summary["step"] + ("" if summary["status"] == "ok" else " (failed)")
+        print(f"{name:<64} {summary['seconds']:>9.3f} {summary['rows']:>11} "
+              f"{summary['rows_per_sec'] or 0:>11.0f} {summary['bytes_read'] / 1e6:>9.1f} "
+              f"{summary['peak_memory_kb'] / 1024:>8.0f}")
+    emit("run_end", steps=len(step_summaries), peak_memory_kb=peak_memory_kb())
+
+@contextlib.contextmanager
+def profiled(profile_path, top=25):
+    # Runs the block under cProfile, dumps the stats to profile_path and prints the hottest functions
+    if not profile_path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        print(f"profile written to {profile_path}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
@@ -7,6 +7,17 @@ import csv
 from pathlib import Path
 import time
 import datetime
+import argparse
+import contextlib
+import hashlib
+import multiprocessing
+import multiprocessing.util
+
+import numpy as np
+import pandas as pd
+
+import loader_metrics
+import rollups
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -24,35 +35,75 @@ DATABASE_URL = generate_url()
 
 from psycopg2 import Error
 
+connection_stats = {"connections": 0, "connect_seconds": 0.0}
+
 def create_connection(db_file, delete_db=False):
     if delete_db and os.path.exists(db_file):
         os.remove(db_file)
 
     conn = None
     try:
+        connect_start = time.perf_counter()
         conn = psycopg2.connect(DATABASE_URL)
+        connection_stats["connections"] += 1
+        connection_stats["connect_seconds"] += time.perf_counter() - connect_start
     except Error as e:
         print(e)
 
     return conn
 
+def step_connection(normalized_database_filename, conn_norm=None):
+    # Returns the connection a step should run on and whether the step owns it. Steps given a
+    # shared connection leave it open for the next step; otherwise they open and close their own.
+    if conn_norm is not None:
+        return conn_norm, False
+    return create_connection(normalized_database_filename, delete_db=False), True
+
+@contextlib.contextmanager
+def loader_step(conn_norm, step_name, step_timings):
+    # Transaction boundary around one step on a shared connection: whatever the step left
+    # uncommitted is committed when it finishes and rolled back if it fails
+    step_start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        conn_norm.rollback()
+        raise
+    conn_norm.commit()
+    step_timings.append((step_name, time.perf_counter() - step_start))
+
+@contextlib.contextmanager
+def step_transaction(conn_norm, own_connection):
+    # Commits what a step wrote when it runs on its own connection. On a shared connection nothing
+    # is committed here, loader_step commits or rolls back the whole step.
+    if own_connection:
+        with conn_norm:
+            yield
+    else:
+        yield
+
+def print_connection_report(step_timings, worker_connection_stats=None):
+    # Prints connection setup time against the time spent in the steps themselves
+    connections = connection_stats["connections"]
+    connect_seconds = connection_stats["connect_seconds"]
+    for stats in (worker_connection_stats or {}).values():
+        connections += stats["connections"]
+        connect_seconds += stats["connect_seconds"]
+
+    print(f"connection setup: {connections} connections, {connect_seconds:.3f}s")
+    for step_name, seconds in step_timings:
+        print(f"{step_name}: {seconds:.3f}s")
+    print(f"step work total: {sum(seconds for _, seconds in step_timings):.3f}s")
+
 
 def create_table(conn, create_table_sql, drop_table_name=None):
-    
-    if drop_table_name: # You can optionally pass drop_table_name to drop the table. 
-        try:
-            c = conn.cursor()
-            c.execute("""DROP TABLE IF EXISTS %s""" % (drop_table_name))
-        except Error as e:
-            print(e)
-    
-    try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
-    except Error as e:
-        print(e)
+    # Runs in the caller's transaction, the table only replaces the old one once the caller commits
 
-    conn.commit()    
+    c = conn.cursor()
+    if drop_table_name: # You can optionally pass drop_table_name to drop the table. 
+        c.execute("""DROP TABLE IF EXISTS %s CASCADE""" % (drop_table_name))
+    c.execute(create_table_sql)
+    c.close()
         
 def execute_sql_statement(sql_statement, conn):
     cur = conn.cursor()
@@ -61,184 +112,396 @@ def execute_sql_statement(sql_statement, conn):
     return rows
 
 
+## -- Bulk loading -- ##
+
+def copy_value(value):
+    # Escapes a single value for the COPY text format
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+class CopyRowStream:
+    # File-like object handed to COPY FROM STDIN. Rows are pulled from the iterable
+    # as the server asks for more data, so the full payload is never held in memory.
+
+    def __init__(self, rows):
+        self.lines = ('\t'.join(copy_value(v) for v in row) + '\n' for row in rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        if self.buffer:
+            line, self.buffer = self.buffer, ''
+            return line
+        return next(self.lines, '')
+
+def copy_rows(cur, table_name, columns, rows):
+    # Streams rows straight into table_name with COPY FROM STDIN
+    cur.copy_expert(f"COPY {table_name}({','.join(columns)}) FROM STDIN", CopyRowStream(rows))
+    return cur.rowcount
+
+def copy_insert(conn, table_name, columns, rows, conflict_columns=None):
+    # Inputs: Open connection, target table, column names, iterable of row tuples and
+    #         optionally the columns of the UNIQUE constraint to skip conflicting rows on
+    # Output: Number of rows merged into the target table
+    #
+    # Rows are streamed into a temporary table with COPY FROM STDIN and then merged with one
+    # INSERT ... SELECT. The merge follows the copy order, so SERIAL ids come out the same as
+    # inserting the rows one by one. Runs inside the caller's transaction.
+
+    column_list = ",".join(columns)
+    stage_table = f"{table_name}_stage"
+
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {stage_table}")
+    cur.execute(f"CREATE TEMP TABLE {stage_table} AS SELECT {column_list} FROM {table_name} WITH NO DATA")
+    cur.execute(f"ALTER TABLE {stage_table} ADD COLUMN copy_seq BIGSERIAL")
+    copy_rows(cur, stage_table, columns, rows)
+
+    merge_sql = f"INSERT INTO {table_name}({column_list}) SELECT {column_list} FROM {stage_table} ORDER BY copy_seq"
+    if conflict_columns:
+        merge_sql += f" ON CONFLICT ({','.join(conflict_columns)}) DO NOTHING"
+    cur.execute(merge_sql)
+    row_count = cur.rowcount
+
+    cur.execute(f"DROP TABLE {stage_table}")
+    cur.close()
+    return row_count
+
+
 normalized_database = 'orders_normalized.db'
 data_file = 'project2/data.csv'
 
 
 ## -- Connection dictionaries -- ##
 
-def step2_create_region_to_regionid_dictionary(normalized_database_filename):
+@loader_metrics.instrumented_step
+def step2_create_region_to_regionid_dictionary(normalized_database_filename, conn_norm=None):
 
-  conn_norm = create_connection(normalized_database_filename, delete_db=False)
+  conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
   fetch_region = """select * from Region"""
   fetch_region_data = execute_sql_statement(fetch_region, conn_norm)
 
   region_dict = {reg : id for id, reg in fetch_region_data}
+  loader_metrics.add_rows(len(region_dict))
   
-  conn_norm.close()
+  if own_connection:
+    conn_norm.close()
   return region_dict
 
-def step4_create_country_to_countryid_dictionary(normalized_database_filename):
+@loader_metrics.instrumented_step
+def step4_create_country_to_countryid_dictionary(normalized_database_filename, conn_norm=None):
     
-  conn_norm = create_connection(normalized_database_filename, delete_db=False)
+  conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
   fetch_country = """select * from Country"""
   fetch_country_data = execute_sql_statement(fetch_country, conn_norm)
 
   country_dict = { c: c_id for c_id, c, r_id in fetch_country_data }
+  loader_metrics.add_rows(len(country_dict))
   
-  conn_norm.close()
+  if own_connection:
+    conn_norm.close()
   return country_dict  
 
-def step6_create_customer_to_customerid_dictionary(normalized_database_filename):
+@loader_metrics.instrumented_step
+def step6_create_customer_to_customerid_dictionary(normalized_database_filename, conn_norm=None):
     
-  conn_norm = create_connection(normalized_database_filename, delete_db=False)
+  conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
   fetch_customer = """select * from Customer"""
   fetch_customer_data = execute_sql_statement(fetch_customer, conn_norm)
 
   customer_dict = { n1 + ' ' + n2 : c_id for c_id, n1, n2, a, city, ct_id in fetch_customer_data }
+  loader_metrics.add_rows(len(customer_dict))
   
-  conn_norm.close()
+  if own_connection:
+    conn_norm.close()
   return customer_dict 
 
-def step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename):
+@loader_metrics.instrumented_step
+def step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, conn_norm=None):
     
-  conn_norm = create_connection(normalized_database_filename, delete_db=False)
+  conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
   fetch_prd_cat = """select * from ProductCategory"""
   fetch_prd_cat_data = execute_sql_statement(fetch_prd_cat, conn_norm)
 
   prd_cat_dict = { pd_cat : cat_id for cat_id, pd_cat, p_cat_desc in fetch_prd_cat_data }
+  loader_metrics.add_rows(len(prd_cat_dict))
   
-  conn_norm.close()
+  if own_connection:
+    conn_norm.close()
   return prd_cat_dict
 
-def step10_create_product_to_productid_dictionary(normalized_database_filename):
+@loader_metrics.instrumented_step
+def step10_create_product_to_productid_dictionary(normalized_database_filename, conn_norm=None):
     
-  conn_norm = create_connection(normalized_database_filename, delete_db=False)
+  conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
   fetch_prd = """select * from Product"""
   fetch_prd_data = execute_sql_statement(fetch_prd, conn_norm)
 
   prd_dict = { p_name : p_id for p_id, p_name, p_price, p_cat_id in fetch_prd_data }
+  loader_metrics.add_rows(len(prd_dict))
   
-  conn_norm.close()
+  if own_connection:
+    conn_norm.close()
   return prd_dict
 
 
-## -- Table creation -- ##
+## -- Data extraction -- ##
 
-def step1_create_region_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
-    # Output: None
+def read_data_rows(data_filename):
+    # Inputs: Name of the data file
+    # Output: Generator yielding the tab separated values of each data row, header skipped
 
-    ## Extracting Region ##
-    region_list = []
-    with open(data_filename, 'r') as f:
-        lines = f.readlines()
+    with open(data_filename, 'rb') as f:
+        header = f.readline()
+
+        if not header:
+            raise ValueError("CSV file is empty.")
 
-        if not lines:
+        for line in f:
+            loader_metrics.add_bytes_read(len(line))
+            yield line.decode().strip().split('\t')
+
+def read_data_range(data_filename, byte_range):
+    # Inputs: Name of the data file and a (start, end) byte range starting on a line boundary
+    # Output: Generator yielding the tab separated values of each row starting inside the range
+
+    start, end = byte_range
+    with open(data_filename, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            loader_metrics.add_bytes_read(len(line))
+            yield line.decode().strip().split('\t')
+
+def split_data_file(data_filename, chunk_count, byte_range=None):
+    # Inputs: Name of the data file, the number of chunks wanted and optionally the byte range to split
+    # Output: List of (start, end) byte ranges covering every data row, split on line boundaries
+
+    with open(data_filename, 'rb') as f:
+        header = f.readline()
+
+        if not header:
             raise ValueError("CSV file is empty.")
 
-        for line in lines[1:]:
-            val_list = line.strip().split('\t')
-            row_data = tuple((val_list[4],))
-            if row_data not in region_list:
-              region_list.append(row_data)
+        if byte_range is None:
+            byte_range = (f.tell(), os.path.getsize(data_filename))
+        boundaries, file_size = [byte_range[0]], byte_range[1]
+        chunk_size = max((file_size - boundaries[0]) // chunk_count, 1)
+        for i in range(1, chunk_count):
+            f.seek(boundaries[0] + i * chunk_size - 1)
+            f.readline()
+            position = f.tell()
+            if position >= file_size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+        boundaries.append(file_size)
+
+    return [byte_range for byte_range in zip(boundaries[:-1], boundaries[1:]) if byte_range[0] < byte_range[1]]
+
+class UniqueRows:
+    # Order preserving collection of distinct row tuples. Membership is a hash lookup
+    # instead of a list scan, so extraction stays linear in the number of rows read.
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, row_data):
+        self.rows.setdefault(row_data)
+
+    def __contains__(self, row_data):
+        return row_data in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+def extract_region(val_list, region_list):
+    row_data = tuple((val_list[4],))
+    region_list.add(row_data)
+
+def extract_country_region(val_list, country_region_list):
+    row_data = tuple((val_list[3], val_list[4]))
+    country_region_list.add(row_data)
+
+def extract_customer(val_list, customer_list):
+    f_name, l_name = val_list[0].split(' ',1)
+    row_data = tuple((f_name, l_name, val_list[1], val_list[2], val_list[3]))
+    customer_list.add(row_data)
+
+def extract_productcategory(val_list, prd_cat_list):
+    prd_cat = val_list[6].strip().split(';')
+    prd_cat_desc = val_list[7].strip().split(';')
+    for i in range(len(prd_cat)):
+        row_data = tuple((prd_cat[i],prd_cat_desc[i]))
+        prd_cat_list.add(row_data)
+
+def extract_product(val_list, product_list):
+    prd_name = val_list[5].strip().split(';')
+    prd_unit_p = val_list[8].strip().split(';')
+    prd_cat = val_list[6].strip().split(';')
+    for i in range(len(prd_cat)):
+        row_data = tuple((prd_name[i],prd_unit_p[i],prd_cat[i]))
+        product_list.add(row_data)
+
+@loader_metrics.instrumented_step
+def extract_dimension_data(data_filename, byte_range=None):
+    # Inputs: Name of the data file, optionally a byte range to restrict the pass to
+    # Output: Dictionary of table name -> distinct rows, built in a single pass over the file
+    #         Memory is bounded by the number of distinct dimension values, not the file size
+
+    dimension_data = {
+        "Region": UniqueRows(),
+        "Country": UniqueRows(),
+        "Customer": UniqueRows(),
+        "ProductCategory": UniqueRows(),
+        "Product": UniqueRows(),
+    }
+    if byte_range is None:
+        val_lists = read_data_rows(data_filename)
+    else:
+        val_lists = read_data_range(data_filename, byte_range)
+
+    row_count = 0
+    for val_list in val_lists:
+        extract_region(val_list, dimension_data["Region"])
+        extract_country_region(val_list, dimension_data["Country"])
+        extract_customer(val_list, dimension_data["Customer"])
+        extract_productcategory(val_list, dimension_data["ProductCategory"])
+        extract_product(val_list, dimension_data["Product"])
+        row_count += 1
+    loader_metrics.add_rows(row_count)
+
+    return dimension_data
+
+
+## -- Table creation -- ##
+
+@loader_metrics.instrumented_step
+def step1_create_region_table(data_filename, normalized_database_filename, dimension_data=None, bulk=False, incremental=False, conn_norm=None):
+    # Inputs: Name of the data and normalized database filename, optionally the output of extract_dimension_data
+    # Output: None
 
+    ## Extracting Region ##
+    if dimension_data is None:
+        dimension_data = extract_dimension_data(data_filename)
+    region_list = dimension_data["Region"]
+
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
     region_list1 = sorted(region_list, key = lambda a: a[0])
+    if incremental:
+        # Region has no UNIQUE constraint, only regions not loaded yet are inserted
+        region_dict = step2_create_region_to_regionid_dictionary(normalized_database_filename, conn_norm)
+        region_list1 = [row for row in region_list1 if row[0] not in region_dict]
     print(region_list1[0:2])
 
     ## Creating Region Table ##
-    conn_norm = create_connection(normalized_database_filename, delete_db=False)
     create_table_region = """ CREATE TABLE IF NOT EXISTS Region(
         RegionID SERIAL not null primary key,
         Region TEXT not null
     )"""
-    create_table(conn_norm, create_table_region, drop_table_name="Region")
+    create_table(conn_norm, create_table_region, drop_table_name=None if incremental else "Region")
     print("table created")
 
     ## Inserting Data ##
-    with conn_norm:
-        region_insert = """ INSERT INTO Region(Region) VALUES(%s)"""
-        cur = conn_norm.cursor()
-        cur.executemany(region_insert, region_list1)
-        cur.close()
+    loader_metrics.add_rows(len(region_list1))
+    with step_transaction(conn_norm, own_connection):
+        if bulk:
+            copy_insert(conn_norm, "Region", ["Region"], region_list1)
+        else:
+            region_insert = """ INSERT INTO Region(Region) VALUES(%s)"""
+            cur = conn_norm.cursor()
+            cur.executemany(region_insert, region_list1)
+            cur.close()
     print("data inserted")
     
-    conn_norm.close()
-
-step1_create_region_table(data_file, normalized_database)
+    if own_connection:
+        conn_norm.close()
 
 
-def step3_create_country_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+@loader_metrics.instrumented_step
+def step3_create_country_table(data_filename, normalized_database_filename, dimension_data=None, bulk=False, incremental=False, conn_norm=None):
+    # Inputs: Name of the data and normalized database filename, optionally the output of extract_dimension_data
     # Output: None
     
     ## Extracting Country Region ##
-    country_region_list = []
-    with open(data_filename, 'r') as f:
-        lines = f.readlines()
-
-        if not lines:
-            raise ValueError("CSV file is empty.")
-
-        for line in lines[1:]:
-            val_list = line.strip().split('\t')
-            row_data = tuple((val_list[3], val_list[4]))
-            if row_data not in country_region_list:
-              country_region_list.append(row_data)
+    if dimension_data is None:
+        dimension_data = extract_dimension_data(data_filename)
+    country_region_list = dimension_data["Country"]
 
     country_region_list1 = sorted(country_region_list, key = lambda a: a[0])
     print(country_region_list1[0:2])
 
-    region_dict = step2_create_region_to_regionid_dictionary(normalized_database_filename)
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+    region_dict = step2_create_region_to_regionid_dictionary(normalized_database_filename, conn_norm)
     country_region_list2 = list(map(lambda a: (a[0],region_dict[a[1]]) , country_region_list1 ))
+    if incremental:
+        # Country has no UNIQUE constraint, only countries not loaded yet are inserted
+        country_dict = step4_create_country_to_countryid_dictionary(normalized_database_filename, conn_norm)
+        country_region_list2 = [row for row in country_region_list2 if row[0] not in country_dict]
 
     ## Creating Country Table ##
-    conn_norm = create_connection(normalized_database_filename, delete_db=False)
     create_table_country = """ CREATE TABLE IF NOT EXISTS Country(
         CountryID SERIAL not null Primary key,
         Country Text not null,
         RegionID integer not null,
         FOREIGN KEY(RegionID) REFERENCES Region(RegionID)
     )"""
-    create_table(conn_norm, create_table_country, drop_table_name="Country")
+    create_table(conn_norm, create_table_country, drop_table_name=None if incremental else "Country")
 
     ## Inserting Data ##
-    with conn_norm:
-        country_insert = """ INSERT INTO Country(Country,RegionID) VALUES(%s,%s)"""
-        cur = conn_norm.cursor()
-        cur.executemany(country_insert, country_region_list2)
-        cur.close()
+    loader_metrics.add_rows(len(country_region_list2))
+    with step_transaction(conn_norm, own_connection):
+        if bulk:
+            copy_insert(conn_norm, "Country", ["Country", "RegionID"], country_region_list2)
+        else:
+            country_insert = """ INSERT INTO Country(Country,RegionID) VALUES(%s,%s)"""
+            cur = conn_norm.cursor()
+            cur.executemany(country_insert, country_region_list2)
+            cur.close()
     
-    conn_norm.close()
-
-step3_create_country_table(data_file, normalized_database)
+    if own_connection:
+        conn_norm.close()
 
 
-def step5_create_customer_table(data_filename, normalized_database_filename):
+@loader_metrics.instrumented_step
+def step5_create_customer_table(data_filename, normalized_database_filename, dimension_data=None, bulk=False, incremental=False, conn_norm=None):
 
     ## Extracting Data ##
-    customer_list = []
-    with open(data_filename, 'r') as f:
-        lines = f.readlines()
-
-        if not lines:
-            raise ValueError("CSV file is empty.")
-
-        for line in lines[1:]:
-            val_list = line.strip().split('\t')
-            f_name, l_name = val_list[0].split(' ',1)
-            row_data = tuple((f_name, l_name, val_list[1], val_list[2], val_list[3]))
-            if row_data not in customer_list:
-              customer_list.append(row_data)
+    if dimension_data is None:
+        dimension_data = extract_dimension_data(data_filename)
+    customer_list = dimension_data["Customer"]
 
     customer_list = sorted(customer_list, key = lambda a: a[0]+a[1])
 
-    country_dict = step4_create_country_to_countryid_dictionary(normalized_database_filename)
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+    country_dict = step4_create_country_to_countryid_dictionary(normalized_database_filename, conn_norm)
     customer_list1 = list(map(lambda a: (a[0],a[1],a[2],a[3],country_dict[a[4]]) , customer_list))
     print(customer_list1[0:2])
 
     ## Creating Table ##
-    conn_norm = create_connection(normalized_database_filename, delete_db=False)
     create_table_customer = """ CREATE TABLE IF NOT EXISTS Customer(
         CustomerID SERIAL not null Primary Key,
         FirstName Text not null,
@@ -249,105 +512,89 @@ def step5_create_customer_table(data_filename, normalized_database_filename):
         UNIQUE (FirstName, LastName, Address),
         FOREIGN KEY(CountryID) REFERENCES Country(CountryID)
     )"""
-    create_table(conn_norm, create_table_customer, drop_table_name="Customer")
+    create_table(conn_norm, create_table_customer, drop_table_name=None if incremental else "Customer")
     print("table created")
 
     ## Inserting Data ##
-    with conn_norm:
-        customer_insert = """ INSERT INTO Customer(FirstName,LastName,Address,City,CountryID) 
-                        VALUES(%s,%s,%s,%s,%s)
-                        ON CONFLICT (FirstName, LastName, Address) DO NOTHING"""
-        cur = conn_norm.cursor()
-        cur.executemany(customer_insert, customer_list1)
-        cur.close()
+    loader_metrics.add_rows(len(customer_list1))
+    with step_transaction(conn_norm, own_connection):
+        if bulk:
+            copy_insert(conn_norm, "Customer", ["FirstName", "LastName", "Address", "City", "CountryID"],
+                        customer_list1, ["FirstName", "LastName", "Address"])
+        else:
+            customer_insert = """ INSERT INTO Customer(FirstName,LastName,Address,City,CountryID) 
+                            VALUES(%s,%s,%s,%s,%s)
+                            ON CONFLICT (FirstName, LastName, Address) DO NOTHING"""
+            cur = conn_norm.cursor()
+            cur.executemany(customer_insert, customer_list1)
+            cur.close()
     print("data inserted")
     
-    conn_norm.close()
-
-step5_create_customer_table(data_file, normalized_database)
+    if own_connection:
+        conn_norm.close()
 
 
-def step7_create_productcategory_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+@loader_metrics.instrumented_step
+def step7_create_productcategory_table(data_filename, normalized_database_filename, dimension_data=None, bulk=False, incremental=False, conn_norm=None):
+    # Inputs: Name of the data and normalized database filename, optionally the output of extract_dimension_data
     # Output: None
 
     ## Extracting Data ##
-    prd_cat_list = []
-    with open(data_filename, 'r') as f:
-        lines = f.readlines()
-
-        if not lines:
-            raise ValueError("CSV file is empty.")
-
-        for line in lines[1:]:
-            val_list = line.strip().split('\t')
-            prd_cat = val_list[6].strip().split(';')
-            prd_cat_desc = val_list[7].strip().split(';')
-            for i in range(len(prd_cat)):
-                row_data = tuple((prd_cat[i],prd_cat_desc[i]))
-                if row_data not in prd_cat_list:
-                    prd_cat_list.append(row_data)
+    if dimension_data is None:
+        dimension_data = extract_dimension_data(data_filename)
+    prd_cat_list = dimension_data["ProductCategory"]
 
     prd_cat_list = sorted(prd_cat_list, key = lambda a: a[0])
     print(prd_cat_list[0:2])
 
     ## Creating Table ##
-    conn_norm = create_connection(normalized_database_filename, delete_db=False)
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
     create_table_prd_cat = """ CREATE TABLE IF NOT EXISTS ProductCategory(
         ProductCategoryID SERIAL not null Primary Key,
         ProductCategory Text not null,
         ProductCategoryDescription Text not null,
         UNIQUE(ProductCategory)
     )"""
-    create_table(conn_norm, create_table_prd_cat, drop_table_name="ProductCategory")
+    create_table(conn_norm, create_table_prd_cat, drop_table_name=None if incremental else "ProductCategory")
     print("table created")
 
     ## Inserting Data ##
-    with conn_norm:
-        prd_cat_insert = """ INSERT INTO ProductCategory(ProductCategory,ProductCategoryDescription) 
-                        VALUES(%s,%s)
-                        ON CONFLICT (ProductCategory) DO NOTHING"""
-        cur = conn_norm.cursor()
-        cur.executemany(prd_cat_insert, prd_cat_list)
-        cur.close()
+    loader_metrics.add_rows(len(prd_cat_list))
+    with step_transaction(conn_norm, own_connection):
+        if bulk:
+            copy_insert(conn_norm, "ProductCategory", ["ProductCategory", "ProductCategoryDescription"],
+                        prd_cat_list, ["ProductCategory"])
+        else:
+            prd_cat_insert = """ INSERT INTO ProductCategory(ProductCategory,ProductCategoryDescription) 
+                            VALUES(%s,%s)
+                            ON CONFLICT (ProductCategory) DO NOTHING"""
+            cur = conn_norm.cursor()
+            cur.executemany(prd_cat_insert, prd_cat_list)
+            cur.close()
     print("data inserted")
     
-    conn_norm.close()
-
-step7_create_productcategory_table(data_file, normalized_database)
+    if own_connection:
+        conn_norm.close()
 
 
-def step9_create_product_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+@loader_metrics.instrumented_step
+def step9_create_product_table(data_filename, normalized_database_filename, dimension_data=None, bulk=False, incremental=False, conn_norm=None):
+    # Inputs: Name of the data and normalized database filename, optionally the output of extract_dimension_data
     # Output: None
 
     ## Extracting Data ##
-    product_list = []
-    with open(data_filename, 'r') as f:
-        lines = f.readlines()
-
-        if not lines:
-            raise ValueError("CSV file is empty.")
-
-        for line in lines[1:]:
-            val_list = line.strip().split('\t')
-            prd_name = val_list[5].strip().split(';')
-            prd_unit_p = val_list[8].strip().split(';')
-            prd_cat = val_list[6].strip().split(';')
-            
-            for i in range(len(prd_cat)):
-                row_data = tuple((prd_name[i],prd_unit_p[i],prd_cat[i]))
-                if row_data not in product_list:
-                    product_list.append(row_data)
+    if dimension_data is None:
+        dimension_data = extract_dimension_data(data_filename)
+    product_list = dimension_data["Product"]
 
     product_list = sorted(product_list, key = lambda a: a[0])
 
-    prd_cat_dict = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename)
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+    prd_cat_dict = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, conn_norm)
     product_list1 = list(map(lambda a: (a[0],a[1],prd_cat_dict[a[2]]) , product_list))
     print(product_list1[0:2])
 
     ## Creating Table ##
-    conn_norm = create_connection(normalized_database_filename, delete_db=False)
     create_table_prd = """ CREATE TABLE IF NOT EXISTS Product(
         ProductID SERIAL not null Primary key,
         ProductName Text not null,
@@ -356,31 +603,215 @@ def step9_create_product_table(data_filename, normalized_database_filename):
         UNIQUE (ProductName),
         FOREIGN KEY(ProductCategoryID) REFERENCES ProductCategory(ProductCategoryID)
     )"""
-    create_table(conn_norm, create_table_prd, drop_table_name="Product")
+    create_table(conn_norm, create_table_prd, drop_table_name=None if incremental else "Product")
     print("table created")
     
     ## Inserting Data ##
-    with conn_norm:
-        prd_insert = """ INSERT INTO Product(ProductName,ProductUnitPrice, ProductCategoryID) 
-                        VALUES(%s,%s,%s)
-                        ON CONFLICT (ProductName) DO NOTHING"""
-        cur = conn_norm.cursor()
-        cur.executemany(prd_insert, product_list1)
-        cur.close()
+    loader_metrics.add_rows(len(product_list1))
+    with step_transaction(conn_norm, own_connection):
+        if bulk:
+            copy_insert(conn_norm, "Product", ["ProductName", "ProductUnitPrice", "ProductCategoryID"],
+                        product_list1, ["ProductName"])
+        else:
+            prd_insert = """ INSERT INTO Product(ProductName,ProductUnitPrice, ProductCategoryID) 
+                            VALUES(%s,%s,%s)
+                            ON CONFLICT (ProductName) DO NOTHING"""
+            cur = conn_norm.cursor()
+            cur.executemany(prd_insert, product_list1)
+            cur.close()
     print("dats inserted")
     
-    conn_norm.close()
+    if own_connection:
+        conn_norm.close()
+
+
+
+def generate_order_lines(data_filename, byte_range=None):
+    # Inputs: Name of the data file, optionally a byte range from split_data_file
+    # Output: Generator of (customer name, product name, order date, quantity) per order line
 
-step9_create_product_table(data_file, normalized_database)
+    if byte_range is None:
+        val_lists = read_data_rows(data_filename)
+    else:
+        val_lists = read_data_range(data_filename, byte_range)
 
+    for val_list in val_lists:
+        name = val_list[0].strip()
+        prd_name = val_list[5].strip().split(';')
+        order_dt = val_list[10].strip().split(';')
+        qt_ord = val_list[9].strip().split(';')
 
+        for i in range(len(prd_name)):
+            order_dt1 = datetime.datetime.strptime(order_dt[i], '%Y%m%d').strftime('%Y-%m-%d')
+            yield tuple((name,prd_name[i],order_dt1,int(qt_ord[i])))
+
+
+class ByteRangeReader:
+    # Binary file wrapper that stops reading at the end of a byte range
+
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end
+
+    def read(self, size=-1):
+        remaining = self.end - self.f.tell()
+        if remaining <= 0:
+            return b''
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.f.read(size)
+        loader_metrics.add_bytes_read(len(data))
+        return data
+
+def generate_order_rows_columnar(data_filename, customer_dict, prd_dict, byte_range=None, chunk_rows=200000):
+    # Inputs: Name of the data file, customer and product lookup dictionaries, optionally a byte range
+    #         and the number of file rows transformed per chunk
+    # Output: Generator of (CustomerID, ProductID, OrderDate, QuantityOrdered) per order line
+    #
+    # Columnar version of resolving generate_order_lines: each chunk is read into pandas columns, the
+    # ';' separated columns are exploded together, dates and quantities are converted once per distinct
+    # value and names are mapped to ids with an index lookup. Yields exactly the rows of the line engine.
+
+    customer_index = pd.Index(list(customer_dict))
+    customer_ids = np.array(list(customer_dict.values()))
+    prd_index = pd.Index(list(prd_dict))
+    prd_ids = np.array(list(prd_dict.values()))
+    order_dates = {}
+
+    with open(data_filename, 'rb') as f:
+        header = f.readline()
+
+        if not header:
+            raise ValueError("CSV file is empty.")
+
+        if byte_range is None:
+            byte_range = (f.tell(), os.path.getsize(data_filename))
+        f.seek(byte_range[0])
+
+        chunks = pd.read_csv(ByteRangeReader(f, byte_range[1]), sep='\t', header=None, usecols=[0, 5, 9, 10],
+                             dtype=str, keep_default_na=False, quoting=csv.QUOTE_NONE, encoding='utf-8',
+                             chunksize=chunk_rows)
+        for chunk in chunks:
+            order_lines = pd.DataFrame({
+                "name": chunk[0].str.strip(),
+                "prd_name": chunk[5].str.strip().str.split(';'),
+                "qt_ord": chunk[9].str.strip().str.split(';'),
+                "order_dt": chunk[10].str.strip().str.split(';'),
+            }).explode(["prd_name", "qt_ord", "order_dt"])
+
+            for order_dt in order_lines["order_dt"].unique():
+                if order_dt not in order_dates:
+                    order_dates[order_dt] = datetime.datetime.strptime(order_dt, '%Y%m%d').strftime('%Y-%m-%d')
+            quantities = {qt_ord: int(qt_ord) for qt_ord in order_lines["qt_ord"].unique()}
+
+            customer_pos = customer_index.get_indexer(order_lines["name"])
+            if (customer_pos < 0).any():
+                raise KeyError(order_lines["name"].iloc[int(np.argmax(customer_pos < 0))])
+            prd_pos = prd_index.get_indexer(order_lines["prd_name"])
+            if (prd_pos < 0).any():
+                raise KeyError(order_lines["prd_name"].iloc[int(np.argmax(prd_pos < 0))])
+
+            yield from zip(customer_ids[customer_pos].tolist(),
+                           prd_ids[prd_pos].tolist(),
+                           order_lines["order_dt"].map(order_dates).tolist(),
+                           order_lines["qt_ord"].map(quantities).tolist())
+
+def resolve_order_rows(data_filename, customer_dict, prd_dict, byte_range=None, engine="rows"):
+    # Inputs: Name of the data file, lookup dictionaries, optionally a byte range and the transform
+    #         engine: "rows" parses line by line, "columnar" transforms pandas chunks
+    # Output: Generator of (CustomerID, ProductID, OrderDate, QuantityOrdered) per order line
+
+    if engine == "columnar":
+        return generate_order_rows_columnar(data_filename, customer_dict, prd_dict, byte_range)
+    return ((customer_dict[name], prd_dict[prd_name_e],order_dt1,qt_ord_e) for name, prd_name_e,order_dt1,qt_ord_e in generate_order_lines(data_filename, byte_range))
+
+
+## -- Parallel OrderDetail loading -- ##
+
+orderdetail_worker = {}
+
+def init_orderdetail_worker(normalized_database_filename, customer_dict, prd_dict, engine):
+    # Runs once in every worker process: one database connection is kept for all its chunks
+    connection_stats.update(connections=0, connect_seconds=0.0)
+    conn_norm = create_connection(normalized_database_filename, delete_db=False)
+    orderdetail_worker.update(conn=conn_norm, customer_dict=customer_dict, prd_dict=prd_dict, engine=engine)
+    multiprocessing.util.Finalize(None, conn_norm.close, exitpriority=10)
 
-def step11_create_orderdetail_table(data_filename, normalized_database_filename, batch_size = 50000):
-    # Inputs: Name of the data and normalized database filename
+def load_orderdetail_chunk(data_filename, chunk_id, byte_range):
+    # Inputs: Name of the data file, chunk number and its byte range
+    # Output: (worker pid, rows staged, worker connection stats) after parsing, resolving and copying the chunk
+
+    conn_norm = orderdetail_worker["conn"]
+    order_rows = ((chunk_id,) + row_data for row_data in resolve_order_rows(data_filename, orderdetail_worker["customer_dict"],
+                                                                            orderdetail_worker["prd_dict"], byte_range,
+                                                                            orderdetail_worker["engine"]))
+    with conn_norm:
+        cur = conn_norm.cursor()
+        row_count = copy_rows(cur, "OrderDetail_parallel_stage", ["ChunkID", "CustomerID", "ProductID", "OrderDate", "QuantityOrdered"], order_rows)
+        cur.close()
+
+    return os.getpid(), row_count, dict(connection_stats)
+
+worker_connection_stats = {}
+
+def load_orderdetail_parallel(data_filename, normalized_database_filename, conn_norm, customer_dict, prd_dict, workers,
+                              byte_range=None, engine="rows"):
+    # Inputs: Name of the data and normalized database filename, open connection, lookup dictionaries,
+    #         the number of worker processes, optionally the byte range to load and the transform engine
+    # Output: Number of rows inserted into OrderDetail
+    #
+    # Workers parse their byte ranges and COPY the resolved rows into a shared UNLOGGED staging table
+    # concurrently. The final merge replays the rows in file order (chunk, then copy order), so the
+    # ids and the rows kept on (CustomerID, ProductID) conflicts are the same as the serial load.
+    # The merge runs in conn_norm's open transaction; the staging table is committed on a connection
+    # of its own so the workers see it.
+
+    with contextlib.closing(create_connection(normalized_database_filename, delete_db=False)) as conn_stage, conn_stage:
+        create_table(conn_stage, """ CREATE UNLOGGED TABLE OrderDetail_parallel_stage(
+            ChunkID integer not null,
+            CustomerID integer not null,
+            ProductID integer not null,
+            OrderDate TIMESTAMP not null,
+            QuantityOrdered integer not null,
+            LineSeq BIGSERIAL not null
+        )""", drop_table_name="OrderDetail_parallel_stage")
+
+    byte_ranges = split_data_file(data_filename, workers * 4, byte_range)
+    with multiprocessing.Pool(workers, initializer=init_orderdetail_worker,
+                              initargs=(normalized_database_filename, customer_dict, prd_dict, engine)) as pool:
+        chunk_results = pool.starmap(load_orderdetail_chunk,
+                                     [(data_filename, chunk_id, byte_range) for chunk_id, byte_range in enumerate(byte_ranges)])
+
+    worker_rows = {}
+    for pid, row_count, worker_stats in chunk_results:
+        worker_rows[pid] = worker_rows.get(pid, 0) + row_count
+        worker_connection_stats[pid] = worker_stats
+    for worker_number, pid in enumerate(sorted(worker_rows)):
+        print(f"worker {worker_number} (pid {pid}) staged {worker_rows[pid]} rows")
+        loader_metrics.emit("worker", worker=worker_number, pid=pid, rows=worker_rows[pid])
+    loader_metrics.add_bytes_read(sum(end - start for start, end in byte_ranges))
+
+    cur = conn_norm.cursor()
+    cur.execute(""" INSERT INTO OrderDetail(CustomerID,ProductID,OrderDate,QuantityOrdered)
+        SELECT CustomerID,ProductID,OrderDate,QuantityOrdered FROM OrderDetail_parallel_stage
+        ORDER BY ChunkID, LineSeq
+        ON CONFLICT (CustomerID, ProductID) DO NOTHING""")
+    row_count_total = cur.rowcount
+    cur.execute("DROP TABLE OrderDetail_parallel_stage")
+    cur.close()
+
+    return row_count_total
+
+
+@loader_metrics.instrumented_step
+def step11_create_orderdetail_table(data_filename, normalized_database_filename, batch_size = 50000, bulk=False, workers=1,
+                                    byte_range=None, incremental=False, conn_norm=None, engine="rows"):
+    # Inputs: Name of the data and normalized database filename, optionally a byte range to load
+    #         and the transform engine ("rows" or "columnar", see resolve_order_rows)
     # Output: None
 
     ## Creating Table ##
-    conn_norm = create_connection(normalized_database_filename, delete_db=False)
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
     create_table_ord = """ CREATE TABLE IF NOT EXISTS OrderDetail(
         OrderID SERIAL not null Primary Key,
         CustomerID integer not null,
@@ -391,70 +822,560 @@ def step11_create_orderdetail_table(data_filename, normalized_database_filename,
         FOREIGN KEY(CustomerID) REFERENCES Customer(CustomerID),
         FOREIGN KEY(ProductID) REFERENCES Product(ProductID)
     )"""
-    create_table(conn_norm, create_table_ord, drop_table_name="OrderDetail")
+    create_table(conn_norm, create_table_ord, drop_table_name=None if incremental else "OrderDetail")
     print("table created")
 
     ## Extracting Data ##
+    prd_dict = step10_create_product_to_productid_dictionary(normalized_database_filename, conn_norm)
+    customer_dict = step6_create_customer_to_customerid_dictionary(normalized_database_filename, conn_norm)
+
+    # Bytes this step reads, for the progress estimate in the batch events
+    if byte_range is None:
+        data_size = os.path.getsize(data_filename)
+    else:
+        data_size = byte_range[1] - byte_range[0]
+    bytes_start = loader_metrics.counters["bytes_read"]
+
+    if workers > 1:
+        ## Parsing and loading byte-range chunks in worker processes ##
+        with step_transaction(conn_norm, own_connection):
+            row_count_total = load_orderdetail_parallel(data_filename, normalized_database_filename, conn_norm,
+                                                        customer_dict, prd_dict, workers, byte_range, engine)
+        loader_metrics.add_rows(row_count_total)
+        print(f"inserted {row_count_total} rows")
+
+        if own_connection:
+            conn_norm.close()
+        return
+
+    if bulk:
+        ## Streaming all order lines through a single COPY ##
+        order_rows = loader_metrics.track_batches(resolve_order_rows(data_filename, customer_dict, prd_dict, byte_range, engine),
+                                                  batch_size, data_size)
+        with step_transaction(conn_norm, own_connection):
+            row_count_total = copy_insert(conn_norm, "OrderDetail", ["CustomerID", "ProductID", "OrderDate", "QuantityOrdered"],
+                                          order_rows, ["CustomerID", "ProductID"])
+        print(f"inserted {row_count_total} rows")
+
+        if own_connection:
+            conn_norm.close()
+        return
 
-    
-    prd_dict = step10_create_product_to_productid_dictionary(normalized_database_filename)
-    customer_dict = step6_create_customer_to_customerid_dictionary(normalized_database_filename)
     row_count_total = 0
     order_list = []
-    
-    with open(data_filename, 'r') as f:
-        lines = f.readlines()
 
-        if not lines:
-            raise ValueError("CSV file is empty.")
-        
-        for line in lines[1:]:
-            val_list = line.strip().split('\t')
-            name = val_list[0].strip()
-            prd_name = val_list[5].strip().split(';')
-            order_dt = val_list[10].strip().split(';')
-            qt_ord = val_list[9].strip().split(';')
-
-            for i in range(len(prd_name)):
-                order_dt1 = datetime.datetime.strptime(order_dt[i], '%Y%m%d').strftime('%Y-%m-%d')
-                row_data = tuple((name,prd_name[i],order_dt1,int(qt_ord[i])))
-                order_list.append(row_data)
-
-                row_count_total += 1
-
-            if row_count_total >= batch_size:
-                order_list1 = [(customer_dict[name], prd_dict[prd_name_e],order_dt1,qt_ord_e) for name, prd_name_e,order_dt1,qt_ord_e in order_list]
-                print(order_list1[0:2])
-                
-                with conn_norm:
-                    ord_insert = """ INSERT INTO OrderDetail(CustomerID,ProductID,OrderDate,QuantityOrdered) 
-                        VALUES(%s,%s,%s,%s)
-                        ON CONFLICT (CustomerID, ProductID) DO NOTHING"""
-                    cur = conn_norm.cursor()
-                    cur.executemany(ord_insert, order_list1)
-                    cur.close()
-                    conn_norm.commit()
-
-                print(f"inserted {row_count_total} rows")
-                row_count_total = 0
-                order_list.clear()
-
-        if row_count_total:
-            order_list1 = [(customer_dict[name], prd_dict[prd_name_e],order_dt1,qt_ord_e) for name, prd_name_e,order_dt1,qt_ord_e in order_list]
-
-            with conn_norm:
-                    ord_insert = """INSERT INTO OrderDetail(CustomerID,ProductID,OrderDate,QuantityOrdered) 
-                        VALUES(%s,%s,%s,%s)
-                        ON CONFLICT (CustomerID, ProductID) DO NOTHING"""
-                    cur = conn_norm.cursor()
-                    cur.executemany(ord_insert, order_list1)
-                    cur.close()
-                    conn_norm.commit()
+    for row_data in resolve_order_rows(data_filename, customer_dict, prd_dict, byte_range, engine):
+        order_list.append(row_data)
+        row_count_total += 1
+
+        if row_count_total >= batch_size:
+            print(order_list[0:2])
+
+            batch_start = time.perf_counter()
+            with step_transaction(conn_norm, own_connection):
+                ord_insert = """ INSERT INTO OrderDetail(CustomerID,ProductID,OrderDate,QuantityOrdered) 
+                    VALUES(%s,%s,%s,%s)
+                    ON CONFLICT (CustomerID, ProductID) DO NOTHING"""
+                cur = conn_norm.cursor()
+                cur.executemany(ord_insert, order_list)
+                cur.close()
+            loader_metrics.record_batch(row_count_total, time.perf_counter() - batch_start, data_size, bytes_start)
 
             print(f"inserted {row_count_total} rows")
-        
+            row_count_total = 0
+            order_list.clear()
+
+    if row_count_total:
+        batch_start = time.perf_counter()
+        with step_transaction(conn_norm, own_connection):
+                ord_insert = """INSERT INTO OrderDetail(CustomerID,ProductID,OrderDate,QuantityOrdered) 
+                    VALUES(%s,%s,%s,%s)
+                    ON CONFLICT (CustomerID, ProductID) DO NOTHING"""
+                cur = conn_norm.cursor()
+                cur.executemany(ord_insert, order_list)
+                cur.close()
+        loader_metrics.record_batch(row_count_total, time.perf_counter() - batch_start, data_size, bytes_start)
+
+        print(f"inserted {row_count_total} rows")
+
+    if own_connection:
+        # Keeps the new table when no batch committed it
+        conn_norm.commit()
+        conn_norm.close()
+
+@loader_metrics.instrumented_step
+def step12_create_rollup_views(normalized_database_filename, conn_norm=None):
+    # Inputs: Name of the normalized database, optionally an open connection
+    # Output: None
+    #
+    # Rebuilds the pre-aggregated sales materialized views from the loaded tables. A full load drops
+    # them along with OrderDetail, so they are rebuilt after every load, incremental or not.
+
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+
+    with step_transaction(conn_norm, own_connection):
+        rollups.build_rollups(conn_norm)
+    loader_metrics.add_rows(len(rollups.rollup_views))
+
+    if own_connection:
+        conn_norm.close()
+
+# Indexes the generated joins and date filters rely on, beyond the primary keys and UNIQUE
+# constraints. OrderDetail.CustomerID is already the leading column of UNIQUE (CustomerID, ProductID).
+supporting_indexes = [
+    ("ix_orderdetail_productid", "OrderDetail", "ProductID"),
+    ("ix_orderdetail_orderdate", "OrderDetail", "OrderDate"),
+    ("ix_customer_countryid", "Customer", "CountryID"),
+    ("ix_country_regionid", "Country", "RegionID"),
+    ("ix_product_productcategoryid", "Product", "ProductCategoryID"),
+]
+
+@loader_metrics.instrumented_step
+def step13_create_indexes(normalized_database_filename, conn_norm=None):
+    # Inputs: Name of the normalized database, optionally an open connection
+    # Output: None
+    #
+    # Creates the supporting indexes once the rows are in, so the bulk load does not maintain them
+    # row by row, and refreshes the planner statistics of the indexed tables. A full load drops them
+    # along with their tables; an incremental load finds them in place.
+
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+
+    with step_transaction(conn_norm, own_connection):
+        cur = conn_norm.cursor()
+        for index_name, table_name, column_name in supporting_indexes:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name}({column_name})")
+        for table_name in dict.fromkeys(table_name for _, table_name, _ in supporting_indexes):
+            cur.execute(f"ANALYZE {table_name}")
+        cur.close()
+    loader_metrics.add_rows(len(supporting_indexes))
+    print(f"{len(supporting_indexes)} supporting indexes in place")
+
+    if own_connection:
+        conn_norm.close()
+
+
+## -- ELT load -- ##
+
+raw_columns = ["Name", "Address", "City", "Country", "Region", "ProductName", "ProductCategory",
+               "ProductCategoryDescription", "ProductUnitPrice", "QuantityOrdered", "OrderDate"]
+
+elt_create_tables = [
+    ("Region", """ CREATE TABLE Region(
+        RegionID SERIAL not null,
+        Region TEXT not null
+    )"""),
+    ("Country", """ CREATE TABLE Country(
+        CountryID SERIAL not null,
+        Country Text not null,
+        RegionID integer not null
+    )"""),
+    ("Customer", """ CREATE TABLE Customer(
+        CustomerID SERIAL not null,
+        FirstName Text not null,
+        LastName Text not null,
+        Address Text not null,
+        City Text not null,
+        CountryID integer not null
+    )"""),
+    ("ProductCategory", """ CREATE TABLE ProductCategory(
+        ProductCategoryID SERIAL not null,
+        ProductCategory Text not null,
+        ProductCategoryDescription Text not null
+    )"""),
+    ("Product", """ CREATE TABLE Product(
+        ProductID SERIAL not null,
+        ProductName Text not null,
+        ProductUnitPrice Real not null,
+        ProductCategoryID integer not null
+    )"""),
+    ("OrderDetail", """ CREATE TABLE OrderDetail(
+        OrderID SERIAL not null,
+        CustomerID integer not null,
+        ProductID integer not null,
+        OrderDate TIMESTAMP not null,
+        QuantityOrdered integer not null
+    )"""),
+]
+
+# Ids are numbered the way the SERIAL columns number the rows in the step functions: dimension
+# rows in their sorted order (ties in first-seen order), order lines in file order. Rows the steps
+# skip with ON CONFLICT DO NOTHING still use up an id there, so they are numbered here and dropped.
+elt_insert_tables = [
+    ("Region", """ INSERT INTO Region(RegionID, Region)
+        SELECT row_number() OVER (ORDER BY Region COLLATE "C"), Region
+        FROM (SELECT DISTINCT Region FROM RawOrders) regions"""),
+    ("Country", """ INSERT INTO Country(CountryID, Country, RegionID)
+        SELECT row_number() OVER (ORDER BY c.Country COLLATE "C", c.FirstSeen), c.Country, r.RegionID
+        FROM (SELECT Country, Region, min(LineNo) AS FirstSeen FROM RawOrders GROUP BY Country, Region) c
+        JOIN Region r ON r.Region = c.Region"""),
+    ("Customer", """ INSERT INTO Customer(CustomerID, FirstName, LastName, Address, City, CountryID)
+        SELECT CustomerID, FirstName, LastName, Address, City, CountryID FROM (
+            SELECT row_number() OVER (ORDER BY (c.FirstName || c.LastName) COLLATE "C", c.FirstSeen) AS CustomerID,
+                   row_number() OVER (PARTITION BY c.FirstName, c.LastName, c.Address ORDER BY c.FirstSeen) AS Attempt,
+                   c.FirstName, c.LastName, c.Address, c.City, co.CountryID
+            FROM (SELECT split_part(Name, ' ', 1) AS FirstName, substr(Name, strpos(Name, ' ') + 1) AS LastName,
+                         Address, City, Country, min(LineNo) AS FirstSeen
+                  FROM RawOrders GROUP BY 1, 2, 3, 4, 5) c
+            JOIN (SELECT Country, max(CountryID) AS CountryID FROM Country GROUP BY Country) co ON co.Country = c.Country
+        ) customers WHERE Attempt = 1"""),
+    ("ProductCategory", """ INSERT INTO ProductCategory(ProductCategoryID, ProductCategory, ProductCategoryDescription)
+        SELECT ProductCategoryID, ProductCategory, ProductCategoryDescription FROM (
+            SELECT row_number() OVER (ORDER BY ProductCategory COLLATE "C", FirstSeen) AS ProductCategoryID,
+                   row_number() OVER (PARTITION BY ProductCategory ORDER BY FirstSeen) AS Attempt,
+                   ProductCategory, ProductCategoryDescription
+            FROM (SELECT ProductCategory, ProductCategoryDescription, min(ARRAY[LineNo, ItemNo]) AS FirstSeen
+                  FROM RawOrderLines GROUP BY ProductCategory, ProductCategoryDescription) c
+        ) categories WHERE Attempt = 1"""),
+    ("Product", """ INSERT INTO Product(ProductID, ProductName, ProductUnitPrice, ProductCategoryID)
+        SELECT ProductID, ProductName, ProductUnitPrice, ProductCategoryID FROM (
+            SELECT row_number() OVER (ORDER BY p.ProductName COLLATE "C", p.FirstSeen) AS ProductID,
+                   row_number() OVER (PARTITION BY p.ProductName ORDER BY p.FirstSeen) AS Attempt,
+                   p.ProductName, p.ProductUnitPrice::real AS ProductUnitPrice, pc.ProductCategoryID
+            FROM (SELECT ProductName, ProductUnitPrice, ProductCategory, min(ARRAY[LineNo, ItemNo]) AS FirstSeen
+                  FROM RawOrderLines GROUP BY ProductName, ProductUnitPrice, ProductCategory) p
+            JOIN ProductCategory pc ON pc.ProductCategory = p.ProductCategory
+        ) products WHERE Attempt = 1"""),
+    ("OrderDetail", """ INSERT INTO OrderDetail(OrderID, CustomerID, ProductID, OrderDate, QuantityOrdered)
+        SELECT OrderID, CustomerID, ProductID, OrderDate, QuantityOrdered FROM (
+            SELECT OrderID, CustomerID, ProductID, OrderDate, QuantityOrdered,
+                   row_number() OVER (PARTITION BY CustomerID, ProductID ORDER BY OrderID) AS Attempt
+            FROM (
+                SELECT row_number() OVER (ORDER BY l.LineNo, l.ItemNo) AS OrderID, c.CustomerID, p.ProductID,
+                       to_date(l.OrderDate, 'YYYYMMDD')::timestamp AS OrderDate, l.QuantityOrdered::integer AS QuantityOrdered
+                FROM RawOrderLines l
+                JOIN (SELECT FirstName || ' ' || LastName AS Name, max(CustomerID) AS CustomerID
+                      FROM Customer GROUP BY 1) c ON c.Name = l.Name
+                JOIN Product p ON p.ProductName = l.ProductName
+            ) order_lines
+        ) orders WHERE Attempt = 1"""),
+]
+
+elt_constraints = [
+    ("Region", "RegionID", """ALTER TABLE Region ADD PRIMARY KEY (RegionID)"""),
+    ("Country", "CountryID", """ALTER TABLE Country ADD PRIMARY KEY (CountryID),
+        ADD FOREIGN KEY(RegionID) REFERENCES Region(RegionID)"""),
+    ("Customer", "CustomerID", """ALTER TABLE Customer ADD PRIMARY KEY (CustomerID),
+        ADD UNIQUE (FirstName, LastName, Address),
+        ADD FOREIGN KEY(CountryID) REFERENCES Country(CountryID)"""),
+    ("ProductCategory", "ProductCategoryID", """ALTER TABLE ProductCategory ADD PRIMARY KEY (ProductCategoryID),
+        ADD UNIQUE(ProductCategory)"""),
+    ("Product", "ProductID", """ALTER TABLE Product ADD PRIMARY KEY (ProductID),
+        ADD UNIQUE (ProductName),
+        ADD FOREIGN KEY(ProductCategoryID) REFERENCES ProductCategory(ProductCategoryID)"""),
+    ("OrderDetail", "OrderID", """ALTER TABLE OrderDetail ADD PRIMARY KEY (OrderID),
+        ADD UNIQUE (CustomerID, ProductID),
+        ADD FOREIGN KEY(CustomerID) REFERENCES Customer(CustomerID),
+        ADD FOREIGN KEY(ProductID) REFERENCES Product(ProductID)"""),
+]
+
+def add_elt_constraints(conn_norm):
+    # Keys, UNIQUE and FOREIGN KEY constraints of tables created with elt_create_tables and filled
+    # with explicit ids, and their SERIAL sequences moved past the largest id. The caller commits.
+    cur = conn_norm.cursor()
+    for table_name, id_column, constraint_sql in elt_constraints:
+        cur.execute(constraint_sql)
+        cur.execute(f"""SELECT setval(pg_get_serial_sequence('{table_name}', '{id_column.lower()}'),
+                                      coalesce(max({id_column}), 0) + 1, false) FROM {table_name}""")
+    cur.close()
+
+@loader_metrics.instrumented_step
+def elt_load(data_filename, normalized_database_filename, conn_norm=None):
+    # Inputs: Name of the data and normalized database filename, optionally an open connection
+    # Output: None
+    #
+    # Alternative to the step functions: the raw rows are copied into an UNLOGGED staging table and
+    # every normalized table is built from it with INSERT ... SELECT inside Postgres. Keys, UNIQUE and
+    # FOREIGN KEY constraints are added once the data is in. Produces the same tables and ids.
+
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+    step_timings = []
+
+    with loader_step(conn_norm, "elt_stage_raw_rows", step_timings):
+        create_table(conn_norm, f""" CREATE UNLOGGED TABLE RawOrders(
+            LineNo BIGSERIAL not null,
+            {", ".join(column + " Text" for column in raw_columns)}
+        )""", drop_table_name="RawOrders")
+        cur = conn_norm.cursor()
+        row_count = copy_rows(cur, "RawOrders", raw_columns,
+                              (val_list[:len(raw_columns)] for val_list in read_data_rows(data_filename)))
+        loader_metrics.add_rows(row_count)
+        print(f"staged {row_count} raw rows")
+
+        cur.execute("DROP TABLE IF EXISTS RawOrderLines")
+        cur.execute(""" CREATE UNLOGGED TABLE RawOrderLines AS
+            SELECT r.LineNo, item.ItemNo, btrim(r.Name) AS Name, item.ProductName, item.ProductCategory,
+                   item.ProductCategoryDescription, item.ProductUnitPrice, item.QuantityOrdered, item.OrderDate
+            FROM RawOrders r
+            CROSS JOIN LATERAL unnest(
+                string_to_array(btrim(r.ProductName), ';'),
+                string_to_array(btrim(r.ProductCategory), ';'),
+                string_to_array(btrim(r.ProductCategoryDescription), ';'),
+                string_to_array(btrim(r.ProductUnitPrice), ';'),
+                string_to_array(btrim(r.QuantityOrdered), ';'),
+                string_to_array(btrim(r.OrderDate), ';')
+            ) WITH ORDINALITY AS item(ProductName, ProductCategory, ProductCategoryDescription,
+                                      ProductUnitPrice, QuantityOrdered, OrderDate, ItemNo)""")
+        print(f"staged {cur.rowcount} raw order lines")
+        cur.close()
+
+    with loader_step(conn_norm, "elt_create_tables", step_timings):
+        for table_name, create_table_sql in elt_create_tables:
+            create_table(conn_norm, create_table_sql, drop_table_name=table_name)
+
+    for table_name, insert_sql in elt_insert_tables:
+        with loader_step(conn_norm, f"elt_insert_{table_name}", step_timings):
+            cur = conn_norm.cursor()
+            cur.execute(insert_sql)
+            print(f"{table_name}: inserted {cur.rowcount} rows")
+            cur.close()
+
+    with loader_step(conn_norm, "elt_constraints", step_timings):
+        add_elt_constraints(conn_norm)
+        cur = conn_norm.cursor()
+        cur.execute("DROP TABLE RawOrderLines")
+        cur.execute("DROP TABLE RawOrders")
+        cur.close()
+
+    with loader_step(conn_norm, "step12_create_rollup_views", step_timings):
+        step12_create_rollup_views(normalized_database_filename, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step13_create_indexes", step_timings):
+        step13_create_indexes(normalized_database_filename, conn_norm=conn_norm)
+
+    bump_load_generation(conn_norm)
+    print_connection_report(step_timings)
+
+    if own_connection:
+        conn_norm.close()
+
+
+## -- Full and incremental loads -- ##
+
+def bump_load_generation(conn_norm):
+    # Increments the single row LoadGeneration counter once a load has committed. The app keys its
+    # query result cache on this value, so every load invalidates the results cached before it.
+    create_table_generation = """ CREATE TABLE IF NOT EXISTS LoadGeneration(
+        Id integer not null Primary Key default 1 CHECK (Id = 1),
+        Generation bigint not null,
+        LoadedAt TIMESTAMP not null default now()
+    )"""
+    create_table(conn_norm, create_table_generation)
+
+    with conn_norm:
+        cur = conn_norm.cursor()
+        cur.execute(""" INSERT INTO LoadGeneration(Id, Generation, LoadedAt) VALUES(1, 1, now())
+            ON CONFLICT (Id) DO UPDATE SET Generation = LoadGeneration.Generation + 1, LoadedAt = EXCLUDED.LoadedAt
+            RETURNING Generation""")
+        print(f"load generation {cur.fetchone()[0]}")
+        cur.close()
+
+def populate_normalized_database(data_filename, normalized_database_filename, bulk=False, workers=1, byte_range=None,
+                                 conn_norm=None, engine="rows"):
+    # Inputs: Name of the data and normalized database filename, load options, optionally a byte range
+    #         and an open connection to run on
+    # Output: None
+    #
+    # Without a byte range every table is dropped and rebuilt from the whole file. With one, only the
+    # rows in that range are read: new dimension members are added and new order lines are appended.
+    # Every step runs on the same connection and is committed before the next one starts.
+
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+    incremental = byte_range is not None
+    step_timings = []
+
+    # One streaming pass extracts every dimension table; the fact table streams the file once more
+    # after the dimension ids it resolves against have been assigned by the database.
+    extract_start = time.perf_counter()
+    dimension_data = extract_dimension_data(data_filename, byte_range)
+    step_timings.append(("extract_dimension_data", time.perf_counter() - extract_start))
+
+    with loader_step(conn_norm, "step1_create_region_table", step_timings):
+        step1_create_region_table(data_filename, normalized_database_filename, dimension_data, bulk=bulk,
+                                  incremental=incremental, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step3_create_country_table", step_timings):
+        step3_create_country_table(data_filename, normalized_database_filename, dimension_data, bulk=bulk,
+                                   incremental=incremental, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step5_create_customer_table", step_timings):
+        step5_create_customer_table(data_filename, normalized_database_filename, dimension_data, bulk=bulk,
+                                    incremental=incremental, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step7_create_productcategory_table", step_timings):
+        step7_create_productcategory_table(data_filename, normalized_database_filename, dimension_data, bulk=bulk,
+                                           incremental=incremental, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step9_create_product_table", step_timings):
+        step9_create_product_table(data_filename, normalized_database_filename, dimension_data, bulk=bulk,
+                                   incremental=incremental, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step11_create_orderdetail_table", step_timings):
+        step11_create_orderdetail_table(data_filename, normalized_database_filename, bulk=bulk, workers=workers,
+                                        byte_range=byte_range, incremental=incremental, conn_norm=conn_norm,
+                                        engine=engine)
+    with loader_step(conn_norm, "step12_create_rollup_views", step_timings):
+        step12_create_rollup_views(normalized_database_filename, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step13_create_indexes", step_timings):
+        step13_create_indexes(normalized_database_filename, conn_norm=conn_norm)
+
+    bump_load_generation(conn_norm)
+    print_connection_report(step_timings, worker_connection_stats)
+
+    if own_connection:
+        conn_norm.close()
+
+def file_fingerprint(data_filename, offset, sample_size=65536):
+    # Hash of the start of the file and of the bytes just before offset. A file that was only
+    # appended to since the checkpoint keeps the same fingerprint for the checkpointed offset.
+    fingerprint = hashlib.md5()
+    with open(data_filename, 'rb') as f:
+        fingerprint.update(f.read(min(sample_size, offset)))
+        f.seek(max(offset - sample_size, 0))
+        fingerprint.update(f.read(offset - max(offset - sample_size, 0)))
+    return fingerprint.hexdigest()
+
+def incremental_load(data_filename, normalized_database_filename, bulk=False, workers=1, engine="rows", elt=False):
+    # Inputs: Name of the data and normalized database filename and load options
+    # Output: None
+    #
+    # Loads only the rows appended to data_filename since the last checkpoint. Falls back to a full
+    # rebuild when there is no checkpoint or the already loaded part of the file has changed.
+
+    conn_norm = create_connection(normalized_database_filename, delete_db=False)
+    create_table_checkpoint = """ CREATE TABLE IF NOT EXISTS LoadCheckpoint(
+        DataFile Text not null Primary Key,
+        ByteOffset bigint not null,
+        Fingerprint Text not null,
+        MaxOrderDate TIMESTAMP,
+        LoadedAt TIMESTAMP not null default now()
+    )"""
+    create_table(conn_norm, create_table_checkpoint)
+
+    data_name = os.path.basename(data_filename)
+    file_size = os.path.getsize(data_filename)
+    with conn_norm:
+        cur = conn_norm.cursor()
+        cur.execute("""SELECT ByteOffset, Fingerprint FROM LoadCheckpoint WHERE DataFile = %s""", (data_name,))
+        checkpoint = cur.fetchone()
+        cur.close()
+
+    if checkpoint is None or checkpoint[0] > file_size or checkpoint[1] != file_fingerprint(data_filename, checkpoint[0]):
+        print("no usable checkpoint, running a full load")
+        if elt:
+            elt_load(data_filename, normalized_database_filename, conn_norm=conn_norm)
+        else:
+            populate_normalized_database(data_filename, normalized_database_filename, bulk=bulk, workers=workers,
+                                         conn_norm=conn_norm, engine=engine)
+    elif checkpoint[0] == file_size:
+        print("no new rows since the last load")
+    else:
+        print(f"loading bytes {checkpoint[0]} to {file_size}")
+        populate_normalized_database(data_filename, normalized_database_filename, bulk=bulk, workers=workers,
+                                     byte_range=(checkpoint[0], file_size), conn_norm=conn_norm,
+                                     engine=engine)
+
+    with conn_norm:
+        cur = conn_norm.cursor()
+        cur.execute(""" INSERT INTO LoadCheckpoint(DataFile, ByteOffset, Fingerprint, MaxOrderDate, LoadedAt)
+            VALUES(%s, %s, %s, (SELECT max(OrderDate) FROM OrderDetail), now())
+            ON CONFLICT (DataFile) DO UPDATE SET ByteOffset = EXCLUDED.ByteOffset,
+                Fingerprint = EXCLUDED.Fingerprint, MaxOrderDate = EXCLUDED.MaxOrderDate, LoadedAt = EXCLUDED.LoadedAt""",
+            (data_name, file_size, file_fingerprint(data_filename, file_size)))
+        cur.close()
+    print("checkpoint saved")
+
+    conn_norm.close()
+
+
+## -- Snapshots -- ##
+
+@loader_metrics.instrumented_step
+def step14_export_snapshot(normalized_database_filename, snapshot_directory, conn_norm=None):
+    # Inputs: Name of the normalized database, the snapshot directory, optionally an open connection
+    # Output: None
+    #
+    # Writes the loaded tables to a Parquet snapshot (see snapshots.py) that restore_snapshot and
+    # duckdb_backend.py --from-snapshot load without parsing data.csv again.
+    import snapshots
+
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+    conn_norm.commit()
+
+    manifest = snapshots.export_snapshot(conn_norm, snapshot_directory)
+    row_count = sum(entry["rows"] for entry in manifest["tables"].values())
+    loader_metrics.add_rows(row_count)
+    print(f"snapshot of {row_count} rows written to {snapshot_directory}")
+
+    if own_connection:
+        conn_norm.close()
+
+@loader_metrics.instrumented_step
+def restore_snapshot(snapshot_directory, normalized_database_filename, conn_norm=None):
+    # Inputs: Snapshot directory written by step14_export_snapshot, the normalized database filename,
+    #         optionally an open connection
+    # Output: None
+    #
+    # Full load from a snapshot instead of data.csv: the tables are created as in the ELT load,
+    # filled with COPY from the Parquet files, then given their constraints, rollups and indexes.
+    import snapshots
+
+    conn_norm, own_connection = step_connection(normalized_database_filename, conn_norm)
+    manifest = snapshots.read_manifest(snapshot_directory)
+    step_timings = []
+
+    with loader_step(conn_norm, "restore_create_tables", step_timings):
+        for table_name, create_table_sql in elt_create_tables:
+            create_table(conn_norm, create_table_sql, drop_table_name=table_name)
+
+    for table_name in snapshots.TABLE_ORDER:
+        with loader_step(conn_norm, f"restore_{table_name}", step_timings):
+            cur = conn_norm.cursor()
+            row_count = snapshots.copy_table(cur, table_name, snapshots.read_table(snapshot_directory, table_name, manifest))
+            loader_metrics.add_rows(row_count)
+            print(f"{table_name}: restored {row_count} rows")
+            cur.close()
+
+    with loader_step(conn_norm, "elt_constraints", step_timings):
+        add_elt_constraints(conn_norm)
+    with loader_step(conn_norm, "step12_create_rollup_views", step_timings):
+        step12_create_rollup_views(normalized_database_filename, conn_norm=conn_norm)
+    with loader_step(conn_norm, "step13_create_indexes", step_timings):
+        step13_create_indexes(normalized_database_filename, conn_norm=conn_norm)
+
+    bump_load_generation(conn_norm)
+    print_connection_report(step_timings)
+
+    if own_connection:
         conn_norm.close()
 
-    
 
-step11_create_orderdetail_table(data_file, normalized_database)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load data.csv into the normalized Postgres tables")
+    parser.add_argument("--bulk", action="store_true",
+                        help="load with COPY FROM STDIN and a set-based merge instead of executemany")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes parsing and loading OrderDetail in parallel")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only load rows appended to data.csv since the last checkpoint")
+    parser.add_argument("--elt", action="store_true",
+                        help="full loads stage the raw rows and normalize them with SQL inside Postgres")
+    parser.add_argument("--engine", choices=["rows", "columnar"], default="rows",
+                        help="OrderDetail transform: line by line, or vectorized over pandas chunks")
+    parser.add_argument("--snapshot", help="after the load, write a Parquet snapshot of the tables to this directory")
+    parser.add_argument("--restore-snapshot", metavar="DIRECTORY",
+                        help="load the tables from a snapshot written with --snapshot instead of data.csv")
+    parser.add_argument("--events", help="write structured progress events as JSON lines to this file, - for stderr")
+    parser.add_argument("--profile", help="run under cProfile and dump the stats to this file")
+    args = parser.parse_args()
+
+    loader_metrics.configure_events(args.events)
+    with loader_metrics.profiled(args.profile):
+        if args.restore_snapshot:
+            restore_snapshot(args.restore_snapshot, normalized_database)
+        elif args.incremental:
+            incremental_load(data_file, normalized_database, bulk=args.bulk, workers=args.workers, engine=args.engine,
+                             elt=args.elt)
+        elif args.elt:
+            elt_load(data_file, normalized_database)
+        else:
+            populate_normalized_database(data_file, normalized_database, bulk=args.bulk, workers=args.workers,
+                                         engine=args.engine)
+        if args.snapshot:
+            step14_export_snapshot(normalized_database, args.snapshot)
+
+    loader_metrics.print_summary()
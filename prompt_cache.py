@@ -0,0 +1,105 @@
+import contextlib
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+
+def normalize_question(question):
+    """Questions differing only in case, spacing or trailing punctuation share a cache entry."""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?.!").strip().lower()
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class PromptCache:
+    """On-disk cache of question -> generated SQL that survives app restarts.
+
+    Entries are keyed on the normalized question, the model name, a hash of the schema given to the
+    model and a hash of prompt, the text the prompts are built from (template and settings). Entries
+    written for another schema or prompt are dropped when the cache is opened, and the least
+    recently used ones are evicted past max_entries. Hits and misses are counted in the same file so the hit rate
+    covers every run, not just the current process.
+    """
+
+    def __init__(self, path, schema, model, max_entries=1000, prompt=""):
+        self.path = path
+        self.schema_hash = text_hash(schema)
+        self.model = model
+        self.prompt_hash = text_hash(prompt)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        with self.lock, self.connect() as conn:
+            conn.execute(""" CREATE TABLE IF NOT EXISTS PromptSQL(
+                Key TEXT not null Primary Key,
+                Question TEXT not null,
+                SQL TEXT not null,
+                SchemaHash TEXT not null,
+                PromptHash TEXT not null default '',
+                Model TEXT not null,
+                CreatedAt REAL not null,
+                LastUsed REAL not null,
+                Hits INTEGER not null default 0
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS PromptSQL_LastUsed ON PromptSQL(LastUsed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS CacheStats(Name TEXT not null Primary Key, Value INTEGER not null)")
+            conn.execute("INSERT OR IGNORE INTO CacheStats VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+            # Files written before PromptHash existed get the column, their entries are dropped below
+            if "PromptHash" not in [row[1] for row in conn.execute("PRAGMA table_info(PromptSQL)")]:
+                conn.execute("ALTER TABLE PromptSQL ADD COLUMN PromptHash TEXT not null default ''")
+            conn.execute("DELETE FROM PromptSQL WHERE SchemaHash != ? OR PromptHash != ?",
+                         (self.schema_hash, self.prompt_hash))
+
+    @contextlib.contextmanager
+    def connect(self):
+        # A short lived connection per call, Streamlit runs every session on its own thread
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def key(self, question):
+        parts = [normalize_question(question), self.schema_hash, self.model, self.prompt_hash]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, question):
+        """Cached SQL for the question, None on a miss."""
+        key = self.key(question)
+        with self.lock, self.connect() as conn:
+            row = conn.execute("SELECT SQL FROM PromptSQL WHERE Key = ?", (key,)).fetchone()
+            if row is None:
+                conn.execute("UPDATE CacheStats SET Value = Value + 1 WHERE Name = 'misses'")
+                return None
+            conn.execute("UPDATE PromptSQL SET LastUsed = ?, Hits = Hits + 1 WHERE Key = ?", (time.time(), key))
+            conn.execute("UPDATE CacheStats SET Value = Value + 1 WHERE Name = 'hits'")
+            return row[0]
+
+    def put(self, question, sql):
+        now = time.time()
+        with self.lock, self.connect() as conn:
+            conn.execute(""" INSERT INTO PromptSQL(Key, Question, SQL, SchemaHash, PromptHash, Model, CreatedAt, LastUsed)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (Key) DO UPDATE SET SQL = excluded.SQL, CreatedAt = excluded.CreatedAt,
+                    LastUsed = excluded.LastUsed""",
+                (self.key(question), normalize_question(question), sql, self.schema_hash, self.prompt_hash, self.model,
+                 now, now))
+            evicted = conn.execute(""" DELETE FROM PromptSQL WHERE Key IN (
+                SELECT Key FROM PromptSQL ORDER BY LastUsed DESC LIMIT -1 OFFSET ?)""", (self.max_entries,)).rowcount
+            if evicted:
+                conn.execute("UPDATE CacheStats SET Value = Value + ? WHERE Name = 'evictions'", (evicted,))
+
+    def clear(self):
+        with self.lock, self.connect() as conn:
+            conn.execute("DELETE FROM PromptSQL")
+
+    def metrics(self):
+        with self.lock, self.connect() as conn:
+            metrics = dict(conn.execute("SELECT Name, Value FROM CacheStats").fetchall())
+            metrics["entries"] = conn.execute("SELECT count(*) FROM PromptSQL").fetchone()[0]
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_rate"] = metrics["hits"] / lookups if lookups else 0.0
+        return metrics
@@ -0,0 +1,106 @@
+import collections
+import re
+import threading
+import time
+
+
+QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+def normalize_sql(sql):
+    """Cache key for a query: whitespace collapsed, unquoted text lowercased, trailing semicolons dropped.
+
+    Quoted literals and identifiers are kept as written, everything else is case-insensitive in Postgres.
+    """
+    parts = QUOTED.split(sql.strip().rstrip(";").strip())
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part).lower() for i, part in enumerate(parts))
+
+def load_generation(conn):
+    """Current value of the token populate_database.py bumps after every load, 0 before the first one.
+
+    Leaves the caller's transaction as it was, a missing table is looked up rather than caught.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('LoadGeneration') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return 0
+        cur.execute("SELECT Generation FROM LoadGeneration")
+        row = cur.fetchone()
+    return row[0] if row else 0
+
+def frame_size(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class QueryCache:
+    """Process-wide LRU cache of query results, bounded by total DataFrame size in bytes.
+
+    Entries expire after ttl_seconds and are all dropped once the load generation moves on,
+    so a result never outlives the data it was computed from.
+    """
+
+    def __init__(self, ttl_seconds=600, max_bytes=64 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.generation = None
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def check_generation(self, generation):
+        # Caller holds the lock
+        if generation != self.generation:
+            if self.entries:
+                self.stats["invalidations"] += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.generation = generation
+
+    def get(self, sql, generation):
+        """Returns (DataFrame, age in seconds) for a fresh cached result, None otherwise."""
+        key = normalize_sql(sql)
+        with self.lock:
+            self.check_generation(generation)
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["stored_at"] > self.ttl_seconds:
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry["df"], time.time() - entry["stored_at"]
+
+    def put(self, sql, generation, df):
+        size = frame_size(df)
+        if size > self.max_bytes:
+            return
+        key = normalize_sql(sql)
+        with self.lock:
+            self.check_generation(generation)
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = {"df": df, "size": size, "stored_at": time.time()}
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def remove(self, key):
+        # Caller holds the lock
+        self.bytes -= self.entries.pop(key)["size"]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.stats)
+            metrics["entries"] = len(self.entries)
+            metrics["bytes"] = self.bytes
+            metrics["generation"] = self.generation
+        metrics["max_bytes"] = self.max_bytes
+        return metrics
@@ -0,0 +1,65 @@
+import threading
+import time
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class QueryTimeout(Exception):
+    # A backend without a statement_timeout of its own ran past the job's timeout
+    pass
+
+
+class QueryJob:
+    """A query running on a background thread, cancellable from the session that started it.
+
+    The worker attaches the connection it runs on, and cancel() sends a backend cancel on that
+    connection, so Postgres stops the statement instead of the app just abandoning the result.
+    """
+
+    def __init__(self, sql, timeout_seconds):
+        self.sql = sql
+        self.timeout_seconds = timeout_seconds
+        self.started = time.time()
+        self.finished = None
+        self.future = None
+        self.conn = None
+        self.cancel_requested = False
+        self.lock = threading.Lock()
+
+    def submit(self, executor, function, *args):
+        self.future = executor.submit(function, *args)
+        self.future.add_done_callback(self.finish)
+
+    def finish(self, future):
+        self.finished = time.time()
+
+    def attach(self, conn):
+        with self.lock:
+            self.conn = conn
+            cancel_requested = self.cancel_requested
+        if cancel_requested:
+            raise QueryCancelled()
+
+    def detach(self):
+        with self.lock:
+            self.conn = None
+
+    def check_cancelled(self):
+        # Called between statements, where a backend cancel would have nothing to interrupt
+        if self.cancel_requested:
+            raise QueryCancelled()
+
+    def cancel(self):
+        with self.lock:
+            self.cancel_requested = True
+            conn = self.conn
+        if conn is not None:
+            conn.cancel()
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def done(self):
+        return self.future is not None and self.future.done()
@@ -0,0 +1,66 @@
+import datetime
+import json
+import os
+import threading
+
+import query_cache
+
+
+class QueryLog:
+    """Append-only JSON lines log of the queries the app sent to the database, read by index_advisor.py.
+
+    One line per executed query with its duration, row count and outcome. Cached pages are not
+    logged, nothing ran for them. Past max_bytes the file is moved to path + ".1", keeping one
+    older file around.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def record(self, sql, seconds, rows=None, status="ok", rollup=None):
+        entry = {
+            "ts": datetime.datetime.now().isoformat(timespec="seconds"),
+            "sql": sql,
+            "seconds": round(seconds, 4),
+            "rows": rows,
+            "status": status,
+            "rollup": rollup,
+        }
+        with self.lock:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+def read_entries(path):
+    # Entries of the rotated file first, then the current one. Lines cut off by a crash are skipped.
+    for log_path in (path + ".1", path):
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def workload(entries, include_rollups=False):
+    """Logged queries grouped by their normalized SQL, the slowest in total first.
+
+    Queries answered from a rollup view are left out unless include_rollups is set, indexes on the
+    base tables do not change how they run.
+    """
+    queries = {}
+    for entry in entries:
+        if entry.get("rollup") and not include_rollups:
+            continue
+        query = queries.setdefault(query_cache.normalize_sql(entry["sql"]), {
+            "sql": entry["sql"], "calls": 0, "total_seconds": 0.0, "max_seconds": 0.0, "errors": 0,
+        })
+        query["calls"] += 1
+        query["total_seconds"] += entry["seconds"]
+        query["max_seconds"] = max(query["max_seconds"], entry["seconds"])
+        query["errors"] += entry["status"] != "ok"
+    return sorted(queries.values(), key=lambda query: query["total_seconds"], reverse=True)
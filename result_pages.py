@@ -0,0 +1,101 @@
+import datetime
+import itertools
+import sys
+
+# pandas and pyarrow are imported by the functions using them: the app imports this module at
+# start up, and the login screen renders before any result is fetched.
+
+FETCH_BATCH_ROWS = 200
+cursor_ids = itertools.count()
+
+def strip_statement(sql):
+    return sql.strip().rstrip(";").strip()
+
+def count_sql(sql):
+    """The query counting every row sql returns, run apart from the page fetch."""
+    return f"SELECT count(*) AS total_rows FROM ({strip_statement(sql)}) AS counted"
+
+def page_key(sql, offset, page_size, max_bytes):
+    # Query cache key for one page, distinct from the key of the full statement
+    return f"{strip_statement(sql)} /* rows {offset}+{page_size} max {max_bytes} bytes */"
+
+def row_size(row):
+    return sum(sys.getsizeof(value) for value in row)
+
+def frame_bytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+def total_frame(total):
+    # Count query result, as kept in the query cache
+    import pandas as pd
+    return pd.DataFrame({"total_rows": [total]})
+
+def compact_frame(df, category_ratio=0.5):
+    """df with its columns stored compactly, the bytes it took before in df.attrs["raw_bytes"].
+
+    Strings repeated across rows (region, country, category names) become categories and other
+    strings Arrow strings, integers are downcast to the smallest type holding them and dates
+    become Arrow dates. Arrow-backed and categorical columns reach st.dataframe without being
+    copied into Python objects again. Floats are left at float64, they carry money amounts.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    raw_bytes = frame_bytes(df)
+    # Columns are addressed by position, a SELECT * over a join repeats names like customerid
+    for position in range(len(df.columns)):
+        values = df.iloc[:, position]
+        if pd.api.types.is_integer_dtype(values.dtype) and not isinstance(values.dtype, pd.ArrowDtype):
+            df.isetitem(position, pd.to_numeric(values, downcast="integer"))
+        elif pd.api.types.is_object_dtype(values.dtype) or pd.api.types.is_string_dtype(values.dtype):
+            present = values.dropna()
+            if present.empty:
+                continue
+            if all(isinstance(value, str) for value in present):
+                if present.nunique() <= len(values) * category_ratio:
+                    df.isetitem(position, values.astype("category"))
+                elif not isinstance(values.dtype, pd.StringDtype) or values.dtype.storage != "pyarrow":
+                    df.isetitem(position, values.astype(pd.StringDtype("pyarrow")))
+            elif all(isinstance(value, datetime.date) and not isinstance(value, datetime.datetime) for value in present):
+                df.isetitem(position, values.astype(pd.ArrowDtype(pa.date32())))
+    df.attrs["raw_bytes"] = raw_bytes
+    return df
+
+def read_page(cur, page_size, max_bytes):
+    """Up to page_size rows from an executed cursor, fetched in batches, as a compacted frame.
+
+    Stops early once the rows take more than max_bytes, which is recorded as df.attrs["truncated"].
+    Works on any DB-API cursor, a Postgres named cursor or a DuckDB one.
+    """
+    import pandas as pd
+
+    rows = []
+    page_bytes = 0
+    truncated = False
+    while len(rows) < page_size and not truncated:
+        batch = cur.fetchmany(min(FETCH_BATCH_ROWS, page_size - len(rows)))
+        if not batch:
+            break
+        for row in batch:
+            rows.append(row)
+            page_bytes += row_size(row)
+            if page_bytes > max_bytes:
+                truncated = True
+                break
+    columns = [column[0] for column in cur.description]
+
+    df = compact_frame(pd.DataFrame.from_records(rows, columns=columns, coerce_float=True))
+    df.attrs["truncated"] = truncated
+    return df
+
+def fetch_page(conn, sql, offset, page_size, max_bytes):
+    """Rows offset to offset + page_size of sql, read through a named server-side cursor.
+
+    Rows before offset are skipped on the server with MOVE and never sent to the app, and at most
+    page_size rows are held in memory. See read_page for the byte limit.
+    """
+    with conn.cursor(name=f"result_page_{next(cursor_ids)}") as cur:
+        cur.execute(strip_statement(sql))
+        if offset:
+            cur.scroll(offset)
+        return read_page(cur, page_size, max_bytes)
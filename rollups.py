@@ -0,0 +1,403 @@
+import argparse
+import math
+import re
+import time
+
+import query_cache
+
+# Pre-aggregated sales at the grains nearly every question asks about. populate_database.py rebuilds
+# them after each load, and route_query rewrites an aggregate query over the base tables into the
+# same query over the smallest rollup that can answer it.
+
+SALES_JOINS = """FROM OrderDetail od
+        JOIN Customer cu ON cu.CustomerID = od.CustomerID
+        JOIN Country c ON c.CountryID = cu.CountryID
+        JOIN Region r ON r.RegionID = c.RegionID
+        JOIN Product p ON p.ProductID = od.ProductID
+        JOIN ProductCategory pc ON pc.ProductCategoryID = p.ProductCategoryID"""
+
+SALES_MEASURES = """sum(p.ProductUnitPrice * od.QuantityOrdered) AS TotalValue,
+        sum(od.QuantityOrdered) AS TotalQuantity,
+        count(*) AS OrderLines"""
+
+# (view name, dimension tables it can group by, grain columns, grain SQL expressions)
+rollup_views = [
+    ("SalesByRegion", {"region"}, ["RegionID", "Region"], ["r.RegionID", "r.Region"]),
+    ("SalesByProductCategory", {"productcategory"},
+     ["ProductCategoryID", "ProductCategory", "ProductCategoryDescription"],
+     ["pc.ProductCategoryID", "pc.ProductCategory", "pc.ProductCategoryDescription"]),
+    ("SalesByMonth", {"month"}, ["OrderMonth"], ["date_trunc('month', od.OrderDate)"]),
+    ("SalesByCountry", {"country", "region"}, ["CountryID", "Country", "RegionID", "Region"],
+     ["c.CountryID", "c.Country", "r.RegionID", "r.Region"]),
+    ("SalesByProduct", {"product", "productcategory"},
+     ["ProductID", "ProductName", "ProductUnitPrice", "ProductCategoryID", "ProductCategory", "ProductCategoryDescription"],
+     ["p.ProductID", "p.ProductName", "p.ProductUnitPrice", "pc.ProductCategoryID", "pc.ProductCategory",
+      "pc.ProductCategoryDescription"]),
+]
+
+MEASURE_COLUMNS = ["TotalValue", "TotalQuantity", "OrderLines"]
+
+def rollup_sql(grain_columns, grain_expressions):
+    grain = ", ".join(f"{expression} AS {column}" for column, expression in zip(grain_columns, grain_expressions))
+    return f"""SELECT {grain},
+        {SALES_MEASURES}
+        {SALES_JOINS}
+        GROUP BY {", ".join(grain_expressions)}"""
+
+def build_rollups(conn):
+    # Inputs: Open connection, the normalized tables already loaded
+    # Output: None. Every rollup is dropped and rebuilt from the current tables; the caller commits.
+    cur = conn.cursor()
+    for view_name, _, grain_columns, grain_expressions in rollup_views:
+        cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view_name}")
+        cur.execute(f"CREATE MATERIALIZED VIEW {view_name} AS {rollup_sql(grain_columns, grain_expressions)}")
+        cur.execute(f"ANALYZE {view_name}")
+        cur.execute(f"SELECT count(*) FROM {view_name}")
+        print(f"{view_name}: {cur.fetchone()[0]} rows")
+    cur.close()
+
+
+## -- Query routing -- ##
+
+# Columns of the normalized tables, to tell dimension columns from the ones only the base tables have
+table_columns = {
+    "region": {"regionid", "region"},
+    "country": {"countryid", "country", "regionid"},
+    "customer": {"customerid", "firstname", "lastname", "address", "city", "countryid"},
+    "productcategory": {"productcategoryid", "productcategory", "productcategorydescription"},
+    "product": {"productid", "productname", "productunitprice", "productcategoryid"},
+    "orderdetail": {"orderid", "customerid", "productid", "orderdate", "quantityordered"},
+}
+base_columns = set().union(*table_columns.values())
+
+CLAUSE_KEYWORDS = ["from", "where", "group by", "having", "order by", "limit", "offset"]
+MONTH_INVARIANT = [
+    r"date_trunc\s*\(\s*'(?:month|quarter|year)'\s*,\s*{column}\s*\)",
+    r"extract\s*\(\s*(?:month|quarter|year)\s+from\s+{column}\s*\)",
+    r"date_part\s*\(\s*'(?:month|quarter|year)'\s*,\s*{column}\s*\)",
+    r"to_char\s*\(\s*{column}\s*,\s*'(?:fm|yyyy|yy|mm|month|mon|q|[\s\-/])+'\s*\)",
+]
+
+def split_top_level(text, separator=","):
+    # Splits on separator outside parentheses and quotes
+    parts, depth, quote, start = [], 0, None, 0
+    for i, char in enumerate(text):
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return parts
+
+def split_clauses(sql):
+    # "select ... from ... group by ..." -> {"select": ..., "from": ..., "group by": ...}, keywords at depth 0 only
+    positions, depth, quote = [], 0, None
+    for i, char in enumerate(sql):
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and char == " ":
+            for keyword in CLAUSE_KEYWORDS:
+                if sql.startswith(f" {keyword} ", i):
+                    positions.append((i, keyword))
+    clauses = {}
+    bounds = [(0, "select")] + positions + [(len(sql), None)]
+    for (start, keyword), (end, _) in zip(bounds, bounds[1:]):
+        if keyword in clauses:
+            return None
+        clauses[keyword] = sql[start + len(keyword) + 1:end].strip()
+    return clauses
+
+def parse_from(from_clause):
+    # Returns {alias: table} for a chain of inner joins on key columns between the normalized tables
+    segments = re.split(r"\s+(?:inner\s+)?join\s+", from_clause)
+    aliases = {}
+    for i, segment in enumerate(segments):
+        match = re.fullmatch(r"(\w+)(?:\s+(?:as\s+)?(?!on\b)(\w+))?(?:\s+on\s+\(?\s*(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)\s*\)?)?",
+                             segment)
+        if match is None or match.group(1) not in table_columns or (i > 0) != (match.group(3) is not None):
+            return None
+        table, alias = match.group(1), match.group(2) or match.group(1)
+        if alias in aliases or table in aliases.values():
+            return None
+        aliases[alias] = table
+        if i > 0:
+            left_alias, left_column, right_alias, right_column = match.group(3, 4, 5, 6)
+            # One side is the joined table, the other one joined before it: r.RegionID = r.RegionID
+            # would make a cartesian join the rollups do not reproduce
+            if left_alias == right_alias:
+                return None
+            if left_column != right_column or not left_column.endswith("id") or alias not in (left_alias, right_alias):
+                return None
+            if left_alias not in aliases or right_alias not in aliases or \
+                    left_column not in table_columns[aliases[left_alias]] or right_column not in table_columns[aliases[right_alias]]:
+                return None
+    return aliases
+
+def measure_expression(function, argument, aliases):
+    # The rollup expression equal to an aggregate over the base tables, None if there is none
+    argument = re.sub(r"::\s*(?:numeric|decimal|float8|double precision|real|float)\b", "", argument)
+    argument = re.sub(r"\s+", "", argument)
+    while argument.startswith("(") and argument.endswith(")"):
+        argument = argument[1:-1]
+    column = r"(?:(\w+)\.)?{}"
+    value = re.fullmatch(column.format("productunitprice") + r"\*" + column.format("quantityordered"), argument) or \
+        re.fullmatch(column.format("quantityordered") + r"\*" + column.format("productunitprice"), argument)
+    quantity = re.fullmatch(column.format("quantityordered"), argument)
+    rows = argument in ("*", "1") or re.fullmatch(column.format("orderid"), argument)
+
+    for match in (value, quantity):
+        if match and any(alias and alias not in aliases for alias in match.groups()):
+            return None
+    if function == "sum" and value:
+        return "sum(rollup.TotalValue)"
+    if function == "sum" and quantity:
+        return "sum(rollup.TotalQuantity)::bigint"
+    if function == "count" and rows:
+        return "sum(rollup.OrderLines)::bigint"
+    if function == "avg" and value:
+        return "(sum(rollup.TotalValue) / nullif(sum(rollup.OrderLines), 0))"
+    if function == "avg" and quantity:
+        return "(sum(rollup.TotalQuantity)::numeric / nullif(sum(rollup.OrderLines), 0))"
+    return None
+
+def replace_aggregates(text, aliases):
+    # Replaces every sum/avg/count call with its rollup expression, None if one has no equivalent.
+    # Returns the rewritten text and the number of aggregates replaced.
+    result, position, replaced = [], 0, 0
+    for match in re.finditer(r"\b(sum|avg|count|min|max|stddev|variance|array_agg|string_agg)\s*\(", text):
+        if match.start() < position:
+            continue
+        depth, end = 1, match.end()
+        while depth and end < len(text):
+            depth += {"(": 1, ")": -1}.get(text[end], 0)
+            end += 1
+        replacement = measure_expression(match.group(1), text[match.end():end - 1].strip(), aliases)
+        if replacement is None:
+            return None
+        result.append(text[position:match.start()])
+        result.append(replacement)
+        position = end
+        replaced += 1
+    result.append(text[position:])
+    return "".join(result), replaced
+
+def grain_dimensions(group_expressions, aliases):
+    # Dimension tables (and "month") the GROUP BY needs, None if it groups by anything else
+    dimensions = set()
+    for expression in group_expressions:
+        for alias, column in re.findall(r"\b(\w+)\.(\w+)\b", expression):
+            table = aliases.get(alias)
+            if table is None:
+                return None
+            if table == "orderdetail" and column == "orderdate":
+                dimensions.add("month")
+            elif table in ("orderdetail", "customer") or column not in table_columns[table]:
+                return None
+            else:
+                dimensions.add(table)
+        for column in re.findall(r"(?<![\w.])([a-z_]\w*)\b(?!\s*[.(])", expression):
+            tables = [table for table in ("region", "country", "productcategory", "product") if column in table_columns[table]]
+            if column == "orderdate":
+                dimensions.add("month")
+            elif tables:
+                dimensions.add(tables[0])
+            elif column in base_columns:
+                return None
+    return dimensions
+
+def route_query(sql):
+    """Rewrites sql to read from a rollup when one can answer it.
+
+    Handles single SELECTs over inner key joins of the normalized tables, without WHERE, grouped by
+    columns of one rollup's dimensions (or month expressions of OrderDate) and aggregating only
+    sum/avg of ProductUnitPrice * QuantityOrdered, sum/avg of QuantityOrdered and row counts.
+    Returns (rollup name, rewritten SQL), or None if the query has to run on the base tables.
+    """
+    text = query_cache.normalize_sql(sql)
+    if not text.startswith("select ") or len(re.findall(r"\bselect\b", text)) != 1:
+        return None
+    if re.search(r"\b(?:distinct|union|intersect|except|over|window|filter|lateral|left|right|full|cross|using|natural)\b", text):
+        return None
+    clauses = split_clauses(text)
+    if clauses is None or "from" not in clauses or "where" in clauses:
+        return None
+    aliases = parse_from(clauses["from"])
+    if aliases is None or "orderdetail" not in aliases.values():
+        return None
+
+    select_items = split_top_level(clauses["select"])
+    group_expressions = []
+    for expression in split_top_level(clauses.get("group by", "")) if "group by" in clauses else []:
+        if expression.isdigit() and 0 < int(expression) <= len(select_items):
+            expression = re.sub(r"\s+as\s+(\w+|\"[^\"]*\")$", "", select_items[int(expression) - 1])
+        group_expressions.append(expression)
+    dimensions = grain_dimensions(group_expressions, aliases)
+    if dimensions is None:
+        return None
+    for view_name, view_dimensions, grain_columns, _ in rollup_views:
+        if dimensions <= view_dimensions:
+            break
+    else:
+        return None
+    rollup_columns = {column.lower() for column in grain_columns + MEASURE_COLUMNS}
+
+    rewritten = {}
+    aggregates = 0
+    date_aliases = [alias for alias, table in aliases.items() if table == "orderdetail"]
+    for keyword in ("select", "group by", "having", "order by"):
+        if keyword not in clauses:
+            continue
+        replaced = replace_aggregates(clauses[keyword], aliases)
+        if replaced is None:
+            return None
+        clause, clause_aggregates = replaced
+        aggregates += clause_aggregates
+        if "*" in re.sub(r"'(?:[^']|'')*'", "''", clause).replace("count(*)", ""):
+            return None
+        if "month" in dimensions:
+            column = r"(?:(?:{})\.)?orderdate".format("|".join(date_aliases))
+            for pattern in MONTH_INVARIANT:
+                clause = re.sub(pattern.format(column=column),
+                                lambda match: re.sub(column, "rollup.OrderMonth", match.group(0)), clause, flags=re.IGNORECASE)
+        for alias in aliases:
+            clause = re.sub(rf"(?<![\w.]){alias}\.", "rollup.", clause)
+        unquoted = re.sub(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"", "''", clause)
+        for column in re.findall(r"rollup\.(\w+)", unquoted):
+            if column.lower() not in rollup_columns:
+                return None
+        for column in re.findall(r"(?<![\w.])([a-z_]\w*)\b(?!\s*\()", unquoted):
+            if column in base_columns and column not in rollup_columns:
+                return None
+        rewritten[keyword] = clause
+
+    # Without GROUP BY or an aggregate the query returns one row per order line, which no rollup holds
+    if "group by" not in clauses and aggregates == 0:
+        return None
+
+    rollup_query = f"select {rewritten['select']} from {view_name} as rollup"
+    for keyword in ("group by", "having", "order by"):
+        if keyword in rewritten:
+            rollup_query += f" {keyword} {rewritten[keyword]}"
+    for keyword in ("limit", "offset"):
+        if keyword in clauses:
+            rollup_query += f" {keyword} {clauses[keyword]}"
+    return view_name, rollup_query
+
+def estimated_cost(conn, sql):
+    with conn.cursor() as cur:
+        cur.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+        return cur.fetchone()[0][0]["Plan"]["Total Cost"]
+
+def estimated_speedup(conn, sql, rollup_query):
+    """Planner cost of the base query over the cost of its rollup rewrite."""
+    rollup_cost = estimated_cost(conn, rollup_query)
+    return estimated_cost(conn, sql) / rollup_cost if rollup_cost else None
+
+def frames_match(base_df, rollup_df, rel_tol=1e-9):
+    """True if both results hold the same rows, floats compared with a relative tolerance.
+
+    Row order is only compared when both are ordered the same way by the query, so rows are
+    sorted first to compare the contents of unordered results.
+    """
+    if list(base_df.columns) != list(rollup_df.columns) or len(base_df) != len(rollup_df):
+        return False
+    def rows(df):
+        return sorted((tuple("" if value is None else value for value in row) for row in df.itertuples(index=False)),
+                      key=lambda row: tuple(str(round(value, 4)) if isinstance(value, float) else str(value) for value in row))
+    for base_row, rollup_row in zip(rows(base_df), rows(rollup_df)):
+        for base_value, rollup_value in zip(base_row, rollup_row):
+            if isinstance(base_value, (float, int)) and isinstance(rollup_value, (float, int)) and \
+                    not isinstance(base_value, bool):
+                if not math.isclose(float(base_value), float(rollup_value), rel_tol=rel_tol, abs_tol=1e-9):
+                    return False
+            elif base_value != rollup_value:
+                return False
+    return True
+
+
+## -- Verification -- ##
+
+verification_queries = [
+    """SELECT r.Region AS region, SUM(p.ProductUnitPrice * od.QuantityOrdered) AS total_value
+       FROM OrderDetail od JOIN Customer c ON od.CustomerID = c.CustomerID JOIN Country co ON c.CountryID = co.CountryID
+       JOIN Region r ON co.RegionID = r.RegionID JOIN Product p ON od.ProductID = p.ProductID
+       GROUP BY r.Region ORDER BY total_value DESC;""",
+    """SELECT co.Country AS country, SUM(p.ProductUnitPrice * od.QuantityOrdered) AS total_order_value
+       FROM OrderDetail od JOIN Customer c ON od.CustomerID = c.CustomerID JOIN Country co ON c.CountryID = co.CountryID
+       JOIN Product p ON od.ProductID = p.ProductID
+       GROUP BY co.Country HAVING SUM(p.ProductUnitPrice * od.QuantityOrdered) > 100000 ORDER BY total_order_value DESC""",
+    """SELECT AVG(p.ProductUnitPrice * od.QuantityOrdered) AS average_order_value
+       FROM OrderDetail od JOIN Product p ON od.ProductID = p.ProductID""",
+    """SELECT p.ProductName AS product_name, SUM(od.QuantityOrdered) AS total_quantity
+       FROM OrderDetail od JOIN Product p ON od.ProductID = p.ProductID
+       GROUP BY p.ProductName ORDER BY total_quantity DESC, product_name LIMIT 5""",
+    """SELECT pc.ProductCategory AS category, COUNT(*) AS order_lines, SUM(p.ProductUnitPrice * od.QuantityOrdered) AS total_value
+       FROM OrderDetail od JOIN Product p ON od.ProductID = p.ProductID
+       JOIN ProductCategory pc ON p.ProductCategoryID = pc.ProductCategoryID
+       GROUP BY pc.ProductCategory ORDER BY category""",
+    """SELECT DATE_TRUNC('month', od.OrderDate) AS month, SUM(p.ProductUnitPrice * od.QuantityOrdered) AS total_value
+       FROM OrderDetail od JOIN Product p ON od.ProductID = p.ProductID
+       GROUP BY DATE_TRUNC('month', od.OrderDate) ORDER BY month""",
+    """SELECT EXTRACT(YEAR FROM od.OrderDate) AS year, r.Region AS region, SUM(od.QuantityOrdered) AS quantity
+       FROM OrderDetail od JOIN Customer c ON od.CustomerID = c.CustomerID JOIN Country co ON c.CountryID = co.CountryID
+       JOIN Region r ON co.RegionID = r.RegionID GROUP BY 1, 2""",
+]
+
+def timed_query(conn, sql, repeats):
+    import pandas as pd
+    best = None
+    for _ in range(repeats):
+        query_start = time.perf_counter()
+        df = pd.read_sql_query(sql, conn)
+        seconds = time.perf_counter() - query_start
+        best = seconds if best is None else min(best, seconds)
+    return df, best
+
+def verify_rollups(conn, queries, repeats=3):
+    # Runs every query on the base tables and on its rollup, prints the timings and whether the answers match
+    # Output: Number of routed queries whose answers differ
+    mismatches = 0
+    for sql in queries:
+        route = route_query(sql)
+        base_df, base_seconds = timed_query(conn, sql, repeats)
+        if route is None:
+            print(f"not routed ({base_seconds * 1000:.1f} ms): {' '.join(sql.split())[:90]}")
+            continue
+        view_name, rollup_query = route
+        rollup_df, rollup_seconds = timed_query(conn, rollup_query, repeats)
+        match = frames_match(base_df, rollup_df)
+        mismatches += not match
+        print(f"{view_name:<24} base {base_seconds * 1000:8.1f} ms  rollup {rollup_seconds * 1000:7.1f} ms  "
+              f"speedup {base_seconds / rollup_seconds:6.1f}x  {'match' if match else 'MISMATCH'}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    import psycopg2
+    import populate_database
+
+    parser = argparse.ArgumentParser(description="Rebuild the sales rollups and check them against the base tables")
+    parser.add_argument("--build", action="store_true", help="rebuild the rollups before verifying")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per query, the fastest is reported")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(populate_database.DATABASE_URL)
+    if args.build:
+        with conn:
+            build_rollups(conn)
+    if verify_rollups(conn, verification_queries, args.repeats):
+        raise SystemExit(1)
+    conn.close()
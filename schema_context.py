@@ -0,0 +1,239 @@
+import collections
+import re
+
+# -- Database Schema for LLM refrence -- #
+DATABASE_SCHEMA = """
+    Database Schema:
+
+    Lookup tables - 
+    Region(
+        RegionID SERIAL not null primary key,
+        Region TEXT not null
+    )
+    Country(
+        CountryID SERIAL not null Primary key,
+        Country Text not null,
+        RegionID integer not null,
+        FOREIGN KEY(RegionID) REFERENCES Region(RegionID)
+    )
+    ProductCategory(
+        ProductCategoryID SERIAL not null Primary Key,
+        ProductCategory Text not null,
+        ProductCategoryDescription Text not null,
+        UNIQUE(ProductCategory)
+    )
+    Product(
+        ProductID SERIAL not null Primary key,
+        ProductName Text not null,
+        ProductUnitPrice Real not null,
+        ProductCategoryID integer not null,
+        UNIQUE (ProductName),
+        FOREIGN KEY(ProductCategoryID) REFERENCES ProductCategory(ProductCategoryID)
+    )
+
+    Core tables -
+
+    Customer(
+        CustomerID SERIAL not null Primary Key,
+        FirstName Text not null,
+        LastName Text not null,
+        Address Text not null,
+        City Text not null,
+        CountryID integer not null,
+        UNIQUE (FirstName, LastName, Address),
+        FOREIGN KEY(CountryID) REFERENCES Country(CountryID)
+    )
+    OrderDetail(
+        OrderID SERIAL not null Primary Key,
+        CustomerID integer not null,
+        ProductID integer not null,
+        OrderDate TIMESTAMP not null,
+        QuantityOrdered integer not null,
+        UNIQUE (CustomerID, ProductID),
+        FOREIGN KEY(CustomerID) REFERENCES Customer(CustomerID),
+        FOREIGN KEY(ProductID) REFERENCES Product(ProductID)
+    )
+
+    Important Notes - 
+    Use Joins to get descriptive values from lookup tables
+    OrderDate is a TIMESTAMP type
+    Always use proper joins for foreign key relationships
+"""
+
+PROMPT_TEMPLATE = """You are a PostgreSQL expert. Given the following database schema and a user's question, generate a valid PostgreSQL query.
+
+    {schema}
+
+    User Question: {question}
+
+    Requirements:
+    1. Generate ONLY the SQL query, wrapped in ```sql``` code blocks
+    2. Use proper JOINs to get descriptive names from lookup tables
+    3. Use appropriate aggregations (COUNT, AVG, SUM, etc.) when needed
+    4. Add LIMIT clauses for queries that might return many rows (default LIMIT 100)
+    5. Use proper date/time functions for TIMESTAMP columns
+    6. Make sure the query is syntactically correct for PostgreSQL
+    7. Add helpful column aliases using AS
+
+    Generate the SQL query: """
+
+# Words in questions that point at a table without naming it or one of its columns
+TABLE_SYNONYMS = {
+    "Region": ["continent", "area"],
+    "Country": ["nation"],
+    "Customer": ["client", "buyer", "people", "person", "who", "name"],
+    "ProductCategory": ["type", "kind", "group"],
+    "Product": ["item", "cost", "price", "value", "revenue", "sale", "sell", "sold", "spend", "spent", "amount"],
+    "OrderDetail": ["order", "purchase", "bought", "sale", "sell", "sold", "value", "revenue", "spend", "spent",
+                    "amount", "month", "year", "day", "date", "time", "when", "trend", "count", "number", "volume"],
+}
+
+
+## -- Schema graph -- ##
+
+def split_words(name):
+    # "ProductCategoryDescription" -> ["product", "category", "description"]
+    return [word.lower() for word in re.findall(r"[A-Z][a-z]*|[a-z]+", name)]
+
+def parse_schema(schema_text):
+    """Parses the schema text into its tables, their columns and foreign keys, and the notes after them.
+
+    Returns (tables, notes) where tables maps each table name, in schema order, to a dict with the
+    column definition lines, constraint lines, foreign keys as (column, table, column) tuples and the
+    words a question may use for the table.
+    """
+    tables = collections.OrderedDict()
+    for match in re.finditer(r"^\s*(\w+)\(\n(.*?)\n\s*\)", schema_text, re.MULTILINE | re.DOTALL):
+        table_name, body = match.groups()
+        table = {"columns": [], "constraints": [], "foreign_keys": []}
+        for line in body.splitlines():
+            line = line.strip().rstrip(",")
+            foreign_key = re.match(r"FOREIGN KEY\s*\((\w+)\)\s*REFERENCES\s*(\w+)\((\w+)\)", line, re.IGNORECASE)
+            if foreign_key:
+                table["foreign_keys"].append(foreign_key.groups())
+                table["constraints"].append(line)
+            elif re.match(r"(UNIQUE|PRIMARY KEY|CHECK)\b", line, re.IGNORECASE):
+                table["constraints"].append(line)
+            elif line:
+                table["columns"].append(line)
+        tables[table_name] = table
+
+    for table_name, table in tables.items():
+        terms = {table_name.lower(), *TABLE_SYNONYMS.get(table_name, [])}
+        table_words = split_words(table_name)
+        terms.add(table_words[-1])
+        for column in table["columns"]:
+            column_name = column.split()[0]
+            if column_name.lower().endswith("id"):
+                continue
+            terms.add(column_name.lower())
+            terms.update(word for word in split_words(column_name) if word not in table_words or word == table_words[-1])
+        table["terms"] = terms
+
+    notes = schema_text[schema_text.index("Important Notes"):].strip() if "Important Notes" in schema_text else ""
+    return tables, notes
+
+def join_graph(tables):
+    graph = {table_name: set() for table_name in tables}
+    for table_name, table in tables.items():
+        for _, referenced_table, _ in table["foreign_keys"]:
+            if referenced_table in graph:
+                graph[table_name].add(referenced_table)
+                graph[referenced_table].add(table_name)
+    return graph
+
+def join_path(graph, selected, target):
+    # Shortest chain of tables linking target to any already selected table, breadth first over the FKs
+    previous = {target: None}
+    queue = collections.deque([target])
+    while queue:
+        table_name = queue.popleft()
+        if table_name in selected:
+            path = []
+            while table_name is not None:
+                path.append(table_name)
+                table_name = previous[table_name]
+            return path
+        for neighbour in sorted(graph[table_name]):
+            if neighbour not in previous:
+                previous[neighbour] = table_name
+                queue.append(neighbour)
+    return [target]
+
+
+## -- Question-aware context -- ##
+
+def word_forms(word):
+    # The word and its likely singular/stem forms: "countries" -> {"countries", "country", ...}
+    forms = {word}
+    if word.endswith("ies"):
+        forms.add(word[:-3] + "y")
+    for suffix in ("es", "s", "ed", "d", "ing"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            forms.add(word[:-len(suffix)])
+    return forms
+
+# Lookup values a question may name instead of the table, e.g. "Europe" for Region
+VALUE_QUERIES = {
+    "Region": "SELECT DISTINCT lower(Region) FROM Region",
+    "Country": "SELECT DISTINCT lower(Country) FROM Country",
+    "ProductCategory": "SELECT DISTINCT lower(ProductCategory) FROM ProductCategory",
+}
+
+def load_value_terms(conn):
+    """Region, country and category names from the database, keyed by table."""
+    value_terms = {}
+    with conn.cursor() as cur:
+        for table_name, value_sql in VALUE_QUERIES.items():
+            cur.execute(value_sql)
+            value_terms[table_name] = {row[0] for row in cur.fetchall() if row[0]}
+    conn.rollback()
+    return value_terms
+
+def mentions_value(question, values):
+    return any(re.search(rf"\b{re.escape(value)}\b", question) for value in values)
+
+def relevant_tables(question, tables, value_terms=None):
+    """Tables the question mentions, plus every table on the join paths between them, in schema order.
+
+    A table is mentioned by its name, one of its columns, a synonym, or one of its values in value_terms.
+    Returns all tables when nothing in the question matches, the prompt then carries the full schema.
+    """
+    question = question.lower()
+    words = set()
+    for word in re.findall(r"[a-z]+", question):
+        words.update(word_forms(word))
+    matched = [table_name for table_name, table in tables.items()
+               if words & table["terms"] or mentions_value(question, (value_terms or {}).get(table_name, ()))]
+    if not matched:
+        return list(tables)
+
+    graph = join_graph(tables)
+    selected = {matched[0]}
+    for table_name in matched[1:]:
+        selected.update(join_path(graph, selected, table_name))
+    return [table_name for table_name in tables if table_name in selected]
+
+def render_schema(tables, table_names, notes):
+    # Schema text for the given tables in the same layout as DATABASE_SCHEMA, dropping foreign keys to tables left out
+    blocks = []
+    for table_name in table_names:
+        table = tables[table_name]
+        lines = table["columns"] + [
+            constraint for constraint in table["constraints"]
+            if not re.match(r"FOREIGN KEY", constraint, re.IGNORECASE)
+            or re.search(r"REFERENCES\s*(\w+)", constraint).group(1) in table_names
+        ]
+        blocks.append(f"    {table_name}(\n" + ",\n".join(f"        {line}" for line in lines) + "\n    )")
+    return "\n    Database Schema:\n\n" + "\n".join(blocks) + (f"\n\n    {notes}\n" if notes else "\n")
+
+SCHEMA_TABLES, SCHEMA_NOTES = parse_schema(DATABASE_SCHEMA)
+
+def schema_for_question(question, value_terms=None):
+    """The part of DATABASE_SCHEMA relevant to the question."""
+    return render_schema(SCHEMA_TABLES, relevant_tables(question, SCHEMA_TABLES, value_terms), SCHEMA_NOTES)
+
+def build_prompt(question, prune_schema=True, value_terms=None):
+    """The SQL generation prompt for a question, with only the relevant schema when prune_schema is set."""
+    schema = schema_for_question(question, value_terms) if prune_schema else DATABASE_SCHEMA
+    return PROMPT_TEMPLATE.format(schema=schema, question=question)
@@ -0,0 +1,131 @@
+import contextlib
+import os
+import sys
+import threading
+import time
+
+import result_pages
+
+
+def value_size(value):
+    """Approximate bytes held by a session state value. DataFrames are measured deep,
+    containers with their contents, anything else by its own size."""
+    # Without pandas imported there is no DataFrame to measure, and nothing to import it for.
+    # A query thread may be importing it right now, leaving the module without DataFrame yet.
+    if isinstance(value, getattr(sys.modules.get("pandas"), "DataFrame", ())):
+        return result_pages.frame_bytes(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(value_size(key) + value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(value_size(item) for item in value)
+    return sys.getsizeof(value)
+
+def state_sizes(state):
+    # Bytes per session state key, largest first
+    sizes = {str(key): value_size(state[key]) for key in state.keys()}
+    return dict(sorted(sizes.items(), key=lambda item: item[1], reverse=True))
+
+
+class SessionMemory:
+    """Latest session state size reported by every session of this server process.
+
+    Sessions report on each rerun; one not heard from in max_age_seconds is taken to be gone.
+    """
+
+    def __init__(self, max_age_seconds=3600):
+        self.max_age_seconds = max_age_seconds
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def update(self, session_key, total_bytes):
+        with self.lock:
+            self.sessions[session_key] = (total_bytes, time.time())
+
+    def evict_stale(self):
+        with self.lock:
+            now = time.time()
+            self.sessions = {key: entry for key, entry in self.sessions.items()
+                             if now - entry[1] <= self.max_age_seconds}
+
+    def metrics(self):
+        self.evict_stale()
+        with self.lock:
+            sizes = [total_bytes for total_bytes, _ in self.sessions.values()]
+        return {
+            "sessions": len(sizes),
+            "bytes": sum(sizes),
+            "max_bytes": max(sizes, default=0),
+        }
+
+
+class ResultSpill:
+    """Full result pages written to local Parquet files, one per session, while the session state
+    keeps only a preview.
+
+    A file is dropped once its session has not written or read it for max_age_seconds.
+    """
+
+    def __init__(self, directory, max_age_seconds=3600):
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, session_key):
+        return os.path.join(self.directory, f"{session_key}.parquet")
+
+    def save(self, session_key, df):
+        # Parquet needs unique column names, a SELECT * over a join repeats some, so columns are
+        # stored by position with their names kept in attrs. Written next to the old file and
+        # renamed over it, a reader never sees half a file.
+        spilled = df.set_axis([str(position) for position in range(len(df.columns))], axis=1)
+        spilled.attrs = {**df.attrs, "columns": [str(column) for column in df.columns]}
+        temporary_path = self.path(session_key) + ".tmp"
+        spilled.to_parquet(temporary_path, index=False)
+        os.replace(temporary_path, self.path(session_key))
+
+    def load(self, session_key):
+        """The spilled page of session_key, None once it has been evicted."""
+        import pandas as pd
+        try:
+            df = pd.read_parquet(self.path(session_key))
+            os.utime(self.path(session_key))
+        except FileNotFoundError:
+            return None
+        return df.set_axis(df.attrs.pop("columns"), axis=1)
+
+    def drop(self, session_key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path(session_key))
+
+    def files(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.name.endswith(".parquet")]
+
+    def evict_stale(self):
+        now = time.time()
+        for entry in self.files():
+            with contextlib.suppress(FileNotFoundError):
+                if now - entry.stat().st_mtime > self.max_age_seconds:
+                    os.remove(entry.path)
+
+    def metrics(self):
+        sizes = []
+        for entry in self.files():
+            with contextlib.suppress(FileNotFoundError):
+                sizes.append(entry.stat().st_size)
+        return {"files": len(sizes), "bytes": sum(sizes)}
+
+
+def start_eviction(interval_seconds, *stores):
+    """Daemon thread calling evict_stale() on every store each interval_seconds."""
+    def evict():
+        while True:
+            time.sleep(interval_seconds)
+            for store in stores:
+                try:
+                    store.evict_stale()
+                except Exception as e:
+                    print(f"evicting stale session data failed: {e}")
+    thread = threading.Thread(target=evict, name="session-eviction", daemon=True)
+    thread.start()
+    return thread
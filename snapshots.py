@@ -0,0 +1,170 @@
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+
+# Parquet snapshot of the normalized tables, written by populate_database.py --snapshot after a
+# load. One zstd compressed file per dimension table, OrderDetail split into one directory per
+# OrderDate month (ordermonth=2020-11/part-0.parquet). A snapshot restores into Postgres with COPY
+# or into the app's DuckDB file without reading data.csv again.
+
+TABLE_ORDER = ["Region", "Country", "Customer", "ProductCategory", "Product", "OrderDetail"]
+PARTITIONED_TABLES = {"OrderDetail": ("orderdate", "ordermonth")}
+MANIFEST = "manifest.json"
+COMPRESSION = "zstd"
+BATCH_ROWS = 100000
+
+def arrow_type(data_type):
+    # REAL is stored as the double Postgres prints (13.44), not the widened single (13.4399995...)
+    import pyarrow as pa
+    return {
+        "integer": pa.int32(),
+        "bigint": pa.int64(),
+        "text": pa.string(),
+        "real": pa.float64(),
+        "double precision": pa.float64(),
+        "timestamp without time zone": pa.timestamp("us"),
+        "date": pa.date32(),
+    }.get(data_type, pa.string())
+
+
+## -- Export -- ##
+
+def table_schema(conn, table_name):
+    # Column names and Postgres types of table_name, in table order
+    with conn.cursor() as cur:
+        cur.execute("""SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position""", (table_name.lower(),))
+        return cur.fetchall()
+
+def table_batches(conn, table_name, schema):
+    # Record batches of table_name in key order, streamed through a server side cursor
+    import pyarrow as pa
+    with conn.cursor(name=f"snapshot_{table_name.lower()}") as cur:
+        cur.itersize = BATCH_ROWS
+        cur.execute(f"SELECT {', '.join(schema.names)} FROM {table_name} ORDER BY 1")
+        while rows := cur.fetchmany(BATCH_ROWS):
+            yield pa.RecordBatch.from_arrays([pa.array(values, field.type) for values, field in zip(zip(*rows), schema)],
+                                             schema=schema)
+
+def write_table(conn, table_name, directory):
+    """Writes table_name under directory, returns its manifest entry."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    columns = table_schema(conn, table_name)
+    schema = pa.schema([(column_name, arrow_type(data_type)) for column_name, data_type in columns])
+    entry = {"columns": dict(columns), "rows": 0}
+
+    if table_name in PARTITIONED_TABLES:
+        date_column, partition_column = PARTITIONED_TABLES[table_name]
+        partitioned_schema = schema.append(pa.field(partition_column, pa.string()))
+
+        def month_batches():
+            for batch in table_batches(conn, table_name, schema):
+                entry["rows"] += batch.num_rows
+                month = pc.strftime(batch.column(date_column), format="%Y-%m")
+                yield pa.RecordBatch.from_arrays(batch.columns + [month], schema=partitioned_schema)
+
+        ds.write_dataset(
+            month_batches(), os.path.join(directory, table_name), schema=partitioned_schema, format="parquet",
+            partitioning=ds.partitioning(pa.schema([partitioned_schema.field(partition_column)]), flavor="hive"),
+            file_options=ds.ParquetFileFormat().make_write_options(compression=COMPRESSION),
+            basename_template="part-{i}.parquet", preserve_order=True,
+        )
+        entry.update(path=table_name, partitioned_by=partition_column)
+    else:
+        with pq.ParquetWriter(os.path.join(directory, f"{table_name}.parquet"), schema, compression=COMPRESSION) as writer:
+            for batch in table_batches(conn, table_name, schema):
+                entry["rows"] += batch.num_rows
+                writer.write_batch(batch)
+        entry.update(path=f"{table_name}.parquet", partitioned_by=None)
+    return entry
+
+def export_snapshot(conn, directory):
+    """Writes every normalized table to a new snapshot at directory and returns its manifest.
+
+    All tables are read in one repeatable read transaction, so they agree with each other even
+    while a load runs. The snapshot is written next to directory and swapped in when complete.
+    """
+    build_directory = directory.rstrip(os.sep) + ".build"
+    shutil.rmtree(build_directory, ignore_errors=True)
+    os.makedirs(build_directory)
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            cur.execute("SELECT to_regclass('LoadGeneration') IS NOT NULL")
+            if cur.fetchone()[0]:
+                cur.execute("SELECT Generation FROM LoadGeneration")
+                load_generation = cur.fetchone()[0]
+            else:
+                load_generation = None
+        manifest = {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "load_generation": load_generation,
+            "compression": COMPRESSION,
+            "tables": {table_name: write_table(conn, table_name, build_directory) for table_name in TABLE_ORDER},
+        }
+    finally:
+        conn.rollback()
+    with open(os.path.join(build_directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    old_directory = directory.rstrip(os.sep) + ".old"
+    shutil.rmtree(old_directory, ignore_errors=True)
+    with contextlib.suppress(FileNotFoundError):
+        os.rename(directory, old_directory)
+    os.rename(build_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+    return manifest
+
+
+## -- Restore -- ##
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as f:
+        return json.load(f)
+
+def table_files(directory, entry):
+    # Glob of the Parquet files holding a table, in the form DuckDB's read_parquet takes
+    if entry["partitioned_by"]:
+        return os.path.join(directory, entry["path"], "*", "*.parquet")
+    return os.path.join(directory, entry["path"])
+
+def read_table(directory, table_name, manifest):
+    """The snapshot of table_name as an Arrow table in key order, without the partition column.
+
+    Single files are memory-mapped rather than read into a buffer first.
+    """
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    entry = manifest["tables"][table_name]
+    path = os.path.join(directory, entry["path"])
+    if entry["partitioned_by"]:
+        table = ds.dataset(path, format="parquet", partitioning="hive").to_table(columns=list(entry["columns"]))
+        table = table.sort_by(next(iter(entry["columns"])))
+    else:
+        table = pq.read_table(path, memory_map=True)
+    if table.num_rows != entry["rows"]:
+        raise ValueError(f"snapshot of {table_name} has {table.num_rows} rows, the manifest lists {entry['rows']}")
+    return table
+
+def copy_table(cur, table_name, table):
+    """Bulk loads an Arrow table into table_name with COPY, one CSV buffer per batch. Returns the row count."""
+    import pyarrow as pa
+    import pyarrow.csv
+
+    columns = ", ".join(table.column_names)
+    write_options = pyarrow.csv.WriteOptions(include_header=False)
+    for batch in table.to_batches(max_chunksize=BATCH_ROWS):
+        buffer = io.BytesIO()
+        pyarrow.csv.write_csv(pa.Table.from_batches([batch]), buffer, write_options)
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    return table.num_rows
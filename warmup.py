@@ -0,0 +1,81 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Canned questions answered before anyone asks them. At server start every question's SQL is
+# taken from the prompt cache or generated, then run once, so the first click on one finds both
+# the SQL and its first result page cached.
+
+
+class WarmupSkipped(Exception):
+    # Raised by run_query for SQL that must not run unattended
+    pass
+
+
+class Warmup:
+    """Background warm-up of a list of questions, run once on a thread pool.
+
+    generate_sql(question) returns the question's SQL and whether it came from the prompt cache,
+    run_query(sql) runs it into the result cache or raises WarmupSkipped for SQL it will not run.
+    Neither may call st, they run on worker threads.
+    """
+
+    def __init__(self, questions, generate_sql, run_query, workers=4):
+        self.questions = list(questions)
+        self.generate_sql = generate_sql
+        self.run_query = run_query
+        self.workers = workers
+        self.results = []
+        self.lock = threading.Lock()
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        """Starts the warm-up on a daemon thread and returns at once."""
+        self.started = time.perf_counter()
+        thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        if self.questions:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="warmup") as executor:
+                for _ in executor.map(self.warm_question, self.questions):
+                    pass
+        self.finished = time.perf_counter()
+        print(f"warm-up: {self.metrics()}")
+
+    def warm_question(self, question):
+        result = {"question": question, "status": "ok", "cached_sql": None, "generate_seconds": None, "query_seconds": None}
+        try:
+            step_start = time.perf_counter()
+            sql, result["cached_sql"] = self.generate_sql(question)
+            result["generate_seconds"] = time.perf_counter() - step_start
+            if not sql:
+                result["status"] = "no SQL generated"
+            else:
+                step_start = time.perf_counter()
+                self.run_query(sql)
+                result["query_seconds"] = time.perf_counter() - step_start
+        except WarmupSkipped as e:
+            result.update(status="skipped", error=str(e))
+            print(f"warm-up of {question!r} skipped: {e}")
+        except Exception as e:
+            result.update(status="error", error=str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__)
+            print(f"warm-up of {question!r} failed: {e}")
+        with self.lock:
+            self.results.append(result)
+
+    def metrics(self):
+        with self.lock:
+            results = list(self.results)
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return {
+            "questions": len(self.questions),
+            "done": len(results),
+            "ready": sum(result["status"] == "ok" for result in results),
+            "skipped": [result["question"] for result in results if result["status"] == "skipped"],
+            "failed": [result["question"] for result in results if result["status"] not in ("ok", "skipped")],
+            "running": self.started is not None and self.finished is None,
+            "seconds": end - self.started if self.started is not None else 0.0,
+        }